@@ -8,4 +8,9 @@ admin.site.register(Income)
 admin.site.register(Expense)
 admin.site.register(Receipt)
 admin.site.register(Budget)
+admin.site.register(ReceiptJob)
+admin.site.register(ReceiptImageCache)
+admin.site.register(SpendingRollup)
+admin.site.register(SearchDocument)
+admin.site.register(ReceiptItem)
 #admin.site.register(Notification)
\ No newline at end of file
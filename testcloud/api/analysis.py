@@ -0,0 +1,235 @@
+"""
+Receipt analysis (OCR) backends and the compact result they produce.
+
+Every backend returns a ParsedReceipt, so receipt creation, the image cache
+and the benchmarks never walk raw Document Intelligence results. The
+backend is selected by settings.RECEIPT_ANALYSER.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Optional
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .clients import get_document_intelligence_client
+from .models import CategoryChoices
+from .storage import get_image_storage
+
+DEFAULT_RECEIPT_ANALYSER = {
+    "BACKEND": "api.analysis.AzureReceiptAnalyser",
+    "RECORD_DIR": None,  # AzureReceiptAnalyser saves every raw result here, ready to be replayed
+    "FIXTURES_DIR": os.path.join(os.path.dirname(__file__), "analysis_fixtures"),
+    "LATENCY": 0.0,  # Seconds FixtureReceiptAnalyser sleeps per call, to imitate the remote service
+}
+
+# Lower-cased OCR receipt types mapped onto our categories, built once instead of per item
+CATEGORY_LOOKUP = {c.value.lower(): c.value for c in CategoryChoices}
+
+
+def match_category(receipt_type):
+    """Map a ReceiptType string such as "Meal" or "Supplies.Grocery" onto a CategoryChoices value."""
+    return CATEGORY_LOOKUP.get(receipt_type.split(".")[0].lower(), CategoryChoices.OTHER)
+
+
+def _decimal(value):
+    return None if value is None else Decimal(str(value))
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+@dataclass(frozen=True, slots=True)
+class ParsedItem:
+    """One line item of a receipt."""
+    description: Optional[str] = None
+    quantity: Optional[str] = None
+    total_price: Optional[Decimal] = None
+
+    def as_json(self):
+        """The item as stored in Receipt.parsed_items."""
+        details = {}
+        if self.description is not None:
+            details["description"] = {"value": self.description}
+        if self.quantity is not None:
+            details["quantity"] = {"value": self.quantity}
+        if self.total_price is not None:
+            details["total_price"] = {"value": str(self.total_price)}
+        return details
+
+
+@dataclass(frozen=True, slots=True)
+class ParsedReceipt:
+    """The fields of an analysed receipt that we store."""
+    merchant: Optional[str] = None
+    total: Optional[Decimal] = None
+    transaction_date: Optional[str] = None  # ISO date
+    receipt_type: Optional[str] = None
+    items: tuple = ()
+
+    @classmethod
+    def from_analyze_result(cls, result):
+        """Parse a prebuilt-receipt AnalyzeResult. The last document with fields wins."""
+        parsed = cls()
+        for document in result.get("documents") or []:
+            fields = document.get("fields")
+            if not fields:
+                continue
+            items = []
+            for item in (fields.get("Items") or {}).get("valueArray") or []:
+                values = item.get("valueObject") or {}
+                description = values.get("Description")
+                quantity = values.get("Quantity")
+                price = values.get("TotalPrice")
+                items.append(ParsedItem(
+                    description=description.get("valueString") if description else None,
+                    quantity=(quantity.get("valueString") or _str(quantity.get("valueNumber"))) if quantity else None,
+                    total_price=_decimal((price.get("valueCurrency") or {}).get("amount")) if price else None,
+                ))
+            merchant, total = fields.get("MerchantName"), fields.get("Total")
+            transaction_date, receipt_type = fields.get("TransactionDate"), fields.get("ReceiptType")
+            parsed = cls(
+                merchant=merchant.get("valueString") if merchant else None,
+                total=_decimal((total.get("valueCurrency") or {}).get("amount")) if total else None,
+                transaction_date=transaction_date.get("valueDate") if transaction_date else None,
+                receipt_type=receipt_type.get("valueString") if receipt_type else None,
+                items=tuple(items),
+            )
+        return parsed
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict(). Raw AnalyzeResult dicts, e.g. recorded fixtures, are parsed as well."""
+        if "documents" in data:
+            return cls.from_analyze_result(AnalyzeResult(data))
+        return cls(
+            merchant=data.get("merchant"),
+            total=_decimal(data.get("total")),
+            transaction_date=data.get("transaction_date"),
+            receipt_type=data.get("receipt_type"),
+            items=tuple(
+                ParsedItem(item.get("description"), item.get("quantity"), _decimal(item.get("total_price")))
+                for item in data.get("items", [])
+            ),
+        )
+
+    def to_dict(self):
+        """A compact JSON-serialisable form, as kept in ReceiptImageCache."""
+        return {
+            "merchant": self.merchant,
+            "total": _str(self.total),
+            "transaction_date": self.transaction_date,
+            "receipt_type": self.receipt_type,
+            "items": [
+                {"description": item.description, "quantity": item.quantity, "total_price": _str(item.total_price)}
+                for item in self.items
+            ],
+        }
+
+    def receipt_fields(self):
+        """Keyword arguments for Receipt, together with a user."""
+        return dict(
+            merchant=self.merchant or "Unknown Merchant",
+            total_amount=self.total if self.total is not None else Decimal("0.00"),
+            parsed_items=[item.as_json() for item in self.items],
+            transaction_date=self.transaction_date,
+            receipt_category=match_category(self.receipt_type) if self.receipt_type else CategoryChoices.OTHER,
+        )
+
+    def expense_fields(self):
+        """Keyword arguments for one Expense per priced line item, together with a user."""
+        # Items take the receipt type as a whole, so "Supplies.Grocery" items fall back to Other
+        category = CATEGORY_LOOKUP.get(self.receipt_type.lower(), CategoryChoices.OTHER) if self.receipt_type else CategoryChoices.OTHER
+        return [
+            dict(
+                amount=item.total_price,
+                category=category,
+                date=self.transaction_date,
+                vendor=self.merchant or "Unknown Merchant",
+                payment_method=None,
+            )
+            for item in self.items
+            if item.total_price is not None
+        ]
+
+
+class BaseReceiptAnalyser:
+    """Turns a stored receipt image into a ParsedReceipt."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def analyse(self, image_key):
+        raise NotImplementedError
+
+
+class AzureReceiptAnalyser(BaseReceiptAnalyser):
+    """Document Intelligence's prebuilt receipt model, reading the image through a signed storage URL."""
+
+    def analyse(self, image_key):
+        poller = get_document_intelligence_client().begin_analyze_document(
+            "prebuilt-receipt",
+            AnalyzeDocumentRequest(url_source=get_image_storage().url(image_key))
+        )
+        result: AnalyzeResult = poller.result()
+        if self.config["RECORD_DIR"]:
+            os.makedirs(self.config["RECORD_DIR"], exist_ok=True)
+            with open(os.path.join(self.config["RECORD_DIR"], f"{os.path.splitext(image_key)[0]}.json"), "w") as record:
+                json.dump(result.as_dict(), record)
+        return ParsedReceipt.from_analyze_result(result)
+
+
+class FixtureReceiptAnalyser(BaseReceiptAnalyser):
+    """
+    Replays recorded results from FIXTURES_DIR without any network access.
+
+    An image whose key matches a fixture name (e.g. one saved with RECORD_DIR)
+    gets that fixture; any other image gets a fixture picked from a hash of
+    its key, so the same image always yields the same receipt.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.fixtures = {}
+        for name in sorted(os.listdir(config["FIXTURES_DIR"])):
+            if name.endswith(".json"):
+                with open(os.path.join(config["FIXTURES_DIR"], name)) as fixture:
+                    self.fixtures[name[:-len(".json")]] = ParsedReceipt.from_dict(json.load(fixture))
+        self.ordered = list(self.fixtures.values())
+
+    def analyse(self, image_key):
+        if self.config["LATENCY"]:
+            time.sleep(self.config["LATENCY"])
+        parsed = self.fixtures.get(os.path.splitext(image_key)[0])
+        if parsed is None:
+            parsed = self.ordered[int(hashlib.sha256(image_key.encode()).hexdigest(), 16) % len(self.ordered)]
+        return parsed
+
+
+_analyser = None
+_analyser_lock = threading.Lock()
+
+
+def get_receipt_analyser():
+    """Return the process-wide analyser configured in RECEIPT_ANALYSER."""
+    global _analyser
+    with _analyser_lock:
+        if _analyser is None:
+            config = {**DEFAULT_RECEIPT_ANALYSER, **getattr(settings, "RECEIPT_ANALYSER", {})}
+            _analyser = import_string(config["BACKEND"])(config)
+        return _analyser
+
+
+@receiver(setting_changed)
+def reset_receipt_analyser(*, setting, **kwargs):
+    global _analyser
+    if setting == "RECEIPT_ANALYSER":
+        with _analyser_lock:
+            _analyser = None
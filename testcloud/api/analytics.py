@@ -0,0 +1,128 @@
+"""
+Spending totals per user, category and day, kept in SpendingRollup.
+
+Every receipt and expense counts towards one rollup row: the receipt on its
+transaction date (or upload date, as in budget matching) and the expense on
+its date (or creation date). Writes change the rows incrementally - the
+signal handlers in signals.py for single objects, record_spending() on the
+bulk insert paths - and rebuild_spending_rollups() recomputes them from
+scratch. spending_series() answers the analytics endpoint from the rollups
+alone.
+"""
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, TruncDate, TruncDay, TruncMonth, TruncWeek
+from .models import Expense, Receipt, SpendingRollup, User, as_money
+
+GRANULARITIES = {"day": TruncDay, "week": TruncWeek, "month": TruncMonth}
+
+RECEIPTS = 0  # Offsets into the delta lists passed to SpendingRollup.apply_deltas
+EXPENSES = 2
+
+
+def rollup_deltas(entries, kind, sign=1, deltas=None):
+    """Add `(key, amount)` rollup entries of one kind (RECEIPTS or EXPENSES) to a deltas dict."""
+    deltas = {} if deltas is None else deltas
+    for key, amount in entries:
+        values = deltas.setdefault(key, [Decimal("0.00"), 0, Decimal("0.00"), 0])
+        values[kind] += sign * amount
+        values[kind + 1] += sign
+    return deltas
+
+
+def record_spending(receipts=(), expenses=()):
+    """Count freshly bulk-inserted receipts and expenses, which fire no post_save signals, in the rollups."""
+    deltas = rollup_deltas((receipt.rollup_entry() for receipt in receipts), RECEIPTS)
+    SpendingRollup.apply_deltas(rollup_deltas((expense.rollup_entry() for expense in expenses), EXPENSES, deltas=deltas))
+
+
+def rebuild_spending_rollups(user_ids=None, batch_size=500, on_batch=None):
+    """
+    Recompute the rollups of the given users (all users by default) with two
+    grouped queries per batch of users, replacing their rows in one transaction
+    per batch. Returns the number of rows written.
+
+    Writes for a user that land while its batch is rebuilt may be lost, so run
+    it while writes are quiet.
+    """
+    if user_ids is None:
+        user_ids = User.objects.order_by("pk").values_list("pk", flat=True).iterator(chunk_size=batch_size)
+    written = 0
+    batch = []
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            written += _rebuild_batch(batch, on_batch)
+            batch = []
+    if batch:
+        written += _rebuild_batch(batch, on_batch)
+    return written
+
+
+def _rebuild_batch(user_ids, on_batch):
+    receipts = (
+        Receipt.objects.filter(user_id__in=user_ids)
+        .annotate(day=TruncDate(Coalesce("transaction_date", "uploaded_at")))
+        .values_list("user_id", "receipt_category", "day")
+        .annotate(total=Sum("total_amount"), count=Count("pk"))
+        .order_by()
+    )
+    expenses = (
+        Expense.objects.filter(user_id__in=user_ids)
+        .annotate(day=Coalesce("date", TruncDate("created_at")))
+        .values_list("user_id", "category", "day")
+        .annotate(total=Sum("amount"), count=Count("pk"))
+        .order_by()
+    )
+    rows = {}
+    for kind, grouped in ((RECEIPTS, receipts), (EXPENSES, expenses)):
+        for user_id, category, day, total, count in grouped:
+            values = rows.setdefault((user_id, category, day), [Decimal("0.00"), 0, Decimal("0.00"), 0])
+            values[kind], values[kind + 1] = as_money(total), count
+
+    with transaction.atomic():
+        SpendingRollup.objects.filter(user_id__in=user_ids).delete()
+        SpendingRollup.objects.bulk_create(
+            [
+                SpendingRollup(user_id=user_id, category=category, day=day, **dict(zip(SpendingRollup.VALUE_FIELDS, values)))
+                for (user_id, category, day), values in rows.items()
+            ],
+            batch_size=1000,
+        )
+    if on_batch:
+        on_batch(len(user_ids), len(rows))
+    return len(rows)
+
+
+def spending_series(user, granularity="month", start=None, end=None, categories=None, by_category=True):
+    """
+    Spending per period (and per category unless `by_category` is false) between
+    two dates, inclusive, as dicts ordered by period. Periods are keyed by their
+    first day; weeks start on Monday.
+    """
+    rollups = SpendingRollup.objects.filter(user=user)
+    if start:
+        rollups = rollups.filter(day__gte=start)
+    if end:
+        rollups = rollups.filter(day__lte=end)
+    if categories:
+        rollups = rollups.filter(category__in=categories)
+
+    group_by = ["period", "category"] if by_category else ["period"]
+    rows = (
+        rollups.annotate(period=GRANULARITIES[granularity]("day"))
+        .values(*group_by)
+        .annotate(**{field: Sum(field) for field in SpendingRollup.VALUE_FIELDS})
+        .order_by(*group_by)
+    )
+    return [
+        {
+            **{name: row[name] for name in group_by},
+            "receipt_total": f"{as_money(row['receipt_total']):.2f}",
+            "receipt_count": row["receipt_count"],
+            "expense_total": f"{as_money(row['expense_total']):.2f}",
+            "expense_count": row["expense_count"],
+        }
+        for row in rows
+    ]
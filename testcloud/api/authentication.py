@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import router
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import BasicAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+DEFAULT_BASIC_AUTH_CACHE = {
+    "MAX_ENTRIES": 1024,
+    "TTL": 300,  # Seconds a verified email/password pair skips the password hasher
+}
+
+DEFAULT_JWT_USER_CACHE = {
+    "CACHE": "default",
+    "TTL": 60,  # Upper bound on staleness for changes that bypass save(), e.g. QuerySet.update()
+}
+
+
+def get_jwt_user_cache_settings():
+    """Return the JWT_USER_CACHE settings merged over the defaults."""
+    return {**DEFAULT_JWT_USER_CACHE, **getattr(settings, "JWT_USER_CACHE", {})}
+
+
+# The user fields kept in JWT_USER_CACHE; everything else, the password hash included, stays in the database
+JWT_USER_CACHE_FIELDS = ("id", "email", "full_name", "is_active", "is_staff", "is_superuser")
+
+
+def _jwt_user_cache_key(user_id):
+    return f"jwt-user:{user_id}"
+
+
+def invalidate_cached_user(user_id):
+    """Drop the user cached for JWT requests, e.g. after a password change, deactivation or deletion."""
+    caches[get_jwt_user_cache_settings()["CACHE"]].delete(_jwt_user_cache_key(user_id))
+
+
+class VerifiedCredentialCache:
+    """
+    A bounded, per-process LRU of recently verified credentials.
+
+    Entries are keyed by an HMAC of the credentials (never the password
+    itself) and remember the password hash they were verified against, so a
+    password change invalidates them on the next lookup.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(userid, password):
+        return salted_hmac("api.authentication.VerifiedCredentialCache", f"{userid}\0{password}", algorithm="sha256").hexdigest()
+
+    def get(self, key):
+        """Return `(user_pk, password_hash)` for a live entry, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key, user_pk, password_hash):
+        with self._lock:
+            self._entries[key] = (user_pk, password_hash, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """
+    BasicAuthentication that only runs the password hasher the first time a
+    credential pair is seen within BASIC_AUTH_CACHE['TTL'] seconds. Repeat
+    requests cost a primary-key lookup instead of a full PBKDF2 hash.
+
+    Kept for clients still sending Basic headers; new logins get JWTs.
+    """
+    _cache = None
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def get_cache(cls):
+        with cls._cache_lock:
+            if cls._cache is None:
+                config = {**DEFAULT_BASIC_AUTH_CACHE, **getattr(settings, "BASIC_AUTH_CACHE", {})}
+                cls._cache = VerifiedCredentialCache(config["MAX_ENTRIES"], config["TTL"])
+            return cls._cache
+
+    def authenticate_credentials(self, userid, password, request=None):
+        cache = self.get_cache()
+        key = cache.key(userid, password)
+        cached = cache.get(key)
+        if cached is not None:
+            user_pk, password_hash = cached
+            user = get_user_model()._default_manager.filter(pk=user_pk, is_active=True).first()
+            if user is not None and constant_time_compare(user.password, password_hash):
+                return (user, None)
+            cache.discard(key)
+
+        user, auth = super().authenticate_credentials(userid, password, request)
+        cache.set(key, user.pk, user.password)
+        return (user, auth)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that resolves the token's user from JWT_USER_CACHE
+    instead of querying it on every request.
+
+    Only JWT_USER_CACHE_FIELDS and the password stamp that tokens carry for
+    the revoked-token check are cached, never the password hash. Users built
+    from an entry have their other fields deferred, so they load on access
+    and a save() only writes the cached fields. Saving or deleting a user
+    invalidates its entry (see signals.py).
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        config = get_jwt_user_cache_settings()
+        cache = caches[config["CACHE"]]
+        cache_key = _jwt_user_cache_key(user_id)
+        entry = cache.get(cache_key)
+        if entry is None:
+            try:
+                user = self.user_model.objects.get(**{jwt_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            password_stamp = get_md5_hash_password(user.password)
+            entry = ({name: getattr(user, name) for name in JWT_USER_CACHE_FIELDS}, password_stamp)
+            cache.set(cache_key, entry, timeout=config["TTL"])
+        else:
+            values, password_stamp = entry
+            names = [f.attname for f in self.user_model._meta.concrete_fields if f.attname in values]  # from_db wants model order
+            user = self.user_model.from_db(router.db_for_read(self.user_model), names, [values[name] for name in names])
+
+        if jwt_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if jwt_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(jwt_settings.REVOKE_TOKEN_CLAIM) != password_stamp:
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+
+@receiver(setting_changed)
+def reset_basic_auth_cache(*, setting, **kwargs):
+    if setting == "BASIC_AUTH_CACHE":
+        with CachedBasicAuthentication._cache_lock:
+            CachedBasicAuthentication._cache = None
@@ -0,0 +1,410 @@
+"""
+Benchmarks for the hot paths of the API, run with `manage.py benchmark`.
+
+Each benchmark is registered with @benchmark and returns a JSON-serialisable
+dict of measurements. Micro-benchmarks take the number of repeats, create
+their own throwaway user and delete it afterwards, so they can run against
+any database. Dataset benchmarks (`@benchmark(name, dataset=True)`) also take
+a Dataset seeded by seeding.seed_dataset() and time real requests against
+it; the command runs them in a throwaway test database.
+"""
+import base64
+import itertools
+import multiprocessing
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+import uuid
+from dataclasses import dataclass
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import override_settings
+from PIL import Image
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import RefreshToken
+from .authentication import CachedBasicAuthentication, CachedJWTAuthentication
+from .analysis import ParsedItem, ParsedReceipt
+from .budgeting import link_receipts_to_budgets
+from .imaging import get_image_settings, prepare_image
+from .models import Budget, Expense, Receipt, User
+from .processing import create_receipt_from_result
+from .seeding import seed_dataset
+
+BENCHMARKS = {}
+
+# Dataset shapes for the dataset benchmarks: the first user is the one whose requests are timed
+DATASETS = {
+    "smoke": {"users": 1, "receipts_per_user": 10},
+    "small": {"users": 10, "receipts_per_user": 1_000},
+    "medium": {"users": 100, "receipts_per_user": 10_000},
+    "wide": {"users": 10_000, "receipts_per_user": 10},
+    "deep": {"users": 1, "receipts_per_user": 100_000},
+}
+
+# Relative slowdown or growth tolerated against a baseline before a metric counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def benchmark(name, dataset=False):
+    """Register a benchmark function under `name`; dataset benchmarks are called with `(dataset, repeat)`."""
+    def register(function):
+        function.needs_dataset = dataset
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@contextmanager
+def benchmark_user(password=None):
+    """Yield a user whose data is deleted once the benchmark finishes."""
+    user = User.objects.create_user(email=f"benchmark-{uuid.uuid4().hex}@example.com", password=password, full_name="Benchmark")
+    try:
+        yield user
+    finally:
+        user.delete()
+
+
+def measure(function, repeat):
+    """Call `function` `repeat` times and summarise the wall-clock time per call in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": repeat,
+        "mean_ms": round(statistics.mean(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "min_ms": round(min(samples), 3),
+        "max_ms": round(max(samples), 3),
+        "per_sec": round(repeat * 1000 / sum(samples), 2) if sum(samples) else None,
+    }
+
+
+def profile(function):
+    """Run `function` once, returning its database query count and peak Python heap growth in KB."""
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    try:
+        with connection.execute_wrapper(count):
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"queries": queries, "peak_kb": round(peak / 1024, 1)}
+
+
+def measure_with_profile(function, repeat):
+    """measure() plus the query count and peak memory of one extra, separately profiled call."""
+    function()  # Warm up caches and lazy imports outside the timings
+    return {**measure(function, repeat), **profile(function)}
+
+
+@dataclass
+class Dataset:
+    """A seeded dataset; benchmarks act as `user`, the first seeded user."""
+    name: str
+    config: dict
+    user_ids: list
+    seed_seconds: float
+
+    @property
+    def user(self):
+        return User.objects.get(pk=self.user_ids[0])
+
+    def busiest_budget(self):
+        return Budget.objects.filter(user_id=self.user_ids[0]).annotate(links=Count("receipts")).order_by("-links", "pk").first()
+
+    def client(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        return client
+
+
+def build_dataset(name, seed=0):
+    """Seed the dataset shape `name` from DATASETS."""
+    config = DATASETS[name]
+    start = time.perf_counter()
+    user_ids = seed_dataset(config["users"], config["receipts_per_user"], seed=seed, email_prefix=f"benchmark-{uuid.uuid4().hex[:8]}")
+    return Dataset(name, config, user_ids, round(time.perf_counter() - start, 2))
+
+
+@contextmanager
+def throwaway_database():
+    """Run the block against a freshly created and migrated test database, which is dropped afterwards."""
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return a description of every metric in `current` that regressed against `baseline`.
+
+    Median latency and peak memory may grow by `tolerance`, throughput may
+    drop by it, and query counts must not grow at all.
+    """
+    regressions = []
+
+    def walk(old, new, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            where = f"{path}.{key}" if path else key
+            before = old[key]
+            if isinstance(value, dict) and isinstance(before, dict):
+                walk(before, value, where)
+            elif not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or isinstance(value, bool):
+                continue
+            elif key == "queries" and value > before:
+                regressions.append(f"{where}: {before} -> {value}")
+            elif key in ("median_ms", "peak_kb") and before and value > before * (1 + tolerance):
+                regressions.append(f"{where}: {before} -> {value} (+{(value / before - 1) * 100:.0f}%)")
+            elif key == "per_sec" and before and value < before * (1 - tolerance):
+                regressions.append(f"{where}: {before} -> {value} (-{(1 - value / before) * 100:.0f}%)")
+
+    walk(baseline, current, "")
+    return regressions
+
+
+def sample_receipt(items=40):
+    """A parsed grocery receipt with `items` priced line items."""
+    return ParsedReceipt(
+        merchant="Benchmark Grocer",
+        total=Decimal("2.50") * items,
+        transaction_date="2024-02-10",
+        receipt_type="Supplies",
+        items=tuple(ParsedItem(description=f"Item {index}", total_price=Decimal("2.50")) for index in range(items)),
+    )
+
+
+def _per_item_write(user, image_key, parsed):
+    """The previous write path: one autocommitted INSERT per line item, outside a transaction."""
+    for expense_fields in parsed.expense_fields():
+        Expense.objects.create(user=user, **expense_fields)
+    receipt = Receipt.objects.create(user=user, image_key=image_key or "", **parsed.receipt_fields())
+    link_receipts_to_budgets([receipt], created=True)
+    return receipt
+
+
+@benchmark("receipt_write")
+def receipt_write(repeat):
+    """Per-receipt latency of storing a 40-item OCR result, per-item INSERTs against the bulk path."""
+    result = sample_receipt(items=40)
+    with benchmark_user() as user:
+        Budget.objects.create(user=user, limit_amount=1000, start_date="2024-02-01", end_date="2024-02-29")
+        return {
+            "items": 40,
+            "per_item": measure(lambda: _per_item_write(user, None, result), repeat),
+            "bulk": measure(lambda: create_receipt_from_result(user, None, result), repeat),
+        }
+
+
+def _legacy_compress_image(image_file):
+    """The previous compress_image: a full-resolution decode and convert in the calling thread."""
+    img = Image.open(image_file)
+    img = img.convert("RGB")
+    img_io = BytesIO()
+    img.save(img_io, format="JPEG", quality=70)
+    img_io.seek(0)
+    return img_io
+
+
+def sample_photo(megapixels=12):
+    """A noisy 4:3 JPEG of roughly `megapixels`, standing in for a phone photo."""
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    noise = Image.effect_noise((width, width * 3 // 4), 40)
+    output = BytesIO()
+    Image.merge("RGB", (noise, noise, noise)).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def _proc_status_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def _preprocess_in_child(variant, data, runs):
+    """Runs in a forked process so its peak RSS (VmHWM, Linux only) reflects this workload alone."""
+    config = get_image_settings()
+    if variant == "legacy":
+        work = lambda: _legacy_compress_image(BytesIO(data))
+    else:
+        work = lambda: prepare_image(data, config["MAX_DIMENSION"], config["MAX_PIXELS"], config["JPEG_QUALITY"])
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")  # Reset the peak RSS counter
+    baseline = _proc_status_kb("VmRSS")
+    start = time.perf_counter()
+    for _ in range(runs):
+        size = len(work().getvalue() if variant == "legacy" else work())
+    elapsed = time.perf_counter() - start
+    return {
+        "peak_rss_mb": round((_proc_status_kb("VmHWM") - baseline) / 1024, 1),
+        "images_per_sec": round(runs / elapsed, 2),
+        "output_kb": round(size / 1024, 1),
+    }
+
+
+@benchmark("image_preprocess")
+def image_preprocess(repeat):
+    """Peak memory and single-process throughput of the old compress_image against prepare_image on a 12 MP photo."""
+    data = sample_photo(megapixels=12)
+    results = {"megapixels": 12, "input_kb": round(len(data) / 1024, 1)}
+    for variant in ("legacy", "pipeline"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as executor:
+            results[variant] = executor.submit(_preprocess_in_child, variant, data, repeat).result()
+    return results
+
+
+@benchmark("auth")
+def auth_overhead(repeat):
+    """Per-request cost of Basic auth (hashed every time and cached) against JWT bearer tokens (with and without the user cache)."""
+    password = "benchmark-password"
+    with benchmark_user(password=password) as user:
+        factory = APIRequestFactory()
+        basic = "Basic " + base64.b64encode(f"{user.email}:{password}".encode()).decode()
+        bearer = f"Bearer {RefreshToken.for_user(user).access_token}"
+
+        def authenticate(authenticator, header):
+            assert authenticator.authenticate(Request(factory.get("/", HTTP_AUTHORIZATION=header)))[0].pk == user.pk
+
+        cached = CachedBasicAuthentication()
+        authenticate(cached, basic)  # The first request pays for the hash
+        cached_jwt = CachedJWTAuthentication()
+        authenticate(cached_jwt, bearer)  # ...and the first JWT request for the user query
+        return {
+            "basic": measure(lambda: authenticate(BasicAuthentication(), basic), repeat),
+            "cached_basic": measure(lambda: authenticate(cached, basic), repeat),
+            "jwt": measure(lambda: authenticate(JWTAuthentication(), bearer), repeat),
+            "cached_jwt": measure(lambda: authenticate(cached_jwt, bearer), repeat),
+        }
+
+
+def _get(client, path):
+    response = client.get(path)
+    assert response.status_code == 200, (path, response.status_code)
+    if response.streaming:
+        b"".join(response.streaming_content)  # Streamed exports are only produced while read
+
+
+@benchmark("receipt_list", dataset=True)
+def receipt_list(dataset, repeat):
+    """First page of GET /api/receipts/ at the default and the largest page size."""
+    client = dataset.client()
+    return {
+        "page_50": measure_with_profile(lambda: _get(client, "/api/receipts/"), repeat),
+        "page_500": measure_with_profile(lambda: _get(client, "/api/receipts/?page_size=500"), repeat),
+    }
+
+
+@benchmark("budget_list", dataset=True)
+def budget_list(dataset, repeat):
+    """GET /api/budgets/, lean and with ?expand=receipts."""
+    client = dataset.client()
+    return {
+        "lean": measure_with_profile(lambda: _get(client, "/api/budgets/"), repeat),
+        "expanded": measure_with_profile(lambda: _get(client, "/api/budgets/?expand=receipts"), repeat),
+    }
+
+
+@benchmark("budget_report", dataset=True)
+def budget_report(dataset, repeat):
+    """GET /api/budget-report/<id>/ for the busiest budget, built from scratch and served from the snapshot cache."""
+    client = dataset.client()
+    path = f"/api/budget-report/{dataset.busiest_budget().pk}/"
+    cache = caches[getattr(settings, "BUDGET_REPORT_CACHE", "default")]
+
+    def cold():
+        cache.clear()
+        _get(client, path)
+
+    return {
+        "cold": measure_with_profile(cold, repeat),
+        "cached": measure_with_profile(lambda: _get(client, path), repeat),
+    }
+
+
+@benchmark("spending_analytics", dataset=True)
+def spending_analytics(dataset, repeat):
+    """GET /api/analytics/spending/ over all of the user's history, per month and per day."""
+    client = dataset.client()
+    return {
+        "month": measure_with_profile(lambda: _get(client, "/api/analytics/spending/"), repeat),
+        "day": measure_with_profile(lambda: _get(client, "/api/analytics/spending/?granularity=day"), repeat),
+    }
+
+
+@benchmark("search", dataset=True)
+def search(dataset, repeat):
+    """GET /api/search/: a common item (coffee), a merchant prefix (walm) and a rarer two-word item query."""
+    client = dataset.client()
+    return {
+        query.replace(" ", "_"): measure_with_profile(lambda query=query: _get(client, f"/api/search/?q={query}"), repeat)
+        for query in ("coffee", "walm", "car wash")
+    }
+
+
+@benchmark("xlsx_export", dataset=True)
+def xlsx_export(dataset, repeat):
+    """All of the user's receipts as XLSX, and as streamed CSV."""
+    client = dataset.client()
+    return {
+        "xlsx": measure_with_profile(lambda: _get(client, "/api/export/receipts/"), repeat),
+        "csv": measure_with_profile(lambda: _get(client, "/api/export/receipts/?export_format=csv"), repeat),
+    }
+
+
+@benchmark("assign_to_budget", dataset=True)
+def assign_to_budget(dataset, repeat):
+    """Re-matching one already linked receipt to its budgets with Receipt.assign_to_budget()."""
+    receipts = itertools.cycle(Receipt.objects.filter(user_id=dataset.user_ids[0]).order_by("pk")[:repeat + 2])
+    return measure_with_profile(lambda: next(receipts).assign_to_budget(), repeat)
+
+
+@benchmark("ocr_pipeline", dataset=True)
+def ocr_pipeline(dataset, repeat):
+    """POST /api/process-receipt/ end to end, with the fixture analyser and local storage standing in for Azure."""
+    client = dataset.client()
+    location = tempfile.mkdtemp()
+    colors = itertools.count()
+
+    def upload():
+        # A new image every time, so the image cache never short-circuits the pipeline
+        color = next(colors)
+        buffer = BytesIO()
+        Image.new("RGB", (800, 1200), (color % 256, color // 256 % 256, color // 65536 % 256)).save(buffer, format="JPEG")
+        buffer.seek(0)
+        buffer.name = "receipt.jpg"
+        response = client.post("/api/process-receipt/", {"image": buffer}, format="multipart")
+        assert response.status_code == 201, response.status_code
+
+    try:
+        with override_settings(
+            RECEIPT_ANALYSER={"BACKEND": "api.analysis.FixtureReceiptAnalyser"},
+            RECEIPT_STORAGE={"BACKEND": "api.storage.LocalFileStorage", "LOCATION": location},
+        ):
+            return measure_with_profile(upload, repeat)
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
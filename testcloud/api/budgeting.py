@@ -0,0 +1,137 @@
+"""
+Set-based matching of receipts to budgets.
+
+A receipt belongs to every budget of its owner whose period contains the
+receipt date (the transaction date, or the upload time when unknown) and
+which either has no filter categories or lists the receipt's category.
+Links are written with one bulk insert into the Receipt.budget through
+table and spending is adjusted with Budget.apply_spending_deltas, so the
+m2m_changed handlers in signals.py are not involved on this path.
+"""
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_aware, localdate
+from .models import Budget, Receipt
+
+
+def receipt_date(receipt):
+    """The date a receipt is matched on, compared the way DateField lookups compare datetimes."""
+    value = receipt.transaction_date or receipt.uploaded_at
+    if isinstance(value, str):
+        value = parse_datetime(value) or parse_date(value)
+    if isinstance(value, datetime):
+        return localdate(value) if is_aware(value) else value.date()
+    return value
+
+
+def match_budgets(receipts, budget_ids=None):
+    """
+    Resolve the matching budgets for a batch of saved receipts with a single query.
+
+    Only the budgets in `budget_ids` are considered when it is given.
+    Returns `({receipt_pk: {budget_pk, ...}}, {budget_pk: filter_categories})`.
+    """
+    receipts = [receipt for receipt in receipts if receipt_date(receipt) is not None]
+    if not receipts:
+        return {}, {}
+    dates = [receipt_date(receipt) for receipt in receipts]
+    budgets = Budget.objects.filter(
+        user_id__in={receipt.user_id for receipt in receipts},
+        start_date__lte=max(dates),
+        end_date__gte=min(dates),
+    )
+    if budget_ids is not None:
+        budgets = budgets.filter(pk__in=budget_ids)
+    rows = budgets.values_list("pk", "user_id", "start_date", "end_date", "category_filters__category")
+
+    budgets = {}
+    filters = defaultdict(set)
+    for budget_id, user_id, start_date, end_date, category in rows:
+        budgets[budget_id] = (user_id, start_date, end_date)
+        if category:
+            filters[budget_id].add(category)
+
+    matches = {}
+    for receipt, day in zip(receipts, dates):
+        matches[receipt.pk] = {
+            budget_id
+            for budget_id, (user_id, start_date, end_date) in budgets.items()
+            if user_id == receipt.user_id and start_date <= day <= end_date
+            and Budget.category_counts(filters[budget_id], receipt.receipt_category)
+        }
+    return matches, {budget_id: filters[budget_id] for budget_id in budgets}
+
+
+def link_receipts_to_budgets(receipts, created=False, budget_ids=None):
+    """
+    Link each receipt to all of its matching budgets and update their spending.
+
+    Receipts that match at least one budget have their links replaced by the
+    matches; receipts that match none keep their current links. Pass
+    `created=True` for receipts that were just inserted to skip reading the
+    existing links, and `budget_ids` to leave links to other budgets alone.
+
+    Existing receipts are locked while their links are read and rewritten, so
+    concurrent calls for the same receipt cannot both count a link. A link
+    inserted behind the lock's back (e.g. by `budget.receipts.add`) makes the
+    insert fail with IntegrityError rather than count it twice.
+    """
+    receipts = list(receipts)
+    matches, filters = match_budgets(receipts, budget_ids)
+    matched = {receipt_id for receipt_id, budget_ids in matches.items() if budget_ids}
+    if not matched:
+        return
+
+    with transaction.atomic(savepoint=False):
+        wanted = {(receipt_id, budget_id) for receipt_id in matched for budget_id in matches[receipt_id]}
+        through = Receipt.budget.through
+        existing = set()
+        if not created:
+            # Lock the receipts first, so a concurrent call for them reads the links this one writes
+            list(Receipt.objects.select_for_update().filter(pk__in=matched).order_by("pk").values_list("pk"))
+            links = through.objects.filter(receipt_id__in=matched)
+            if budget_ids is not None:
+                links = links.filter(budget_id__in=budget_ids)
+            existing = set(links.values_list("receipt_id", "budget_id"))
+        added = wanted - existing
+        removed = existing - wanted
+
+        through.objects.bulk_create([through(receipt_id=receipt_id, budget_id=budget_id) for receipt_id, budget_id in added])
+        if removed:
+            stale = Q()
+            for receipt_id, budget_id in removed:
+                stale |= Q(receipt_id=receipt_id, budget_id=budget_id)
+            through.objects.filter(stale).delete()
+            stale_budgets = {budget_id for _, budget_id in removed} - set(filters)
+            filters.update(
+                (budget_id, set(categories or []))
+                for budget_id, categories in Budget.objects.filter(pk__in=stale_budgets).values_list("pk", "filter_categories")
+            )
+
+        keys = {receipt.pk: receipt.spending_key() for receipt in receipts}
+        deltas = defaultdict(Decimal)
+        for pairs, sign in ((added, 1), (removed, -1)):
+            for receipt_id, budget_id in pairs:
+                amount, category = keys[receipt_id]
+                if Budget.category_counts(filters[budget_id], category):
+                    deltas[budget_id] += sign * amount
+        Budget.apply_spending_deltas(deltas, touched={budget_id for _, budget_id in added | removed})
+
+
+def link_budget_to_receipts(budget):
+    """
+    Retroactively link a budget to its owner's existing receipts.
+
+    The query only narrows the candidates down to the budget's period;
+    link_receipts_to_budgets decides the matches and the spending they add.
+    """
+    day_in_period = (
+        Q(transaction_date__date__gte=budget.start_date, transaction_date__date__lte=budget.end_date)
+        | Q(transaction_date__isnull=True, uploaded_at__date__gte=budget.start_date, uploaded_at__date__lte=budget.end_date)
+    )
+    candidates = Receipt.objects.filter(day_in_period, user_id=budget.user_id).exclude(budget=budget)
+    link_receipts_to_budgets(candidates.only(*Receipt.SPENDING_FIELDS), budget_ids=[budget.pk])
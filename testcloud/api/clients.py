@@ -0,0 +1,148 @@
+"""
+Per-process registry of long-lived HTTP and Azure SDK clients.
+
+Clients are created on first use and share one keep-alive `requests.Session`,
+so receipts reuse TLS connections instead of handshaking on every call. The
+registry is rebuilt after a fork and closed when the process exits.
+"""
+import atexit
+import os
+import threading
+from collections import Counter
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+DEFAULT_HTTP_POOL = {
+    "CONNECTIONS": 10,  # Hosts with a cached connection pool
+    "MAXSIZE": 20,  # Keep-alive connections kept per host; size it to the number of worker threads
+}
+
+_connection_stats = Counter()
+_connection_stats_lock = threading.Lock()
+
+
+def get_connection_stats():
+    """Return how many HTTP requests this process sent and how many new connections they needed."""
+    with _connection_stats_lock:
+        stats = {"requests": _connection_stats["requests"], "connections_opened": _connection_stats["connections_opened"]}
+    stats["connections_reused"] = stats["requests"] - stats["connections_opened"]
+    return stats
+
+
+def _count(name):
+    with _connection_stats_lock:
+        _connection_stats[name] += 1
+
+
+class _CountingPoolMixin:
+    def _new_conn(self):
+        _count("connections_opened")
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        _count("requests")
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connection pools record requests and newly opened connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+
+_clients = {}
+_clients_lock = threading.RLock()  # Client factories fetch the shared session
+_clients_pid = os.getpid()
+
+
+def _get_client(name, factory):
+    global _clients, _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Forked worker: the parent's sockets must not be shared, so start over without closing them
+            _clients, _clients_pid = {}, os.getpid()
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_http_session():
+    """Return the process-wide keep-alive session."""
+    def create():
+        config = {**DEFAULT_HTTP_POOL, **getattr(settings, "HTTP_POOL", {})}
+        session = Session()
+        adapter = CountingHTTPAdapter(pool_connections=config["CONNECTIONS"], pool_maxsize=config["MAXSIZE"])
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _get_client("http", create)
+
+
+def _azure_transport():
+    # The session belongs to the registry, so closing an SDK client must leave it open
+    return RequestsTransport(session=get_http_session(), session_owner=False)
+
+
+def get_blob_service_client():
+    """Return the process-wide Blob Storage client for settings.AZURE_STORAGE."""
+    def create():
+        config = settings.AZURE_STORAGE
+        return BlobServiceClient(
+            f"https://{config['ACCOUNT_NAME']}.blob.core.windows.net",
+            credential=config["ACCOUNT_KEY"],
+            transport=_azure_transport(),
+            max_single_put_size=config.get("BLOCK_SIZE", 4 * 1024 * 1024),
+            max_block_size=config.get("BLOCK_SIZE", 4 * 1024 * 1024),
+        )
+    return _get_client("blob", create)
+
+
+def get_document_intelligence_client():
+    """Return the process-wide Document Intelligence client for settings.DOCUMENT_INTELLIGENCE."""
+    def create():
+        config = settings.DOCUMENT_INTELLIGENCE
+        return DocumentIntelligenceClient(
+            endpoint=config["ENDPOINT"],
+            credential=AzureKeyCredential(config["KEY"]),
+            transport=_azure_transport(),
+        )
+    return _get_client("document_intelligence", create)
+
+
+def close_clients():
+    """Close every client created by this process. They are recreated lazily if used again."""
+    global _clients
+    with _clients_lock:
+        clients, _clients = _clients, {}
+    session = clients.pop("http", None)
+    for client in clients.values():
+        client.close()
+    if session is not None:
+        session.close()
+
+
+atexit.register(close_clients)
+
+
+@receiver(setting_changed)
+def reset_clients(*, setting, **kwargs):
+    if setting in ("HTTP_POOL", "AZURE_STORAGE", "DOCUMENT_INTELLIGENCE"):
+        close_clients()
@@ -0,0 +1,98 @@
+"""
+Receipt image preprocessing: downscale, orient and re-encode uploads before OCR.
+
+The work is CPU-bound, so it runs on a process pool and request threads only
+wait for the result. This module must stay importable without Django being
+set up (no model imports), because the pool's worker processes are spawned.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+DEFAULT_RECEIPT_IMAGES = {
+    "MAX_DIMENSION": 2000,  # Longest side in pixels; plenty for the receipt model
+    "MAX_PIXELS": 50_000_000,  # Anything larger is rejected as a decompression bomb
+    "JPEG_QUALITY": 70,
+    "WORKERS": 2,  # Preprocessing processes; 0 runs in the calling thread
+    "MAX_BYTES": 20 * 1024 * 1024,  # Largest upload or download accepted
+    "CHUNK_SIZE": 64 * 1024,  # Bytes read at a time while ingesting an image
+}
+
+
+class ImageRejected(ValueError):
+    """Raised when an upload is not a readable image or is too large to decode safely."""
+
+
+def get_image_settings():
+    """Return the RECEIPT_IMAGES settings merged over the defaults."""
+    return {**DEFAULT_RECEIPT_IMAGES, **getattr(settings, "RECEIPT_IMAGES", {})}
+
+
+def prepare_image(source, max_dimension, max_pixels, quality):
+    """
+    Return the image in `source` (bytes, a path or a binary file) re-encoded
+    as an upright RGB JPEG no larger than `max_dimension` on its longest side.
+
+    JPEGs are decoded at a reduced scale with `draft()`, so a 48 MP photo
+    never needs its full-resolution bitmap in memory.
+    """
+    try:
+        with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as img:
+            # Only the header has been read so far, so this check is cheap
+            if img.width * img.height > max_pixels:
+                raise ImageRejected(f"Image is too large ({img.width}x{img.height} pixels).")
+            scale = min(1, max_dimension / max(img.size))
+            img.draft("RGB", (round(img.width * scale), round(img.height * scale)))
+            img.thumbnail((max_dimension, max_dimension))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ImageRejected(f"Could not read image: {e}")
+
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned rather than forked: the web process runs threads (job and batch pools)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def preprocess_image(source):
+    """
+    Prepare an image (bytes or a binary file) for OCR according to
+    RECEIPT_IMAGES, returning JPEG bytes. Files on disk are handed to the
+    worker process by path rather than copied through a pipe.
+    """
+    config = get_image_settings()
+    options = (config["MAX_DIMENSION"], config["MAX_PIXELS"], config["JPEG_QUALITY"])
+    if not config["WORKERS"]:
+        return prepare_image(source, *options)
+    if not isinstance(source, bytes):
+        path = getattr(source, "name", None)
+        source = path if isinstance(path, str) and os.path.isfile(path) else source.read()
+    return _get_executor(config["WORKERS"]).submit(prepare_image, source, *options).result()
+
+
+@receiver(setting_changed)
+def reset_image_executor(*, setting, **kwargs):
+    global _executor
+    if setting == "RECEIPT_IMAGES":
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = None
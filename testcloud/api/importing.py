@@ -0,0 +1,268 @@
+"""
+Bulk import of a user's expenses or receipts from CSV or JSON lines.
+
+The input is read as a stream and handled a chunk of rows at a time. Rows are
+checked by small per-field cleaners instead of the DRF serializers, and every
+chunk's valid rows are written in one transaction with bulk_create, together
+with what the single-object signal handlers would have done: budget links
+through the set-based matcher, receipt items, spending rollups and search
+documents. Invalid rows are reported by line number and never stop the import.
+"""
+import codecs
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, time as time_of_day
+from decimal import Decimal
+from django.db import DatabaseError, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, make_aware
+from .analysis import CATEGORY_LOOKUP, ParsedItem
+from .analytics import record_spending
+from .budgeting import link_receipts_to_budgets
+from .models import CategoryChoices, Expense, Receipt, ReceiptItem, parse_decimal
+from .search import index_documents
+
+FORMATS = ("csv", "ndjson")
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000  # Errors kept on ImportResult; on_error sees all of them
+
+
+class RowError(ValueError):
+    """A row that cannot be imported."""
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    errors: list = field(default_factory=list)  # The first MAX_REPORTED_ERRORS `(line, message)` pairs
+    error: str = None  # Why reading stopped before the end of the input, if it did
+
+    @property
+    def rows_per_second(self):
+        return (self.imported + self.failed) / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            "imported": self.imported,
+            "failed": self.failed,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+            "errors": [{"line": line, "error": message} for line, message in self.errors],
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+class ErrorFile:
+    """An `on_error` callback writing rejected rows to a CSV of line, error and the row as JSON."""
+
+    def __init__(self, stream):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(["line", "error", "row"])
+
+    def __call__(self, line, message, row):
+        self.writer.writerow([line, message, "" if row is None else json.dumps(row, default=str)])
+
+
+def _text(row, name, max_length, required=False):
+    value = row.get(name)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f"{name} is required.")
+    if len(value) > max_length:
+        raise RowError(f"{name} is longer than {max_length} characters.")
+    return value or None
+
+
+def _money(row, name, required=False):
+    value = row.get(name)
+    if value is None or value == "":
+        if required:
+            raise RowError(f"{name} is required.")
+        return None
+    amount = parse_decimal(value)
+    if amount is None or abs(amount) >= 10 ** 8:
+        raise RowError(f"{name} is not a valid amount: {value!r}.")
+    return amount.quantize(Decimal("0.01"))
+
+
+def _category(row, name):
+    value = _text(row, name, 50)
+    if value is None:
+        return CategoryChoices.OTHER
+    try:
+        return CATEGORY_LOOKUP[value.lower()]
+    except KeyError:
+        raise RowError(f"{name} must be one of: {', '.join(CategoryChoices.values)}.")
+
+
+def _date(row, name):
+    value = _text(row, name, 32)
+    if value is None:
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise RowError(f"{name} must be a date in YYYY-MM-DD format.")
+    return day
+
+
+def _datetime(row, name):
+    value = _text(row, name, 40)
+    if value is None:
+        return None
+    try:
+        moment = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise RowError(f"{name} must be an ISO date or date and time.")
+    if not isinstance(moment, datetime):
+        moment = datetime.combine(moment, time_of_day())
+    return make_aware(moment) if is_naive(moment) else moment
+
+
+def clean_expense(row):
+    """Expense keyword arguments from an import row."""
+    return dict(
+        amount=_money(row, "amount", required=True),
+        category=_category(row, "category"),
+        date=_date(row, "date"),
+        vendor=_text(row, "vendor", 100),
+        payment_method=_text(row, "payment_method", 50),
+    )
+
+
+def clean_receipt(row):
+    """
+    Receipt keyword arguments from an import row. JSON rows may carry `items`,
+    a list of `{"description", "quantity", "total_price"}` objects.
+    """
+    items = row.get("items") or []
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise RowError("items must be a list of objects.")
+    parsed_items = []
+    for item in items:
+        price = _money(item, "total_price")
+        parsed_items.append(ParsedItem(
+            description=_text(item, "description", 255),
+            quantity=_text(item, "quantity", 20),
+            total_price=price,
+        ).as_json())
+    return dict(
+        merchant=_text(row, "merchant", 100),
+        total_amount=_money(row, "total_amount"),
+        transaction_date=_datetime(row, "transaction_date"),
+        receipt_category=_category(row, "receipt_category"),
+        parsed_items=parsed_items,
+    )
+
+
+def _create_expenses(user, rows):
+    expenses = Expense.objects.bulk_create([Expense(user=user, **fields) for fields in rows])
+    record_spending(expenses=expenses)
+    index_documents(expenses=expenses)
+
+
+def _create_receipts(user, rows):
+    receipts = Receipt.objects.bulk_create([Receipt(user=user, **fields) for fields in rows])
+    ReceiptItem.objects.bulk_create([item for receipt in receipts for item in receipt.item_rows()])
+    link_receipts_to_budgets(receipts, created=True)
+    record_spending(receipts=receipts)
+    index_documents(receipts=receipts)
+
+
+IMPORTERS = {
+    "expenses": (clean_expense, _create_expenses),
+    "receipts": (clean_receipt, _create_receipts),
+}
+
+
+def read_rows(lines, data_format):
+    """
+    Yield `(line number, row dict or RowError)` from an iterable of text lines.
+    CSV input starts with a header row naming the columns.
+    """
+    if data_format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            if None in row:
+                yield reader.line_num, RowError("Row has more values than the header has columns.")
+            else:
+                yield reader.line_num, row
+        return
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, RowError(f"Invalid JSON: {e}")
+            continue
+        yield line_number, row if isinstance(row, dict) else RowError("Each line must be a JSON object.")
+
+
+def decode_lines(byte_lines):
+    """Text lines from an iterable of byte lines, such as an upload or request body, dropping a UTF-8 BOM."""
+    return codecs.iterdecode(byte_lines, "utf-8-sig")
+
+
+def import_rows(user, kind, lines, data_format="csv", chunk_size=DEFAULT_CHUNK_SIZE, on_error=None, on_chunk=None):
+    """
+    Import expenses or receipts (`kind`) for `user` from text lines, committing
+    every chunk of valid rows separately. `on_error(line, message, row)` is called
+    for every rejected row and `on_chunk(result)` after every chunk.
+    """
+    if kind not in IMPORTERS:
+        raise ValueError(f"Unknown import kind {kind!r}; expected one of: {', '.join(IMPORTERS)}.")
+    if data_format not in FORMATS:
+        raise ValueError(f"Unknown import format {data_format!r}; expected one of: {', '.join(FORMATS)}.")
+    clean, create = IMPORTERS[kind]
+    result = ImportResult()
+    started = time.perf_counter()
+
+    def reject(line, message, row):
+        result.failed += 1
+        if len(result.errors) < MAX_REPORTED_ERRORS:
+            result.errors.append((line, message))
+        if on_error:
+            on_error(line, message, row)
+
+    def flush(chunk):
+        try:
+            with transaction.atomic():
+                create(user, [fields for _, fields, _ in chunk])
+        except DatabaseError as e:
+            for line, _, row in chunk:
+                reject(line, f"Not imported, the database rejected its chunk: {e}", row)
+        else:
+            result.imported += len(chunk)
+        result.seconds = time.perf_counter() - started
+        if on_chunk:
+            on_chunk(result)
+
+    chunk = []
+    try:
+        for line, row in read_rows(lines, data_format):
+            if isinstance(row, RowError):
+                reject(line, str(row), None)
+                continue
+            try:
+                chunk.append((line, clean(row), row))
+            except RowError as e:
+                reject(line, str(e), row)
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        # Rows already read are still imported; nothing after the bad input is
+        result.error = f"Reading stopped after {result.imported + result.failed + len(chunk)} rows: {e}"
+    if chunk:
+        flush(chunk)
+    result.seconds = time.perf_counter() - started
+    return result
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.signals import request_started, setting_changed
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+from .models import ReceiptJob
+from .processing import process_receipt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECEIPT_JOBS = {
+    "BACKEND": "api.jobs.DatabaseJobBackend",
+    "WORKERS": 4,
+    "MAX_ATTEMPTS": 3,
+    "RETRY_DELAY": 5,  # Seconds before the first retry, doubled for every further attempt
+    "LEASE": 600,  # Seconds an attempt may run before its worker is presumed dead and the job is re-queued
+    "POLL_INTERVAL": 5,  # Seconds between ThreadPoolJobBackend's checks for retries and abandoned jobs
+}
+
+
+def get_job_settings():
+    """Return the RECEIPT_JOBS settings merged over the defaults."""
+    return {**DEFAULT_RECEIPT_JOBS, **getattr(settings, "RECEIPT_JOBS", {})}
+
+
+def runnable_jobs():
+    """Pending jobs whose retry delay has elapsed, and running ones whose lease has expired."""
+    current = now()
+    lease = timedelta(seconds=get_job_settings()["LEASE"])
+    return ReceiptJob.objects.filter(
+        Q(status=ReceiptJob.Status.PENDING, available_at__lte=current)
+        | Q(status=ReceiptJob.Status.RUNNING, claimed_at__lt=current - lease)
+    )
+
+
+def run_job(job_id):
+    """
+    Run a single attempt of a pending job.
+
+    Returns the number of seconds to wait before the job may be retried,
+    or None when the job has finished (or was not runnable, e.g. claimed
+    by another worker).
+    """
+    config = get_job_settings()
+    # Claim the job atomically so that concurrent workers never run it twice. The attempt is
+    # counted up front, so a job whose worker keeps dying still runs out of attempts.
+    claimed = runnable_jobs().filter(pk=job_id).update(
+        status=ReceiptJob.Status.RUNNING, claimed_at=now(), attempts=F("attempts") + 1, updated_at=now()
+    )
+    if not claimed:
+        return None
+
+    job = ReceiptJob.objects.select_related("user").get(pk=job_id)
+    if job.attempts > config["MAX_ATTEMPTS"]:
+        logger.error("Receipt job %s abandoned by its worker on the last attempt", job.pk)
+        job.status = ReceiptJob.Status.FAILED
+        job.error = "The worker processing the receipt stopped."
+        job.save(update_fields=["status", "error", "updated_at"])
+        return None
+    try:
+        if job.image_file:
+            with job.image_file.open("rb") as image_file:
+                receipt = process_receipt(job.user, image_file=image_file)
+        else:
+            receipt = process_receipt(job.user, image_url=job.image_url)
+    except Exception as e:
+        logger.exception("Receipt job %s failed on attempt %s", job.pk, job.attempts)
+        job.error = str(e)
+        if job.attempts >= config["MAX_ATTEMPTS"]:
+            job.status = ReceiptJob.Status.FAILED
+            job.save(update_fields=["status", "error", "updated_at"])
+            return None
+        delay = config["RETRY_DELAY"] * 2 ** (job.attempts - 1)
+        job.status = ReceiptJob.Status.PENDING
+        job.available_at = now() + timedelta(seconds=delay)
+        job.save(update_fields=["status", "error", "available_at", "updated_at"])
+        return delay
+
+    if job.image_file:
+        job.image_file.delete(save=False)  # The image now lives in Blob Storage
+    job.receipt = receipt
+    job.status = ReceiptJob.Status.SUCCEEDED
+    job.error = ""
+    job.save(update_fields=["receipt", "status", "error", "image_file", "updated_at"])
+    return None
+
+
+def run_job_until_done(job_id):
+    """Run a job, sleeping between attempts until it succeeds or runs out of retries. Only for InlineJobBackend."""
+    delay = run_job(job_id)
+    while delay is not None:
+        time.sleep(delay)
+        delay = run_job(job_id)
+
+
+class BaseJobBackend:
+    """Dispatches queued receipt jobs to workers."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def enqueue(self, job_id):
+        raise NotImplementedError
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class InlineJobBackend(BaseJobBackend):
+    """Runs jobs synchronously in the calling thread. Intended for tests and local development."""
+
+    def enqueue(self, job_id):
+        run_job_until_done(job_id)
+
+
+class ThreadPoolJobBackend(BaseJobBackend):
+    """
+    Runs jobs on a bounded pool of threads inside the web process.
+
+    Workers run one attempt at a time. A poller thread hands the pool every job
+    that becomes runnable later: retries once their delay has elapsed, jobs
+    left pending or running by a previous process once their lease expires.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.executor = ThreadPoolExecutor(max_workers=config["WORKERS"], thread_name_prefix="receipt-job")
+        self.queued = set()  # Submitted and not yet finished, so the poller does not submit them twice
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.poller = threading.Thread(target=self._poll, name="receipt-job-poller", daemon=True)
+        self.poller.start()
+
+    def enqueue(self, job_id):
+        with self.lock:
+            if job_id in self.queued or self.stopped.is_set():
+                return
+            self.queued.add(job_id)
+        self.executor.submit(self._work, job_id)
+
+    def _work(self, job_id):
+        try:
+            run_job(job_id)
+        except Exception:
+            logger.exception("Receipt job %s crashed", job_id)
+        finally:
+            with self.lock:
+                self.queued.discard(job_id)
+            close_old_connections()
+
+    def _poll(self):
+        while True:
+            try:
+                for job_id in ready_job_ids(self.config["WORKERS"]):
+                    self.enqueue(job_id)
+            except Exception:
+                logger.exception("Polling for receipt jobs failed")
+            finally:
+                close_old_connections()
+            if self.stopped.wait(self.config["POLL_INTERVAL"]):
+                return
+
+    def shutdown(self, wait=True):
+        self.stopped.set()
+        self.executor.shutdown(wait=wait)
+
+
+class DatabaseJobBackend(BaseJobBackend):
+    """
+    Leaves jobs in the database for the `process_receipt_jobs` management
+    command, so OCR work runs in separate worker processes.
+    """
+
+    def enqueue(self, job_id):
+        pass
+
+
+def ready_job_ids(limit):
+    """Return the ids of up to `limit` runnable jobs, oldest first."""
+    return list(runnable_jobs().order_by("available_at").values_list("pk", flat=True)[:limit])
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_job_backend():
+    """Return the process-wide job backend configured in RECEIPT_JOBS."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            config = get_job_settings()
+            _backend = import_string(config["BACKEND"])(config)
+        return _backend
+
+
+@receiver(request_started)
+def start_job_backend(**kwargs):
+    """Start the backend with the first request, so a restarted web process resumes its queued jobs."""
+    if _backend is None:
+        get_job_backend()
+
+
+@receiver(setting_changed)
+def reset_job_backend(*, setting, **kwargs):
+    global _backend
+    if setting == "RECEIPT_JOBS":
+        with _backend_lock:
+            if _backend is not None:
+                _backend.shutdown(wait=False)
+            _backend = None
@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from api.analytics import rebuild_spending_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the SpendingRollup rows behind /api/analytics/spending/ from every receipt and expense. "
+        "Run it after migrating, or after writes that bypassed the model (queryset.update(), raw SQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="users", help="Only rebuild this user id (repeatable).")
+        parser.add_argument("--batch-size", type=int, default=500, help="Users rebuilt per transaction.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        users = 0
+
+        def report(batch_users, batch_rows):
+            nonlocal users
+            users += batch_users
+            self.stdout.write(f"{users} users rebuilt, {batch_rows} rollup rows in the last batch")
+
+        rows = rebuild_spending_rollups(options["users"], batch_size=options["batch_size"], on_batch=report)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {rows:,} rollup rows for {users:,} users in {time.perf_counter() - started:.1f}s."))
@@ -0,0 +1,66 @@
+import json
+import platform
+from contextlib import nullcontext
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.timezone import now
+from api.benchmarks import BENCHMARKS, DATASETS, DEFAULT_TOLERANCE, build_dataset, compare_results, throwaway_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the registered API benchmarks and print the results as JSON. Dataset benchmarks run against "
+        "a seeded throwaway test database. With --baseline, fail when a metric regressed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help=f"Benchmarks to run (default: all). Available: {', '.join(BENCHMARKS)}.")
+        parser.add_argument("--repeat", type=int, default=20, help="Number of timed runs per benchmark.")
+        parser.add_argument("--dataset", choices=list(DATASETS), default="smoke", help="Dataset shape for the dataset benchmarks.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed for the generated dataset.")
+        parser.add_argument("--in-place", action="store_true", help="Seed into the configured database instead of a throwaway test database.")
+        parser.add_argument("--output", help="Also write the results to this JSON file.")
+        parser.add_argument("--baseline", help="Results file from an earlier run to compare against.")
+        parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative slowdown tolerated against the baseline.")
+
+    def handle(self, *args, **options):
+        names = options["names"] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmark(s): {', '.join(sorted(unknown))}")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        needs_dataset = any(BENCHMARKS[name].needs_dataset for name in names)
+        meta = {
+            "started_at": now().isoformat(),
+            "repeat": options["repeat"],
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+        }
+        with nullcontext() if options["in_place"] or not needs_dataset else throwaway_database():
+            dataset = None
+            if needs_dataset:
+                dataset = build_dataset(options["dataset"], seed=options["seed"])
+                meta["dataset"] = {"name": dataset.name, **dataset.config, "seed": options["seed"], "seed_seconds": dataset.seed_seconds}
+            results = {}
+            for name in names:
+                function = BENCHMARKS[name]
+                results[name] = function(dataset, options["repeat"]) if function.needs_dataset else function(options["repeat"])
+
+        report = json.dumps({"meta": meta, "results": results}, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(report + "\n")
+        self.stdout.write(report)
+
+        if baseline is not None:
+            if baseline.get("meta", {}).get("dataset", {}).get("name") != meta.get("dataset", {}).get("name"):
+                self.stderr.write("Warning: the baseline was recorded against a different dataset.")
+            regressions = compare_results(baseline["results"], results, options["tolerance"])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
@@ -0,0 +1,55 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from api.importing import DEFAULT_CHUNK_SIZE, FORMATS, IMPORTERS, ErrorFile, decode_lines, import_rows
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Import a user's expenses or receipts from a CSV file (with a header row) or a JSON lines file, "
+        "committing a chunk of rows at a time. Invalid rows are skipped and can be written to an error file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=list(IMPORTERS))
+        parser.add_argument("path", help="The file to import, or - for standard input.")
+        parser.add_argument("--user", required=True, help="Email of the user the rows belong to.")
+        parser.add_argument("--format", choices=FORMATS, help="Input format; by default taken from the file extension.")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows committed per transaction.")
+        parser.add_argument("--errors", help="Write rejected rows to this CSV file (line, error, row).")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(email=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user with email {options['user']!r}.")
+        path = options["path"]
+        data_format = options["format"] or ("ndjson" if path.lower().endswith((".ndjson", ".jsonl", ".json")) else "csv")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        def report(result):
+            self.stdout.write(f"{result.imported:,} imported, {result.failed:,} failed, {result.rows_per_second:,.0f} rows/s")
+
+        source = sys.stdin.buffer if path == "-" else open(path, "rb")
+        error_file = open(options["errors"], "w", newline="", encoding="utf-8") if options["errors"] else None
+        try:
+            result = import_rows(
+                user, options["kind"], decode_lines(source), data_format, chunk_size=options["chunk_size"],
+                on_error=ErrorFile(error_file) if error_file else None, on_chunk=report,
+            )
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+            if error_file:
+                error_file.close()
+
+        if result.error:
+            self.stderr.write(result.error)
+        if not error_file:
+            for line, message in result.errors[:10]:
+                self.stderr.write(f"line {line}: {message}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.imported:,} {options['kind']} ({result.failed:,} failed) "
+            f"in {result.seconds:.1f}s, {result.rows_per_second:,.0f} rows/s."
+        ))
@@ -0,0 +1,38 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.clients import close_clients
+from api.jobs import ready_job_ids, get_job_settings, run_job
+
+
+class Command(BaseCommand):
+    help = "Run a pool of workers that process queued receipt jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="Number of concurrent workers (defaults to RECEIPT_JOBS['WORKERS']).")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Drain the ready jobs once and exit.")
+
+    def handle(self, *args, **options):
+        workers = options["workers"] or get_job_settings()["WORKERS"]
+        self.stdout.write(f"Processing receipt jobs with {workers} workers")
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="receipt-job") as executor:
+                while True:
+                    job_ids = ready_job_ids(workers)
+                    if job_ids:
+                        wait([executor.submit(self._work, job_id) for job_id in job_ids])
+                    elif options["once"]:
+                        break
+                    else:
+                        time.sleep(options["poll_interval"])
+        finally:
+            close_clients()
+
+    def _work(self, job_id):
+        try:
+            run_job(job_id)
+        finally:
+            close_old_connections()
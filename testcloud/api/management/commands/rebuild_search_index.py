@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from api.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the SearchDocument rows behind /api/search/ from every receipt and expense. "
+        "Run it after migrating, or after writes that bypassed the model (queryset.update(), raw SQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Receipts or expenses indexed per transaction.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = rebuild_search_index(batch_size=options["batch_size"])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Indexed {rows:,} receipts and expenses in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f}/s)."))
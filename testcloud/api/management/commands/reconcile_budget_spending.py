@@ -0,0 +1,46 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from api.models import Budget, Receipt, as_money
+
+
+class Command(BaseCommand):
+    help = "Recompute every budget's current_spending from its linked receipts and report any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Write the recomputed totals back to the drifted budgets.")
+
+    def handle(self, *args, **options):
+        # One grouped query: linked totals per budget and receipt category
+        totals = defaultdict(dict)
+        linked = (
+            Receipt.budget.through.objects.exclude(receipt__total_amount=None)
+            .values_list("budget_id", "receipt__receipt_category")
+            .annotate(total=Sum("receipt__total_amount"))
+            .order_by()
+        )
+        for budget_id, category, total in linked:
+            totals[budget_id][category] = as_money(total)
+
+        drifted = []
+        for budget in Budget.objects.only("id", "filter_categories", "current_spending").iterator():
+            expected = sum(
+                (total for category, total in totals[budget.pk].items() if Budget.category_counts(budget.filter_categories, category)),
+                as_money(0),
+            )
+            if expected != budget.current_spending:
+                self.stdout.write(f"Budget {budget.pk}: stored {budget.current_spending}, expected {expected} (drift {budget.current_spending - expected})")
+                budget.current_spending = expected
+                drifted.append(budget)
+
+        if drifted and options["fix"]:
+            with transaction.atomic():
+                Budget.objects.bulk_update(drifted, ["current_spending"], batch_size=500)
+                # bulk_update skips save(), so bump the versions that key cached reports and their ETags
+                Budget.touch([budget.pk for budget in drifted])
+            self.stdout.write(self.style.SUCCESS(f"Fixed {len(drifted)} budget(s)."))
+        elif drifted:
+            self.stdout.write(self.style.WARNING(f"{len(drifted)} budget(s) drifted. Re-run with --fix to correct them."))
+        else:
+            self.stdout.write(self.style.SUCCESS("No drift found."))
@@ -0,0 +1,67 @@
+import time
+from collections import Counter
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from api.models import User
+from api.seeding import SEED_PASSWORD, parse_distribution, seed_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic users, budgets, receipts, expenses and budget links in bulk. "
+        "The same --seed always generates the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100, help="Number of users to create.")
+        parser.add_argument(
+            "--receipts", default="lognormal:200,1.0,20000",
+            help="Receipts per user: N, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA[,MAX] or pareto:MIN,ALPHA[,MAX].",
+        )
+        parser.add_argument("--budgets", default="uniform:1,12", help="Monthly budgets per user, in the same format as --receipts.")
+        parser.add_argument("--start", type=date.fromisoformat, default=date(2024, 1, 1), help="First budget month and earliest receipt date.")
+        parser.add_argument("--days", type=int, help="Days of receipt history per user (default: the span of the user's budgets).")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed; also part of every seeded email address.")
+        parser.add_argument("--email-prefix", default="seed", help="Seeded users are <prefix>-<seed>-<n>@example.com.")
+        parser.add_argument("--workers", type=int, default=1, help="Processes seeding users in parallel.")
+        parser.add_argument("--batch-size", type=int, default=2000, help="Rows per INSERT and per committed batch.")
+
+    def handle(self, *args, **options):
+        for name in ("receipts", "budgets"):
+            try:
+                parse_distribution(options[name])
+            except ValueError as e:
+                raise CommandError(str(e))
+        if User.objects.filter(email__startswith=f"{options['email_prefix']}-{options['seed']}-").exists():
+            raise CommandError("Users with this --email-prefix and --seed already exist; pick another of either.")
+
+        totals = Counter()
+        started = time.perf_counter()
+
+        def report(counts):
+            totals.update(counts)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{totals['users']}/{options['users']} users, {totals['receipts']} receipts, "
+                f"{sum(totals.values()) / elapsed:,.0f} rows/s"
+            )
+
+        seed_dataset(
+            options["users"],
+            options["receipts"],
+            budgets_per_user=options["budgets"],
+            seed=options["seed"],
+            email_prefix=options["email_prefix"],
+            start=options["start"],
+            days=options["days"],
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            on_chunk=report,
+        )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {sum(totals.values()):,} rows in {elapsed:.1f}s ({sum(totals.values()) / elapsed:,.0f} rows/s): "
+            + ", ".join(f"{count:,} {name}" for name, count in sorted(totals.items()))
+            + f". Every user's password is {SEED_PASSWORD!r}."
+        ))
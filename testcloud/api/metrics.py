@@ -0,0 +1,234 @@
+"""
+Per-request performance metrics.
+
+RequestMetricsMiddleware (middleware.py) opens a RequestTimings for every
+request. Code on the request's path records spans into it with timed() - the
+external calls, serialization and rendering - and the middleware counts the
+request's database queries. The totals go out in a Server-Timing header and
+are aggregated per view into the histograms below, which MetricsView serves
+in the Prometheus text format.
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import connections
+from .clients import get_connection_stats
+
+DEFAULT_REQUEST_METRICS = {
+    "ENABLED": True,
+    "SERVER_TIMING": True,  # Add a Server-Timing header to every response
+    "BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),  # Seconds
+    "QUERY_BUCKETS": (0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+    "TOKEN": None,  # When set, /metrics requires "Authorization: Bearer <TOKEN>"
+}
+
+
+def get_metrics_settings():
+    """Return the REQUEST_METRICS settings merged over the defaults."""
+    return {**DEFAULT_REQUEST_METRICS, **getattr(settings, "REQUEST_METRICS", {})}
+
+
+class RequestTimings:
+    """The spans and database queries recorded while serving one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}  # name -> seconds
+        self.queries = 0
+        self.query_seconds = 0.0
+        self._lock = threading.Lock()  # Batch requests record from worker threads too
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+_current_timings = contextvars.ContextVar("request_timings", default=None)
+_open_spans = contextvars.ContextVar("request_open_spans", default=frozenset())
+
+
+def current_timings():
+    """Return the RequestTimings of the request being served, or None outside one."""
+    return _current_timings.get()
+
+
+@contextmanager
+def collect_timings(timings):
+    """Record timed() spans into `timings` for the duration of the block."""
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time spent in the block to the current request's `name` span.
+
+    A no-op outside a request, e.g. in the job worker. Nested spans of the
+    same name count once, so a serializer nested in another is not counted
+    twice.
+    """
+    timings = _current_timings.get()
+    open_spans = _open_spans.get()
+    if timings is None or name in open_spans:
+        yield
+        return
+    token = _open_spans.set(open_spans | {name})
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+        _open_spans.reset(token)
+
+
+@contextmanager
+def count_queries(timings):
+    """
+    Count the queries this thread runs on any database into `timings` for the
+    duration of the block. Connections are per thread, so request code that
+    queries from worker threads enters this in each of them too. A no-op when
+    `timings` is None.
+    """
+    if timings is None:
+        yield
+        return
+
+    def record(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings.add_query(time.perf_counter() - started)
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(record))
+        yield
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """A Prometheus histogram with fixed buckets, aggregated in this process."""
+
+    def __init__(self, name, documentation, labelnames, buckets_setting="BUCKETS"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets_setting = buckets_setting
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._buckets = None
+        self._lock = threading.Lock()
+
+    @property
+    def buckets(self):
+        if self._buckets is None:
+            self._buckets = tuple(sorted(get_metrics_settings()[self.buckets_setting])) + (math.inf,)
+        return self._buckets
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        buckets = self.buckets
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+            self._buckets = None
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+            for key, (counts, total, count) in series:
+                labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{_format_number(bound)}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{labels}}} {_format_number(total)}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds", "Time to produce a response, per view.", ["view", "method", "status"])
+REQUEST_DB_QUERIES = Histogram(
+    "api_request_db_queries", "Database queries per request, per view.", ["view"], buckets_setting="QUERY_BUCKETS")
+REQUEST_DB_DURATION = Histogram(
+    "api_request_db_duration_seconds", "Time spent in database queries per request, per view.", ["view"])
+REQUEST_SPAN_DURATION = Histogram(
+    "api_request_span_duration_seconds",
+    "Time spent per request in external calls (download, blob_upload, analysis), preprocessing, serialization and rendering.",
+    ["view", "span"])
+
+HISTOGRAMS = (REQUEST_DURATION, REQUEST_DB_QUERIES, REQUEST_DB_DURATION, REQUEST_SPAN_DURATION)
+
+
+def observe_request(view, method, status, timings, duration):
+    """Aggregate one finished request into the histograms."""
+    REQUEST_DURATION.observe(duration, view=view, method=method, status=status)
+    REQUEST_DB_QUERIES.observe(timings.queries, view=view)
+    REQUEST_DB_DURATION.observe(timings.query_seconds, view=view)
+    for span, seconds in timings.spans.items():
+        REQUEST_SPAN_DURATION.observe(seconds, view=view, span=span)
+
+
+def server_timing(timings, duration):
+    """Format a Server-Timing header value for a request."""
+    entries = [f'db;dur={timings.query_seconds * 1000:.1f};desc="{timings.queries} queries"']
+    entries.extend(f"{span};dur={seconds * 1000:.1f}" for span, seconds in sorted(timings.spans.items()))
+    entries.append(f"total;dur={duration * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render_metrics():
+    """Render the histograms and process counters in the Prometheus text exposition format."""
+    from .processing import get_image_cache_stats  # Imported here, processing records its spans with timed()
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    connection_stats = get_connection_stats()
+    cache_stats = get_image_cache_stats()
+    counters = [
+        ("api_http_requests_total", "Requests sent through the pooled HTTP clients.", connection_stats["requests"]),
+        ("api_http_connections_opened_total", "Connections opened by the pooled HTTP clients.", connection_stats["connections_opened"]),
+        ("api_receipt_image_cache_hits_total", "Receipt images served from ReceiptImageCache.", cache_stats["hits"]),
+        ("api_receipt_image_cache_misses_total", "Receipt images that had to be analysed.", cache_stats["misses"]),
+    ]
+    for name, documentation, value in counters:
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} counter", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
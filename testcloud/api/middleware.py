@@ -0,0 +1,59 @@
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse
+from .metrics import RequestTimings, collect_timings, count_queries, get_metrics_settings, observe_request, server_timing, timed
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and counts its database queries, then adds a
+    Server-Timing header and feeds the per-view histograms in metrics.py.
+
+    Streamed responses (the CSV export) keep being measured while their body
+    is sent, so queries made during streaming count towards the request.
+    Queries from the batch upload's worker threads are counted as well (see
+    processing._map_concurrently).
+    Their Server-Timing header can only cover the time until the headers.
+    Place it first in MIDDLEWARE so the other middleware is included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = get_metrics_settings()
+        if not self.config["ENABLED"]:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        with collect_timings(timings), count_queries(timings):
+            response = self.get_response(request)
+
+        duration = timings.elapsed()
+        if self.config["SERVER_TIMING"]:
+            response["Server-Timing"] = server_timing(timings, duration)
+
+        view = self._view_name(request)
+        if response.streaming and not response.is_async and not isinstance(response, FileResponse):
+            response.streaming_content = self._measure_stream(response.streaming_content, request, response, view, timings)
+        else:
+            observe_request(view, request.method, response.status_code, timings, duration)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns; render here to time the encoding
+        with timed("render"):
+            response.render()
+        return response
+
+    def _measure_stream(self, content, request, response, view, timings):
+        try:
+            with collect_timings(timings), count_queries(timings):
+                yield from content
+        finally:
+            observe_request(view, request.method, response.status_code, timings, timings.elapsed())
+
+    @staticmethod
+    def _view_name(request):
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            return "unmatched"
+        return match.view_name or match.route
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_receiptjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptImageCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('blob_url', models.URLField(max_length=500)),
+                ('analyze_result', models.JSONField(blank=True, null=True)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Receipt Image Cache Entry',
+                'verbose_name_plural': 'Receipt Image Cache',
+            },
+        ),
+    ]
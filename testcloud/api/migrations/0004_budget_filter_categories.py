@@ -0,0 +1,46 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_filter_categories(apps, schema_editor):
+    Budget = apps.get_model("api", "Budget")
+    BudgetFilterCategory = apps.get_model("api", "BudgetFilterCategory")
+    rows = [
+        BudgetFilterCategory(budget_id=budget_id, category=category)
+        for budget_id, categories in Budget.objects.exclude(filter_categories="").values_list("pk", "filter_categories").iterator()
+        for category in set(categories or [])
+    ]
+    BudgetFilterCategory.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_receiptimagecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BudgetFilterCategory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('Meal', 'Meal'), ('Supplies', 'Supplies'), ('Hotel', 'Hotel'), ('Fuel & Energy', 'Fuel & Energy'), ('Transportation', 'Transportation'), ('Communication & Subscriptions', 'Communication & Subscriptions'), ('Entertainment', 'Entertainment'), ('Training', 'Training'), ('Healthcare', 'Healthcare'), ('Other', 'Other')], max_length=50)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['user', 'start_date', 'end_date'], name='budget_user_period_idx'),
+        ),
+        migrations.AddField(
+            model_name='budgetfiltercategory',
+            name='budget',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='category_filters', to='api.budget'),
+        ),
+        migrations.AddConstraint(
+            model_name='budgetfiltercategory',
+            constraint=models.UniqueConstraint(fields=('budget', 'category'), name='unique_budget_filter_category'),
+        ),
+        migrations.RunPython(populate_filter_categories, migrations.RunPython.noop),
+    ]
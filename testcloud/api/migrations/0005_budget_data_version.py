@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:22
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_budget_filter_categories'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='budget',
+            name='data_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='budget',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:02
+
+from urllib.parse import unquote, urlsplit
+from django.conf import settings
+from django.db import migrations, models
+
+
+def blob_key(url):
+    """Return the blob name from a SAS URL into our container, or "" for any other URL."""
+    if not url:
+        return ""
+    parts = urlsplit(url)
+    prefix = f"/{settings.AZURE_STORAGE['CONTAINER']}/"
+    if parts.hostname != f"{settings.AZURE_STORAGE['ACCOUNT_NAME']}.blob.core.windows.net" or not parts.path.startswith(prefix):
+        return ""
+    return unquote(parts.path[len(prefix):])
+
+
+def populate_image_keys(apps, schema_editor):
+    Receipt = apps.get_model("api", "Receipt")
+    ReceiptImageCache = apps.get_model("api", "ReceiptImageCache")
+    receipts = []
+    for receipt in Receipt.objects.exclude(image_url=None).only("pk", "image_url").iterator():
+        receipt.image_key = blob_key(receipt.image_url)
+        if receipt.image_key:
+            receipts.append(receipt)
+    Receipt.objects.bulk_update(receipts, ["image_key"], batch_size=1000)
+
+    entries = list(ReceiptImageCache.objects.only("pk", "blob_url"))
+    for entry in entries:
+        entry.image_key = blob_key(entry.blob_url)
+    ReceiptImageCache.objects.bulk_update(entries, ["image_key"], batch_size=1000)
+    # Entries whose image cannot be located again are useless
+    ReceiptImageCache.objects.filter(image_key="").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='image_key',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='receiptimagecache',
+            name='image_key',
+            field=models.CharField(default='', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_image_keys, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='receiptimagecache',
+            name='blob_url',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_receipt_image_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('Meal', 'Meal'), ('Supplies', 'Supplies'), ('Hotel', 'Hotel'), ('Fuel & Energy', 'Fuel & Energy'), ('Transportation', 'Transportation'), ('Communication & Subscriptions', 'Communication & Subscriptions'), ('Entertainment', 'Entertainment'), ('Training', 'Training'), ('Healthcare', 'Healthcare'), ('Other', 'Other')], max_length=50)),
+                ('day', models.DateField()),
+                ('receipt_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('receipt_count', models.IntegerField(default=0)),
+                ('expense_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('expense_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spending_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Spending Rollup',
+                'verbose_name_plural': 'Spending Rollups',
+                'constraints': [models.UniqueConstraint(fields=('user', 'day', 'category'), name='unique_spending_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,138 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import DatabaseError, migrations, models, transaction
+from django.utils.timezone import is_aware, localdate
+
+BATCH_SIZE = 1000
+
+# The index behind SearchDocument.text depends on the database; see api/search.py
+SEARCH_INDEX_SQL = {
+    "postgresql": (
+        [
+            "ALTER TABLE api_searchdocument ADD COLUMN search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED",
+            "CREATE INDEX api_searchdocument_vector_idx ON api_searchdocument USING GIN (search_vector)",
+        ],
+        [
+            "DROP INDEX IF EXISTS api_searchdocument_trgm_idx",
+            "DROP INDEX IF EXISTS api_searchdocument_vector_idx",
+            "ALTER TABLE api_searchdocument DROP COLUMN IF EXISTS search_vector",
+        ],
+    ),
+    "sqlite": (
+        [
+            "CREATE VIRTUAL TABLE api_searchdocument_fts USING fts5("
+            "text, content='api_searchdocument', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+            "CREATE TRIGGER api_searchdocument_fts_insert AFTER INSERT ON api_searchdocument BEGIN "
+            "INSERT INTO api_searchdocument_fts(rowid, text) VALUES (new.id, new.text); END",
+            "CREATE TRIGGER api_searchdocument_fts_delete AFTER DELETE ON api_searchdocument BEGIN "
+            "INSERT INTO api_searchdocument_fts(api_searchdocument_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+            "CREATE TRIGGER api_searchdocument_fts_update AFTER UPDATE OF text ON api_searchdocument BEGIN "
+            "INSERT INTO api_searchdocument_fts(api_searchdocument_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+            "INSERT INTO api_searchdocument_fts(rowid, text) VALUES (new.id, new.text); END",
+        ],
+        [
+            "DROP TRIGGER IF EXISTS api_searchdocument_fts_update",
+            "DROP TRIGGER IF EXISTS api_searchdocument_fts_delete",
+            "DROP TRIGGER IF EXISTS api_searchdocument_fts_insert",
+            "DROP TABLE IF EXISTS api_searchdocument_fts",
+        ],
+    ),
+}
+
+
+# Creating pg_trgm needs a superuser or, on Azure Database for PostgreSQL, pg_trgm listed in the
+# azure.extensions server parameter. Without it the migration still succeeds and search uses the tsvector alone.
+TRIGRAM_INDEX_SQL = "CREATE INDEX api_searchdocument_trgm_idx ON api_searchdocument USING GIN (text gin_trgm_ops)"
+
+
+def create_trigram_extension(schema_editor):
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError:
+        return False
+    return True
+
+
+def create_search_index(apps, schema_editor):
+    for statement in SEARCH_INDEX_SQL.get(schema_editor.connection.vendor, ([], []))[0]:
+        schema_editor.execute(statement)
+    if schema_editor.connection.vendor == "postgresql" and create_trigram_extension(schema_editor):
+        schema_editor.execute(TRIGRAM_INDEX_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    for statement in SEARCH_INDEX_SQL.get(schema_editor.connection.vendor, ([], []))[1]:
+        schema_editor.execute(statement)
+
+
+def receipt_text(receipt):
+    """The same text as search.receipt_text, which a migration should not import."""
+    parts = [receipt.merchant or ""]
+    if isinstance(receipt.parsed_items, list):
+        for item in receipt.parsed_items:
+            description = (item.get("description") or {}).get("value") if isinstance(item, dict) else None
+            if description:
+                parts.append(str(description))
+    return " ".join(part for part in parts if part)
+
+
+def day_of(moment):
+    return localdate(moment) if is_aware(moment) else moment.date()
+
+
+def index_existing_documents(apps, schema_editor):
+    """Index the receipts and expenses that predate the search index; the FTS triggers or generated column do the rest."""
+    Receipt = apps.get_model("api", "Receipt")
+    Expense = apps.get_model("api", "Expense")
+    SearchDocument = apps.get_model("api", "SearchDocument")
+
+    documents = []
+    receipts = Receipt.objects.only("pk", "user_id", "merchant", "parsed_items", "transaction_date", "uploaded_at").order_by("pk")
+    for receipt in receipts.iterator(chunk_size=BATCH_SIZE):
+        documents.append(SearchDocument(
+            user_id=receipt.user_id, receipt_id=receipt.pk, text=receipt_text(receipt),
+            day=day_of(receipt.transaction_date or receipt.uploaded_at),
+        ))
+        if len(documents) >= BATCH_SIZE:
+            SearchDocument.objects.bulk_create(documents)
+            documents = []
+    expenses = Expense.objects.only("pk", "user_id", "vendor", "date", "created_at").order_by("pk")
+    for expense in expenses.iterator(chunk_size=BATCH_SIZE):
+        documents.append(SearchDocument(
+            user_id=expense.user_id, expense_id=expense.pk, text=expense.vendor or "",
+            day=expense.date or day_of(expense.created_at),
+        ))
+        if len(documents) >= BATCH_SIZE:
+            SearchDocument.objects.bulk_create(documents)
+            documents = []
+    SearchDocument.objects.bulk_create(documents)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_spendingrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+                ('day', models.DateField(blank=True, null=True)),
+                ('expense', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='api.expense')),
+                ('receipt', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='api.receipt')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_documents', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('expense__isnull', True), ('receipt__isnull', False)), models.Q(('expense__isnull', False), ('receipt__isnull', True)), _connector='OR'), name='search_document_one_source')],
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(index_existing_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,117 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:14
+
+import django.db.models.deletion
+from collections import defaultdict, deque
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.db import migrations, models
+from django.utils.timezone import is_aware, localdate
+
+BATCH_SIZE = 1000
+
+
+def parse_number(value, places, limit):
+    """The same conversion as ReceiptItem.from_parsed, which historical models cannot call."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = Decimal(str(value).strip().replace(",", ""))
+    except InvalidOperation:
+        return None
+    return number.quantize(places) if number.is_finite() and abs(number) < limit else None
+
+
+def expense_day(moment):
+    """The date an Expense created from a receipt stores for its transaction_date."""
+    if isinstance(moment, datetime):
+        return localdate(moment) if is_aware(moment) else moment.date()
+    return moment
+
+
+def link_expenses(Expense, pending, linked):
+    """
+    Link priced items to the Expense create_receipts_from_results made for
+    them, matched on user, date, vendor and amount. Each expense is used once,
+    in creation order, and items without a match stay unlinked.
+    """
+    users = {key[0] for _, key in pending}
+    vendors = {key[2] for _, key in pending}
+    candidates = defaultdict(deque)
+    expenses = Expense.objects.filter(user_id__in=users, vendor__in=vendors).order_by("pk")
+    for pk, user_id, day, vendor, amount in expenses.values_list("pk", "user_id", "date", "vendor", "amount"):
+        if pk not in linked:
+            candidates[user_id, day, vendor, amount].append(pk)
+    for item, key in pending:
+        if candidates[key]:
+            item.expense_id = candidates[key].popleft()
+            linked.add(item.expense_id)
+
+
+def populate_receipt_items(apps, schema_editor):
+    Receipt = apps.get_model("api", "Receipt")
+    Expense = apps.get_model("api", "Expense")
+    ReceiptItem = apps.get_model("api", "ReceiptItem")
+
+    def value(details, name):
+        field = details.get(name)
+        return field.get("value") if isinstance(field, dict) else None
+
+    def flush():
+        link_expenses(Expense, pending, linked)
+        ReceiptItem.objects.bulk_create(items)
+        items.clear()
+        pending.clear()
+
+    items, pending, linked = [], [], set()
+    receipts = Receipt.objects.exclude(parsed_items=None).only(
+        "pk", "user_id", "merchant", "transaction_date", "parsed_items"
+    ).order_by("pk")
+    for receipt in receipts.iterator(chunk_size=BATCH_SIZE):
+        if not isinstance(receipt.parsed_items, list):
+            continue
+        for position, details in enumerate(receipt.parsed_items):
+            if not isinstance(details, dict):
+                continue
+            item = ReceiptItem(
+                receipt_id=receipt.pk,
+                position=position,
+                description=str(value(details, "description") or "")[:255],
+                quantity=parse_number(value(details, "quantity"), Decimal("0.001"), 10 ** 9),
+                total_price=parse_number(value(details, "total_price"), Decimal("0.01"), 10 ** 8),
+            )
+            items.append(item)
+            if item.total_price is not None:
+                vendor = receipt.merchant or "Unknown Merchant"  # As ParsedReceipt.expense_fields names it
+                pending.append((item, (receipt.user_id, expense_day(receipt.transaction_date), vendor, item.total_price)))
+        if len(items) >= BATCH_SIZE:
+            flush()
+    flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_searchdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('description', models.CharField(blank=True, default='', max_length=255)),
+                ('quantity', models.DecimalField(blank=True, decimal_places=3, max_digits=12, null=True)),
+                ('total_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('expense', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='receipt_item', to='api.expense')),
+                ('receipt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='api.receipt')),
+            ],
+            options={
+                'verbose_name': 'Receipt Item',
+                'verbose_name_plural': 'Receipt Items',
+                'ordering': ['receipt', 'position'],
+                'constraints': [models.UniqueConstraint(fields=('receipt', 'position'), name='unique_receipt_item_position')],
+            },
+        ),
+        migrations.RunPython(populate_receipt_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# KeysetPagination orders undated incomes and expenses last (`date DESC NULLS LAST`).
+# A plain DESC index entry is NULLS FIRST on PostgreSQL, where it cannot serve
+# that sort, so the indexes are rebuilt to match there. SQLite puts NULLs last in
+# DESC order already and does not accept NULLS LAST in an index.
+DATE_INDEX_SQL = {
+    "postgresql": (
+        [
+            "DROP INDEX IF EXISTS expense_user_date_id_idx",
+            "CREATE INDEX expense_user_date_id_idx ON api_expense (user_id, date DESC NULLS LAST, id DESC)",
+            "DROP INDEX IF EXISTS income_date_id_idx",
+            "CREATE INDEX income_date_id_idx ON api_income (date DESC NULLS LAST, id DESC)",
+        ],
+        [
+            "DROP INDEX IF EXISTS expense_user_date_id_idx",
+            "CREATE INDEX expense_user_date_id_idx ON api_expense (user_id, date DESC, id DESC)",
+            "DROP INDEX IF EXISTS income_date_id_idx",
+            "CREATE INDEX income_date_id_idx ON api_income (date DESC, id DESC)",
+        ],
+    ),
+}
+
+
+def create_nulls_last_indexes(apps, schema_editor):
+    for statement in DATE_INDEX_SQL.get(schema_editor.connection.vendor, ([], []))[0]:
+        schema_editor.execute(statement)
+
+
+def restore_indexes(apps, schema_editor):
+    for statement in DATE_INDEX_SQL.get(schema_editor.connection.vendor, ([], []))[1]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_receiptitem'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_nulls_last_indexes, restore_indexes),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_nulls_last_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptjob',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,18 +1,36 @@
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.utils.translation import gettext_lazy as _
-from django.db.models import Sum, FloatField, Q
+from django.db.models import Sum, FloatField, Q, F, Case, When, Value
 from django.db.models.functions import Cast
 from multiselectfield import MultiSelectField
-from django.utils.timezone import now
+from django.utils.dateparse import parse_date
+from django.utils.timezone import localdate, now
 from django.contrib.postgres.fields import ArrayField
 from django.db.models import JSONField
+from decimal import Decimal, InvalidOperation
 
 
 
 # Create your models here.
 
+def as_money(value):
+    """ Convert an amount (Decimal, float, str or None) to an exact two-place Decimal. """
+    if value is None or value == "":
+        return Decimal("0.00")
+    return Decimal(str(value)).quantize(Decimal("0.01"))
+
+def parse_decimal(value):
+    """ A Decimal from an OCR value such as "2", 3.5 or "1.25", or None when it is missing or not a number. """
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = Decimal(str(value).strip().replace(",", ""))
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
 class UserManager(BaseUserManager):
     """Define a model manager for User model with no username field."""
 
@@ -82,6 +100,8 @@ class Income(Transaction):
     class Meta:
         verbose_name = _("Income")
         verbose_name_plural = _("Incomes")
+        # DESC NULLS LAST on PostgreSQL, to match KeysetPagination's order; see migration 0011
+        indexes = [models.Index(fields=["-date", "-id"], name="income_date_id_idx")]
 
 class CategoryChoices(models.TextChoices):
     MEAL = "Meal", _("Meal")
@@ -100,9 +120,28 @@ class Expense(Transaction):
     category = models.CharField(max_length=50,choices=CategoryChoices.choices,default=CategoryChoices.OTHER,verbose_name=_("Category"),help_text=_("Select the category of the expense."),)
     vendor = models.CharField(max_length=100,blank=True,null=True,verbose_name=_("Vendor"),help_text=_("The vendor or merchant associated with the expense."))
     payment_method = models.CharField(max_length=50,blank=True,null=True,verbose_name=_("Payment Method"),help_text=_("Payment method used for the expense, e.g., credit card, cash."))
+
+    ROLLUP_FIELDS = ("user", "amount", "category", "date", "created_at")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not {"user_id", "amount", "category", "date", "created_at"} & instance.get_deferred_fields():
+            instance._loaded_rollup = instance.rollup_entry()
+        return instance
+
+    def rollup_entry(self):
+        """ The `(user_id, category, day)` SpendingRollup row this expense counts towards, and its amount. Undated expenses count on the day they were recorded. """
+        day = self.date or (localdate(self.created_at) if self.created_at else None)
+        if isinstance(day, str):
+            day = parse_date(day)
+        return (self.user_id, self.category, day), as_money(self.amount)
+
     class Meta:
         verbose_name = _("Expense")
         verbose_name_plural = _("Expenses")
+        # DESC NULLS LAST on PostgreSQL, to match KeysetPagination's order; see migration 0011
+        indexes = [models.Index(fields=["user", "-date", "-id"], name="expense_user_date_id_idx")]
 
 class Budget(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="budgets")
@@ -114,33 +153,99 @@ class Budget(models.Model):
     start_date = models.DateField()  # Start of budget period
     end_date = models.DateField()  # End of budget period
     created_at = models.DateTimeField(auto_now_add=True)
+    data_version = models.PositiveIntegerField(default=0)  # Bumped whenever the budget or its linked receipts change
+    data_updated_at = models.DateTimeField(default=now)
 
-    def update_spending(self):
-        """ Update current spending based on linked receipts' total amounts. """
-        if not self.filter_categories:
-            total_spent = (
-                self.receipts.exclude(total_amount=None)
-                .annotate(total_as_float=Cast("total_amount", FloatField()))
-                .aggregate(total=Sum("total_as_float"))["total"] or 0
-            )
-        else:
-            total_spent = (
-                self.receipts.filter(receipt_category__in=self.filter_categories)  # ✅ Only count allowed categories
-                .exclude(total_amount=None)
-                .annotate(total_as_float=Cast("total_amount", FloatField()))
-                .aggregate(total=Sum("total_as_float"))["total"] or 0
+    # Maintained with atomic F() updates, so a save() must never write back a stale in-memory copy
+    COUNTER_FIELDS = ("current_spending", "data_version", "data_updated_at")
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "filter_categories" not in instance.get_deferred_fields():
+            instance._loaded_filter_categories = list(instance.filter_categories or [])
+        return instance
+
+    @staticmethod
+    def category_counts(filter_categories, category):
+        """ A budget counts every receipt when it has no filter categories. """
+        return not filter_categories or category in filter_categories
+
+    @classmethod
+    def apply_spending_deltas(cls, deltas, touched=()):
+        """
+        Atomically add Decimal amounts, keyed by budget id, to current_spending in one UPDATE.
+
+        Every budget in `deltas` or `touched` also gets a new data_version, which
+        invalidates its cached report snapshots.
+        """
+        deltas = {budget_id: delta for budget_id, delta in deltas.items() if delta}
+        budget_ids = set(deltas) | set(touched)
+        if not budget_ids:
+            return
+        changes = {"data_version": F("data_version") + 1, "data_updated_at": now()}
+        if deltas:
+            money = models.DecimalField(max_digits=10, decimal_places=2)
+            change = Case(
+                *[When(pk=budget_id, then=Value(delta, output_field=money)) for budget_id, delta in deltas.items()],
+                default=Value(Decimal("0.00"), output_field=money),
+                output_field=money,
             )
-        self.current_spending = total_spent
-        self.save()
+            changes["current_spending"] = F("current_spending") + change
+        cls.objects.filter(pk__in=budget_ids).update(**changes)
+
+    @classmethod
+    def touch(cls, budget_ids):
+        """ Mark budgets as changed without touching their spending. """
+        cls.apply_spending_deltas({}, touched=budget_ids)
+
+    def sync_filter_categories(self):
+        """ Mirror filter_categories into BudgetFilterCategory rows used by the matching engine. """
+        self.category_filters.all().delete()
+        BudgetFilterCategory.objects.bulk_create(
+            BudgetFilterCategory(budget=self, category=category) for category in set(self.filter_categories or [])
+        )
+
+    def update_spending(self):
+        """ Recompute current spending from scratch based on linked receipts' total amounts. """
+        receipts = self.receipts.exclude(total_amount=None)
+        if self.filter_categories:
+            receipts = receipts.filter(receipt_category__in=self.filter_categories)  # ✅ Only count allowed categories
+        self.current_spending = receipts.aggregate(total=Sum("total_amount"))["total"] or Decimal("0.00")
+        Budget.objects.filter(pk=self.pk).update(
+            current_spending=self.current_spending, data_version=F("data_version") + 1, data_updated_at=now()
+        )
 
     class Meta:
         verbose_name = _("Budget")
         verbose_name_plural = _("Budgets")
+        indexes = [
+            models.Index(fields=["user", "start_date", "end_date"], name="budget_user_period_idx"),
+            models.Index(fields=["user", "-start_date", "-id"], name="budget_user_start_id_idx"),
+        ]
+
+
+class BudgetFilterCategory(models.Model):
+    """ One row per category in Budget.filter_categories, so matching can join instead of substring-searching. """
+    budget = models.ForeignKey(Budget, on_delete=models.CASCADE, related_name="category_filters")
+    category = models.CharField(max_length=50, choices=CategoryChoices.choices)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["budget", "category"], name="unique_budget_filter_category")]
 
 
 class Receipt(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="receipts")
     image_url = models.URLField(max_length=500, verbose_name=_("Image URL"), blank=True, null=True)  # Store uploaded receipt image URLs
+    image_key = models.CharField(max_length=255, blank=True, default="")  # Key in the receipt image storage; read URLs are signed on demand
     budget = models.ManyToManyField(Budget, related_name=_("receipts")) # Link to budget
     merchant = models.CharField(max_length=100, verbose_name=_("Merchant"), blank=True, null=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name=_("Total"), blank=True, null=True)
@@ -151,30 +256,281 @@ class Receipt(models.Model):
     
     def __str__(self):
         return f"Receipt from {self.merchant or 'Unknown Merchant'} uploaded on {self.uploaded_at}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        deferred = instance.get_deferred_fields()
+        if not {"total_amount", "receipt_category"} & deferred:
+            instance._loaded_spending = instance.spending_key()
+        if not {"user_id", "total_amount", "receipt_category", "transaction_date", "uploaded_at"} & deferred:
+            instance._loaded_rollup = instance.rollup_entry()
+        if "parsed_items" not in deferred:
+            instance._loaded_parsed_items = instance.parsed_items
+        return instance
+
+    # Everything spending_key() and rollup_entry() read
+    SPENDING_FIELDS = ("user", "total_amount", "receipt_category", "transaction_date", "uploaded_at")
+
+    def spending_key(self):
+        """ The values that decide how much this receipt adds to a budget. """
+        return as_money(self.total_amount), self.receipt_category
+
+    def rollup_entry(self):
+        """ The `(user_id, category, day)` SpendingRollup row this receipt counts towards, and its amount. """
+        from .budgeting import receipt_date
+        return (self.user_id, self.receipt_category, receipt_date(self)), as_money(self.total_amount)
     
+    def item_rows(self):
+        """ Unsaved ReceiptItems for the entries of parsed_items. """
+        if not isinstance(self.parsed_items, list):
+            return []
+        return [
+            ReceiptItem.from_parsed(self, position, details)
+            for position, details in enumerate(self.parsed_items)
+            if isinstance(details, dict)
+        ]
+
+    def sync_items(self):
+        """ Mirror parsed_items into ReceiptItem rows. Expense links of the replaced rows are lost. """
+        self.items.all().delete()
+        ReceiptItem.objects.bulk_create(self.item_rows())
+
     def assign_to_budget(self):
         """ Automatically assigns the receipt to the correct budget if applicable. """
-        matching_budgets = Budget.objects.filter(
-            user=self.user,
-            start_date__lte=self.transaction_date if self.transaction_date else self.uploaded_at,
-            end_date__gte=self.transaction_date if self.transaction_date else self.uploaded_at,
-        )
-        
-        matching_budgets = matching_budgets.filter(
-            models.Q(filter_categories__isnull=True) |  # No filtering if filter_categories is empty
-            models.Q(filter_categories="") |  # No filtering if empty string
-            models.Q(filter_categories__contains=self.receipt_category)  # Match receipt category
-        )
-        
-        if matching_budgets.exists():
-            self.budget.set(matching_budgets)  # ✅ Assign multiple budgets
-            self.save()
-
-        # ✅ Update spending for all affected budgets
-            for budget in matching_budgets:
-                budget.update_spending()
+        from .budgeting import link_receipts_to_budgets
+        link_receipts_to_budgets([self])
     
     def determine_category(parsed_category):
         """Assigns a category based on parsed data."""
         category_map = {c.label.lower(): c.value for c in CategoryChoices}
         return category_map.get(parsed_category.lower(), CategoryChoices.OTHER)
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "-uploaded_at", "-id"], name="receipt_user_uploaded_id_idx")]
+
+
+class ReceiptItem(models.Model):
+    """ One line item of a receipt, mirrored from Receipt.parsed_items so items can be queried in SQL. """
+    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE, related_name="items")
+    expense = models.OneToOneField(Expense, on_delete=models.SET_NULL, related_name="receipt_item", blank=True, null=True)  # The Expense created for a priced item
+    position = models.PositiveIntegerField()  # Index in parsed_items
+    description = models.CharField(max_length=255, blank=True, default="")
+    quantity = models.DecimalField(max_digits=12, decimal_places=3, blank=True, null=True)
+    total_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+
+    @classmethod
+    def from_parsed(cls, receipt, position, details):
+        """ An unsaved item from one parsed_items entry, `{"description": {"value": ...}, "total_price": {"value": ...}, ...}`. """
+        def value(name):
+            field = details.get(name)
+            return field.get("value") if isinstance(field, dict) else None
+
+        def number(name, places, limit):
+            parsed = parse_decimal(value(name))
+            # OCR misreads that would overflow the column are dropped rather than failing the receipt
+            return parsed.quantize(places) if parsed is not None and abs(parsed) < limit else None
+
+        return cls(
+            receipt=receipt,
+            position=position,
+            description=str(value("description") or "")[:255],
+            quantity=number("quantity", Decimal("0.001"), 10 ** 9),
+            total_price=number("total_price", Decimal("0.01"), 10 ** 8),
+        )
+
+    @classmethod
+    def for_receipts(cls, receipts, expenses_by_receipt):
+        """
+        Unsaved items for bulk-inserted receipts, each priced item linked to its
+        Expense. `expenses_by_receipt` holds every receipt's saved expenses, one
+        per priced item in item order, as ParsedReceipt.expense_fields() makes them.
+        """
+        rows = []
+        for receipt, receipt_expenses in zip(receipts, expenses_by_receipt):
+            expenses = iter(receipt_expenses)
+            for item in receipt.item_rows():
+                if item.total_price is not None:
+                    item.expense = next(expenses, None)
+                rows.append(item)
+        return rows
+
+    class Meta:
+        verbose_name = _("Receipt Item")
+        verbose_name_plural = _("Receipt Items")
+        ordering = ["receipt", "position"]
+        constraints = [models.UniqueConstraint(fields=["receipt", "position"], name="unique_receipt_item_position")]
+
+
+class SpendingRollup(models.Model):
+    """
+    Receipt and expense totals per user, category and day, for the analytics endpoint.
+
+    Receipts and their line-item expenses describe the same money, so the two
+    are kept side by side rather than added together. Rows are maintained
+    incrementally by the signal handlers and bulk write paths through
+    apply_deltas(); `manage.py backfill_spending_rollups` rebuilds them.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="spending_rollups")
+    category = models.CharField(max_length=50, choices=CategoryChoices.choices)
+    day = models.DateField()
+    receipt_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    receipt_count = models.IntegerField(default=0)
+    expense_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    expense_count = models.IntegerField(default=0)
+
+    VALUE_FIELDS = ("receipt_total", "receipt_count", "expense_total", "expense_count")
+
+    @classmethod
+    def apply_deltas(cls, deltas, batch_size=250):
+        """
+        Atomically add `{(user_id, category, day): [receipt_total, receipt_count, expense_total, expense_count]}`
+        to the rollup rows.
+
+        Missing rows are inserted with their values; existing ones (and any a
+        concurrent writer just created) are added to in place, one UPDATE per
+        batch. Rows left without receipts or expenses are deleted.
+        """
+        deltas = {key: values for key, values in deltas.items() if key[2] is not None and any(values)}
+        if not deltas:
+            return
+        with transaction.atomic():
+            ids = cls._ids_for(deltas)
+            missing = [key for key, values in deltas.items() if key not in ids and (values[1] > 0 or values[3] > 0)]
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(
+                        [cls(user_id=key[0], category=key[1], day=key[2], **dict(zip(cls.VALUE_FIELDS, deltas[key]))) for key in missing],
+                        batch_size=batch_size,
+                    )
+            except IntegrityError:
+                # Some appeared since the lookup; create the rest empty and add to them all below
+                cls.objects.bulk_create(
+                    [cls(user_id=user_id, category=category, day=day) for user_id, category, day in missing],
+                    batch_size=batch_size,
+                    ignore_conflicts=True,
+                )
+                ids = cls._ids_for(deltas)
+
+            changed = [(ids[key], values) for key, values in deltas.items() if key in ids]
+            for start in range(0, len(changed), batch_size):
+                if cls._update_from_supported():
+                    cls._add_values(changed[start:start + batch_size])
+                else:
+                    cls._add_values_with_case(changed[start:start + batch_size])
+            if any(values[1] < 0 or values[3] < 0 for values in deltas.values()):
+                cls.objects.filter(pk__in=ids.values(), receipt_count__lte=0, expense_count__lte=0).delete()
+
+    @staticmethod
+    def _update_from_supported():
+        if connection.vendor == "sqlite":
+            return connection.Database.sqlite_version_info >= (3, 33)
+        return connection.vendor == "postgresql"
+
+    @classmethod
+    def _add_values(cls, batch):
+        """Add `[(pk, values)]` to the rows in one UPDATE ... FROM (VALUES ...) statement."""
+        table, quote = cls._meta.db_table, connection.ops.quote_name
+        sets = ", ".join(f"{quote(field)} = {quote(field)} + v.column{index}" for index, field in enumerate(cls.VALUE_FIELDS, 2))
+        rows = ", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {quote(table)} SET {sets} FROM (VALUES {rows}) AS v WHERE {quote(table)}.{quote(cls._meta.pk.column)} = v.column1",
+                [value for pk, values in batch for value in (pk, *values)],
+            )
+
+    @classmethod
+    def _add_values_with_case(cls, batch):
+        """_add_values() for databases without UPDATE ... FROM: one Case per field, which costs far more to compile."""
+        money = models.DecimalField(max_digits=14, decimal_places=2)
+        changes = {}
+        for index, field in enumerate(cls.VALUE_FIELDS):
+            output_field = money if field.endswith("_total") else models.IntegerField()
+            whens = [When(pk=pk, then=Value(values[index], output_field=output_field)) for pk, values in batch if values[index]]
+            if whens:
+                changes[field] = F(field) + Case(*whens, default=Value(0, output_field=output_field), output_field=output_field)
+        cls.objects.filter(pk__in=[pk for pk, _ in batch]).update(**changes)
+
+    @classmethod
+    def _ids_for(cls, deltas):
+        days = [day for _, _, day in deltas]
+        rows = cls.objects.filter(
+            user_id__in={user_id for user_id, _, _ in deltas}, day__range=(min(days), max(days)),
+        ).values_list("pk", "user_id", "category", "day")
+        return {(user_id, category, day): pk for pk, user_id, category, day in rows if (user_id, category, day) in deltas}
+
+    class Meta:
+        verbose_name = _("Spending Rollup")
+        verbose_name_plural = _("Spending Rollups")
+        constraints = [models.UniqueConstraint(fields=["user", "day", "category"], name="unique_spending_rollup")]
+
+
+class SearchDocument(models.Model):
+    """
+    The searchable text of one receipt (merchant and item descriptions) or expense (vendor).
+
+    Only `text` is written by Django. Migration 0009 indexes it per database:
+    a generated tsvector column with GIN and trigram indexes on PostgreSQL,
+    and an FTS5 table kept in sync by triggers on SQLite. search.py queries
+    whichever exists.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="search_documents")
+    receipt = models.OneToOneField(Receipt, on_delete=models.CASCADE, related_name="search_document", blank=True, null=True)
+    expense = models.OneToOneField(Expense, on_delete=models.CASCADE, related_name="search_document", blank=True, null=True)
+    text = models.TextField()
+    day = models.DateField(blank=True, null=True)  # Breaks ties between equally ranked results, newest first
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(receipt__isnull=False, expense__isnull=True) | Q(receipt__isnull=True, expense__isnull=False),
+                name="search_document_one_source",
+            ),
+        ]
+
+
+class ReceiptJob(models.Model):
+    """A receipt upload queued for background OCR processing."""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        RUNNING = "running", _("Running")
+        SUCCEEDED = "succeeded", _("Succeeded")
+        FAILED = "failed", _("Failed")
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="receipt_jobs")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING, db_index=True)
+    image_file = models.FileField(upload_to="receipt_jobs/", blank=True, null=True)  # Stored upload awaiting processing
+    image_url = models.URLField(max_length=500, blank=True, null=True)  # Remote image to download instead
+    receipt = models.ForeignKey(Receipt, on_delete=models.SET_NULL, related_name="jobs", blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    available_at = models.DateTimeField(default=now)  # Earliest time the next attempt may run
+    claimed_at = models.DateTimeField(blank=True, null=True)  # When the running attempt started; stale ones are re-queued
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Receipt Job")
+        verbose_name_plural = _("Receipt Jobs")
+        indexes = [models.Index(fields=["status", "available_at"], name="receiptjob_status_avail_idx")]
+
+    def __str__(self):
+        return f"Receipt job {self.pk} ({self.status})"
+
+
+class ReceiptImageCache(models.Model):
+    """Maps the SHA-256 of a receipt image to its stored image and its analysis result."""
+    content_hash = models.CharField(max_length=64, unique=True)
+    image_key = models.CharField(max_length=255)
+    analyze_result = models.JSONField(blank=True, null=True)  # AnalyzeResult.as_dict() from Document Intelligence
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name = _("Receipt Image Cache Entry")
+        verbose_name_plural = _("Receipt Image Cache")
+
+    def __str__(self):
+        return self.content_hash
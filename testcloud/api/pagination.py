@@ -0,0 +1,169 @@
+import base64
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over the view's `ordering`, e.g. ('-uploaded_at', '-id').
+
+    The cursor carries the values of every ordering field of the row it
+    points at. The next page is fetched with the equivalent of a row-value
+    comparison against them, spelled out as ORs of per-field comparisons
+    under an inclusive bound on the first field (see _segments). With a
+    matching (user, ..., id) index every page is an index range scan
+    starting at the cursor, so page N costs the same as page 1. The ordering must
+    end with a unique field. Nullable fields sort their NULLs last.
+    """
+    page_size = 50
+    max_page_size = 500
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering = ('-id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.keys = self.get_keys(queryset.model, view)
+        values, self.reverse = self.decode_cursor(request, queryset.model)
+
+        keys = [(name, not descending, not nulls_last) for name, descending, nulls_last in self.keys] if self.reverse else self.keys
+        queryset = queryset.order_by(*[self._order_by(*key) for key in keys])
+        if values is None:
+            rows = list(queryset[:self.page_size + 1])
+        else:
+            rows = []
+            for segment in self._segments(keys, values):
+                rows += queryset.filter(segment)[:self.page_size + 1 - len(rows)]
+                if len(rows) > self.page_size:
+                    break
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = values is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, values is not None
+        self.page = rows
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def get_keys(self, model, view):
+        """ Return (field name, descending, nulls last) for every ordering field. """
+        keys = []
+        for name in getattr(view, 'ordering', self.ordering):
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            keys.append((name, descending, model._meta.get_field(name).null))
+        return keys
+
+    def _order_by(self, name, descending, nulls_last):
+        if not self._nullable(name):
+            return F(name).desc() if descending else F(name).asc()
+        nulls = {'nulls_last': True} if nulls_last else {'nulls_first': True}
+        return F(name).desc(**nulls) if descending else F(name).asc(**nulls)
+
+    def _nullable(self, name):
+        return any(key[0] == name and key[2] for key in self.keys)
+
+    def _after(self, keys, values):
+        """ Build `(k1, k2, ...) > (v1, v2, ...)` in the direction of `keys`, as ORs of per-field comparisons. """
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, descending, nulls_last), value in zip(keys, values):
+            if value is None:
+                after = None if nulls_last else Q(**{f'{name}__isnull': False})
+                same = Q(**{f'{name}__isnull': True})
+            else:
+                after = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+                if self._nullable(name) and nulls_last:
+                    after |= Q(**{f'{name}__isnull': True})
+                same = Q(**{name: value})
+            if after is not None:
+                condition |= equal & after
+            equal &= same
+        return condition
+
+    def _segments(self, keys, values):
+        """
+        Filters for the rows after the cursor, in page order. Each one bounds the
+        first key to a single range (k1 <= v1, or k1 IS NULL) so the database
+        can seek to the cursor on the index; an OR with the NULLs would make it
+        filter every row of the user instead.
+        """
+        (name, descending, nulls_last), value = keys[0], values[0]
+        rest = self._after(keys[1:], values[1:])
+        if value is None:
+            segments = [Q(**{f'{name}__isnull': True}) & rest]
+            if not nulls_last:
+                segments.append(Q(**{f'{name}__isnull': False}))
+            return segments
+        op = 'lt' if descending else 'gt'
+        segments = [Q(**{f'{name}__{op}e': value}) & (Q(**{f'{name}__{op}': value}) | (Q(**{name: value}) & rest))]
+        if self._nullable(name) and nulls_last:
+            segments.append(Q(**{f'{name}__isnull': True}))
+        return segments
+
+    def encode_cursor(self, row, reverse):
+        values = [None if getattr(row, name) is None else row._meta.get_field(name).value_to_string(row)
+                  for name, _, _ in self.keys]
+        token = json.dumps({'v': values, 'r': reverse}, separators=(',', ':')).encode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   base64.urlsafe_b64encode(token).decode())
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode()))
+            raw = data['v']
+            if len(raw) != len(self.keys):
+                raise ValueError
+            values = [None if value is None else model._meta.get_field(name).to_python(value)
+                      for (name, _, _), value in zip(self.keys, raw)]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return values, bool(data.get('r'))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
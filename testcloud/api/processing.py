@@ -0,0 +1,265 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+from collections import Counter
+from contextvars import copy_context
+from io import BytesIO
+import hashlib
+import requests
+import tempfile
+import threading
+from .analysis import ParsedReceipt, get_receipt_analyser
+from .analytics import record_spending
+from .budgeting import link_receipts_to_budgets
+from .clients import get_http_session
+from .imaging import ImageRejected, get_image_settings, preprocess_image
+from .metrics import count_queries, current_timings, timed
+from .search import index_documents
+from .models import Expense, Receipt, ReceiptImageCache, ReceiptItem
+from .storage import get_image_storage
+
+
+class ReceiptProcessingError(Exception):
+    """Raised when a receipt image cannot be fetched or processed."""
+
+
+_cache_stats = Counter()
+_cache_stats_lock = threading.Lock()
+
+
+def get_image_cache_stats():
+    """Return the image cache hit/miss counters for this process."""
+    with _cache_stats_lock:
+        return {"hits": _cache_stats["hits"], "misses": _cache_stats["misses"]}
+
+
+def process_receipt(user, image_file=None, image_url=None):
+    """Upload, analyse and store a receipt image, returning the new Receipt."""
+    [outcome] = analyse_receipt_sources([(image_file, image_url)])
+    if isinstance(outcome, Exception):
+        raise outcome
+    image_key, result = outcome
+    return create_receipt_from_result(user, image_key, result)
+
+
+class ReceiptImage:
+    """
+    An ingested image spooled to a temporary file, hashed as it was written.
+
+    The file is named so a preprocessing worker process can open it by path.
+    """
+
+    def __init__(self, max_bytes):
+        self.file = tempfile.NamedTemporaryFile(prefix="receipt-", suffix=".img")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self.content_hash = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise ReceiptProcessingError(f"Image is larger than {self.max_bytes // (1024 * 1024)} MB.")
+        self._hash.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self):
+        self.file.flush()
+        self.file.seek(0)
+        self.content_hash = self._hash.hexdigest()
+        return self
+
+    def close(self):
+        self.file.close()
+
+
+def read_receipt_image(image_file=None, image_url=None):
+    """
+    Stream an uploaded file or a remote image into a ReceiptImage, chunk by
+    chunk, enforcing RECEIPT_IMAGES['MAX_BYTES'].
+    """
+    config = get_image_settings()
+    if not image_file and not image_url:
+        raise ReceiptProcessingError("No image file or image_url provided.")
+    image = ReceiptImage(config["MAX_BYTES"])
+    try:
+        if image_file:
+            for chunk in iter(lambda: image_file.read(config["CHUNK_SIZE"]), b""):
+                image.write(chunk)
+        else:
+            with timed("download"):
+                _download_image(image_url, image, config)
+    except BaseException:
+        image.close()
+        raise
+    return image.finish()
+
+
+def _download_image(image_url, image, config):
+    try:
+        # Download the image from the URL over the shared keep-alive session
+        with get_http_session().get(image_url, timeout=10, stream=True) as response:
+            if response.status_code != 200:
+                raise ReceiptProcessingError("Failed to download image from URL.")
+            # Reject from the headers before reading any of the body
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+                raise ReceiptProcessingError(f"URL does not point to an image ({content_type}).")
+            if int(response.headers.get("Content-Length") or 0) > config["MAX_BYTES"]:
+                raise ReceiptProcessingError(f"Image is larger than {config['MAX_BYTES'] // (1024 * 1024)} MB.")
+            for chunk in response.iter_content(config["CHUNK_SIZE"]):
+                image.write(chunk)
+    except requests.exceptions.RequestException as e:
+        raise ReceiptProcessingError(f"Error fetching image from URL: {str(e)}")
+
+
+def analyse_receipt_image(image_key):
+    """Analyse a stored receipt image with the configured analyser, returning a ParsedReceipt."""
+    with timed("analysis"):
+        return get_receipt_analyser().analyse(image_key)
+
+
+def create_receipt_from_result(user, image_key, parsed):
+    """
+    Create the Expense rows and the Receipt described by a ParsedReceipt.
+
+    Runs as one transaction with a fixed number of queries, however many
+    line items the receipt has.
+    """
+    [receipt] = create_receipts_from_results(user, [(image_key, parsed)])
+    return receipt
+
+
+def analyse_receipt_sources(sources, max_workers=None):
+    """
+    Upload and analyse many receipt images concurrently.
+
+    `sources` is a list of `(image_file, image_url)` pairs. Returns a list in the
+    same order holding either an `(image_key, ParsedReceipt)` tuple or the
+    exception raised while processing that source.
+
+    Images are keyed by the SHA-256 of their bytes. An image that was analysed
+    before is served from ReceiptImageCache without being uploaded or analysed
+    again, and duplicates within one batch are only analysed once.
+    """
+    max_workers = max_workers or getattr(settings, "RECEIPT_BATCH_WORKERS", 8)
+
+    # Stream every image to a temporary file, hashing it on the way
+    images = _map_concurrently(lambda source: read_receipt_image(*source), sources, max_workers)
+    try:
+        return _analyse_images(images, max_workers)
+    finally:
+        for image in images:
+            if not isinstance(image, Exception):
+                image.close()
+
+
+def _analyse_images(images, max_workers):
+    hashes = [None if isinstance(image, Exception) else image.content_hash for image in images]
+
+    cached = ReceiptImageCache.objects.in_bulk({h for h in hashes if h}, field_name="content_hash")
+    hit_hashes = {h for h, entry in cached.items() if entry.analyze_result is not None}
+    hits = sum(1 for h in hashes if h in hit_hashes)
+    with _cache_stats_lock:
+        _cache_stats["hits"] += hits
+        _cache_stats["misses"] += sum(1 for h in hashes if h) - hits
+    if hit_hashes:
+        ReceiptImageCache.objects.filter(content_hash__in=hit_hashes).update(hits=F("hits") + 1, last_used_at=now())
+
+    # Upload and analyse the images that have not been seen before
+    first_index = {}
+    for index, content_hash in enumerate(hashes):
+        if content_hash and content_hash not in hit_hashes:
+            first_index.setdefault(content_hash, index)
+
+    def analyse(content_hash):
+        entry = cached.get(content_hash)
+        if entry:
+            image_key = entry.image_key  # Uploaded before, but the analysis did not finish
+        else:
+            image = images[first_index[content_hash]]
+            image_key = store_receipt_image(image.file, f"{content_hash}.jpg")
+        return image_key, analyse_receipt_image(image_key)
+
+    analysed = dict(zip(first_index, _map_concurrently(analyse, list(first_index), max_workers)))
+    ReceiptImageCache.objects.bulk_create(
+        [
+            ReceiptImageCache(content_hash=content_hash, image_key=outcome[0], analyze_result=outcome[1].to_dict())
+            for content_hash, outcome in analysed.items()
+            if not isinstance(outcome, Exception)
+        ],
+        update_conflicts=True,
+        unique_fields=["content_hash"],
+        update_fields=["image_key", "analyze_result", "last_used_at"],
+    )
+
+    outcomes = []
+    for image, content_hash in zip(images, hashes):
+        if content_hash is None:
+            outcomes.append(image)
+        elif content_hash in hit_hashes:
+            entry = cached[content_hash]
+            outcomes.append((entry.image_key, ParsedReceipt.from_dict(entry.analyze_result)))
+        else:
+            outcomes.append(analysed[content_hash])
+    return outcomes
+
+
+def _map_concurrently(function, items, max_workers):
+    """Apply `function` to every item on a bounded thread pool, returning results or exceptions in order."""
+    def call(item):
+        try:
+            return function(item)
+        except Exception as e:
+            return e
+
+    if len(items) <= 1:
+        return [call(item) for item in items]
+    def call_in_worker(item):
+        # Worker threads have their own database connections, which the request's query count must cover too
+        with count_queries(current_timings()):
+            return call(item)
+
+    # Each call runs in a copy of the caller's context, so its timed() spans reach the request's metrics
+    contexts = [copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="receipt-batch") as executor:
+        return list(executor.map(lambda context, item: context.run(call_in_worker, item), contexts, items))
+
+
+def create_receipts_from_results(user, analysed):
+    """Bulk-insert the Receipts and Expenses for a list of `(image_key, ParsedReceipt)` pairs."""
+    receipts = []
+    expenses_by_receipt = []
+    for image_key, parsed in analysed:
+        receipts.append(Receipt(user=user, image_key=image_key or "", **parsed.receipt_fields()))
+        expenses_by_receipt.append([Expense(user=user, **fields) for fields in parsed.expense_fields()])
+    expenses = [expense for receipt_expenses in expenses_by_receipt for expense in receipt_expenses]
+
+    with transaction.atomic():
+        Receipt.objects.bulk_create(receipts)
+        Expense.objects.bulk_create(expenses)
+        ReceiptItem.objects.bulk_create(ReceiptItem.for_receipts(receipts, expenses_by_receipt))
+        link_receipts_to_budgets(receipts, created=True)
+        record_spending(receipts, expenses)
+        index_documents(receipts, expenses)
+    return receipts
+
+
+def store_receipt_image(image_file, key):
+    """Compress an image and store it under `key` in the receipt image storage, returning the key."""
+    with timed("preprocess"):
+        compressed_image = compress_image(image_file)
+    length = compressed_image.seek(0, 2)
+    compressed_image.seek(0)
+    with timed("blob_upload"):
+        return get_image_storage().save(key, compressed_image, length, "image/jpeg")
+
+
+def compress_image(image_file):
+    """Downscale and compress the image to reduce file size before uploading."""
+    try:
+        return BytesIO(preprocess_image(image_file))
+    except ImageRejected as e:
+        raise ReceiptProcessingError(str(e))
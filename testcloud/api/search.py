@@ -0,0 +1,192 @@
+"""
+Full-text search over receipts (merchant and item descriptions) and expenses (vendor).
+
+Each receipt and expense has one SearchDocument row holding its text. The
+signal handlers in signals.py keep it current for single saves and
+index_documents() covers the bulk insert paths. The index itself lives in
+the database (see migration 0009):
+
+- PostgreSQL: a generated `search_vector` tsvector column with a GIN index,
+  plus a pg_trgm GIN index on the text, so misspelt names still match. The
+  trigram part is skipped where the pg_trgm extension could not be created
+  (it needs a superuser, or on Azure pg_trgm in `azure.extensions`).
+- SQLite: an FTS5 table over the text, ranked with bm25().
+
+Other databases fall back to unranked substring matching. Every term of the
+query must match, as a word prefix ("coff" finds "Coffee").
+"""
+import re
+from django.db import connection, transaction
+from django.db.models import Q
+from .models import Expense, Receipt, SearchDocument
+
+MAX_TERMS = 10
+
+_trigram_support = {}  # Database alias -> whether pg_trgm is installed
+
+
+def search_terms(query):
+    """The lower-cased words of a search query, without operators or punctuation."""
+    return re.findall(r"\w+", (query or "").lower())[:MAX_TERMS]
+
+
+def receipt_text(receipt):
+    """The merchant and item descriptions of a receipt, as indexed."""
+    parts = [receipt.merchant or ""]
+    if isinstance(receipt.parsed_items, list):
+        for item in receipt.parsed_items:
+            description = (item.get("description") or {}).get("value") if isinstance(item, dict) else None
+            if description:
+                parts.append(str(description))
+    return " ".join(part for part in parts if part)
+
+
+def document_for(instance):
+    """An unsaved SearchDocument for a Receipt or Expense."""
+    (user_id, _, day), _ = instance.rollup_entry()  # Dated the way the spending rollups date it
+    if isinstance(instance, Receipt):
+        return SearchDocument(user_id=user_id, receipt_id=instance.pk, text=receipt_text(instance), day=day)
+    return SearchDocument(user_id=user_id, expense_id=instance.pk, text=instance.vendor or "", day=day)
+
+
+def index_documents(receipts=(), expenses=(), batch_size=1000):
+    """Index freshly bulk-inserted receipts and expenses, which fire no post_save signals."""
+    documents = [document_for(instance) for instance in [*receipts, *expenses]]
+    SearchDocument.objects.bulk_create(documents, batch_size=batch_size)
+    return len(documents)
+
+
+def update_document(instance):
+    """Bring the SearchDocument of a saved Receipt or Expense up to date, creating it if missing."""
+    document = document_for(instance)
+    source = {"receipt": instance} if isinstance(instance, Receipt) else {"expense": instance}
+    if not SearchDocument.objects.filter(**source).update(text=document.text, day=document.day, user_id=document.user_id):
+        document.save()
+
+
+def rebuild_search_index(batch_size=1000, on_batch=None):
+    """
+    Replace every SearchDocument, one transaction per batch of receipts or
+    expenses. Returns the number written. Searches only see part of the
+    index until it finishes.
+    """
+    SearchDocument.objects.all().delete()
+    written = 0
+    sources = (("receipts", Receipt, ("merchant", "parsed_items", *Receipt.SPENDING_FIELDS)), ("expenses", Expense, ("vendor", *Expense.ROLLUP_FIELDS)))
+    for name, model, fields in sources:
+        batch = []
+        for instance in model.objects.only(*fields).order_by("pk").iterator(chunk_size=batch_size):
+            batch.append(instance)
+            if len(batch) >= batch_size:
+                written += _index_batch(name, batch, on_batch)
+                batch = []
+        if batch:
+            written += _index_batch(name, batch, on_batch)
+    return written
+
+
+def _index_batch(name, instances, on_batch):
+    with transaction.atomic():
+        count = index_documents(**{name: instances})
+    if on_batch:
+        on_batch(name, count)
+    return count
+
+
+class SearchResults:
+    """
+    The ranked matches of a query, fetched a page at a time.
+
+    Supports count() and slicing, so it can be handed to a Django or DRF
+    paginator. Slices are lists of `(SearchDocument id, rank)`.
+    """
+
+    def __init__(self, user, terms, kind=None):
+        self.user = user
+        self.terms = terms
+        self.kind = kind
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self._query(count=True)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("SearchResults only supports slicing.")
+        start, stop = index.start or 0, index.stop
+        return self._query(offset=start, limit=None if stop is None else max(stop - start, 0))
+
+    def _scope(self):
+        """SQL conditions and params restricting documents (aliased d) to the user and kind."""
+        sql, params = ["d.user_id = %s"], [self.user.pk]
+        if self.kind == "receipt":
+            sql.append("d.receipt_id IS NOT NULL")
+        elif self.kind == "expense":
+            sql.append("d.expense_id IS NOT NULL")
+        return " AND ".join(sql), params
+
+    def _query(self, count=False, offset=0, limit=None):
+        if not self.terms:
+            return 0 if count else []
+        search = {"sqlite": self._sqlite, "postgresql": self._postgresql}.get(connection.vendor, self._fallback)
+        return search(count, offset, limit)
+
+    def _run(self, tables, where, rank, params, rank_params, count, offset, limit):
+        if count:
+            sql = f"SELECT COUNT(*) FROM {tables} WHERE {where}"
+        else:
+            sql = f"SELECT d.id, {rank} AS rank FROM {tables} WHERE {where} ORDER BY rank DESC, d.day DESC, d.id DESC LIMIT %s OFFSET %s"
+            params = [*rank_params, *params, -1 if limit is None and connection.vendor == "sqlite" else limit, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0] if count else [(row[0], float(row[1])) for row in cursor.fetchall()]
+
+    def _sqlite(self, count, offset, limit):
+        scope, params = self._scope()
+        match = " ".join(f'"{term}"*' for term in self.terms)
+        # CROSS JOIN keeps the FTS match as the outer loop; driven from the user's rows it re-runs the match per row
+        tables = "api_searchdocument_fts CROSS JOIN api_searchdocument d ON d.id = api_searchdocument_fts.rowid"
+        where = f"api_searchdocument_fts MATCH %s AND {scope}"
+        return self._run(tables, where, "-bm25(api_searchdocument_fts)", [match, *params], [], count, offset, limit)
+
+    def _postgresql(self, count, offset, limit):
+        scope, params = self._scope()
+        tsquery = " & ".join(f"{term}:*" for term in self.terms)
+        if not has_trigram_support():
+            where = f"d.search_vector @@ to_tsquery('simple', %s) AND {scope}"
+            rank = "ts_rank(d.search_vector, to_tsquery('simple', %s))"
+            return self._run("api_searchdocument d", where, rank, [tsquery, *params], [tsquery], count, offset, limit)
+        phrase = " ".join(self.terms)
+        where = f"(d.search_vector @@ to_tsquery('simple', %s) OR d.text %% %s) AND {scope}"
+        rank = "ts_rank(d.search_vector, to_tsquery('simple', %s)) + similarity(d.text, %s)"
+        return self._run("api_searchdocument d", where, rank, [tsquery, phrase, *params], [tsquery, phrase], count, offset, limit)
+
+    def _fallback(self, count, offset, limit):
+        documents = SearchDocument.objects.filter(user=self.user)
+        if self.kind:
+            documents = documents.filter(**{f"{self.kind}__isnull": False})
+        for term in self.terms:
+            documents = documents.filter(Q(text__icontains=term))
+        if count:
+            return documents.count()
+        documents = documents.order_by("-day", "-id").values_list("id", flat=True)
+        return [(pk, 0.0) for pk in (documents[offset:] if limit is None else documents[offset:offset + limit])]
+
+
+def has_trigram_support():
+    """Whether the pg_trgm extension is installed in the PostgreSQL database; checked once per process."""
+    if connection.alias not in _trigram_support:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            _trigram_support[connection.alias] = cursor.fetchone()[0]
+    return _trigram_support[connection.alias]
+
+
+def search_documents(user, query, kind=None):
+    """The user's receipts and expenses matching `query`, best first; `kind` limits it to "receipt" or "expense"."""
+    return SearchResults(user, search_terms(query), kind)
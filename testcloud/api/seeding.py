@@ -0,0 +1,281 @@
+"""
+Deterministic synthetic data for benchmarks and profiling.
+
+seed_dataset() writes users with monthly budgets, receipts with realistic
+parsed_items and their ReceiptItems, one expense per priced item and the
+receipts' budget links, all with bulk_create in batches. Every user's rows, including how many of
+them there are, come from a generator seeded with `(seed, user index)`, so
+the same arguments produce the same data however the users are split
+across worker processes (only the primary keys differ).
+"""
+import math
+import multiprocessing
+import random
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import django
+from django.contrib.auth.hashers import make_password
+from django.db import connections, transaction
+from django.utils.timezone import get_current_timezone, make_aware
+from .analysis import ParsedItem
+from .analytics import rebuild_spending_rollups
+from .models import Budget, BudgetFilterCategory, CategoryChoices, Expense, Receipt, ReceiptItem, User
+from .search import index_documents
+
+SEED_PASSWORD = "seed-password"  # Every seeded user can log in with it
+
+
+@dataclass(frozen=True)
+class CategoryProfile:
+    weight: int  # Relative share of receipts
+    merchants: tuple
+    items: tuple  # (description, min price, max price)
+    item_counts: tuple  # (min, mode, max) line items per receipt
+
+
+CATALOG = {
+    CategoryChoices.SUPPLIES: CategoryProfile(
+        30,
+        ("Walmart", "Tesco", "Costco", "Aldi", "Staples", "Target"),
+        (("Milk 2L", 1.1, 2.4), ("Bread", 0.9, 3.5), ("Eggs x12", 2.5, 4.8), ("Bananas", 0.8, 2.2),
+         ("Printer Paper", 4.0, 9.0), ("Coffee Beans 1kg", 8.0, 19.0), ("Dish Soap", 1.5, 3.9),
+         ("Chicken Breast", 4.5, 11.0), ("Rice 5kg", 6.0, 12.0), ("Pens x10", 2.0, 6.5)),
+        (1, 8, 45),
+    ),
+    CategoryChoices.MEAL: CategoryProfile(
+        25,
+        ("Starbucks", "Pret A Manger", "Chipotle", "Nando's", "Olive Garden", "Local Diner"),
+        (("Coffee", 2.5, 5.5), ("Latte", 3.0, 6.0), ("Sandwich", 4.5, 11.0), ("Burrito", 7.0, 13.0),
+         ("Salad", 6.0, 14.0), ("Soft Drink", 1.5, 3.5), ("Dessert", 3.0, 8.0)),
+        (1, 2, 8),
+    ),
+    CategoryChoices.FUEL_ENERGY: CategoryProfile(
+        10, ("Shell", "BP", "Esso", "Texaco"), (("Unleaded", 25.0, 95.0), ("Diesel", 30.0, 110.0), ("Car Wash", 5.0, 15.0)), (1, 1, 3),
+    ),
+    CategoryChoices.TRANSPORTATION: CategoryProfile(
+        8, ("Uber", "Lyft", "National Rail", "City Transit"), (("Ride", 6.0, 45.0), ("Train Ticket", 3.0, 90.0), ("Bus Pass", 2.0, 25.0)), (1, 1, 2),
+    ),
+    CategoryChoices.COMMUNICATION_SUBSCRIPTIONS: CategoryProfile(
+        5, ("Vodafone", "Netflix", "Spotify", "Comcast"), (("Monthly Plan", 8.0, 60.0), ("Add-on", 2.0, 15.0)), (1, 1, 2),
+    ),
+    CategoryChoices.ENTERTAINMENT: CategoryProfile(
+        6, ("Cineworld", "Ticketmaster", "Steam"), (("Ticket", 8.0, 80.0), ("Popcorn", 3.0, 8.0), ("Game", 5.0, 60.0)), (1, 2, 5),
+    ),
+    CategoryChoices.HEALTHCARE: CategoryProfile(
+        5, ("Boots", "CVS Pharmacy", "Walgreens"), (("Prescription", 5.0, 40.0), ("Vitamins", 6.0, 25.0), ("Plasters", 2.0, 6.0)), (1, 2, 6),
+    ),
+    CategoryChoices.HOTEL: CategoryProfile(
+        3, ("Hilton", "Premier Inn", "Marriott"), (("Room Night", 60.0, 240.0), ("Breakfast", 8.0, 25.0), ("Parking", 10.0, 30.0)), (1, 2, 4),
+    ),
+    CategoryChoices.TRAINING: CategoryProfile(
+        2, ("Udemy", "Coursera", "O'Reilly"), (("Course", 10.0, 200.0), ("Book", 15.0, 60.0)), (1, 1, 2),
+    ),
+    CategoryChoices.OTHER: CategoryProfile(
+        6, ("Amazon", "eBay", "IKEA"), (("Household Item", 3.0, 80.0), ("Gift", 10.0, 60.0), ("Misc", 1.0, 30.0)), (1, 2, 6),
+    ),
+}
+
+
+def _money(value):
+    return Decimal(f"{value:.2f}")
+
+
+def parse_distribution(spec):
+    """
+    Parse a per-user volume into a function drawing an int from a random.Random.
+
+    Accepts an int, "N" or "fixed:N", "uniform:LOW,HIGH", "lognormal:MEDIAN,SIGMA[,MAX]"
+    or "pareto:MIN,ALPHA[,MAX]". The last two give the long tail real usage has:
+    most users with a few receipts, a handful with very many.
+    """
+    if isinstance(spec, int):
+        return lambda rng: spec
+    kind, _, arguments = str(spec).partition(":")
+    if not arguments:
+        kind, arguments = "fixed", kind
+    try:
+        values = [float(value) for value in arguments.split(",")]
+        if kind == "fixed" and len(values) == 1:
+            count = int(values[0])
+            return lambda rng: count
+        if kind == "uniform" and len(values) == 2:
+            low, high = int(values[0]), int(values[1])
+            return lambda rng: rng.randint(low, high)
+        if kind in ("lognormal", "pareto") and len(values) in (2, 3):
+            upper = values[2] if len(values) == 3 else math.inf
+            if kind == "lognormal":
+                median, sigma = values[:2]
+                return lambda rng: int(min(round(median * math.exp(sigma * rng.gauss(0, 1))), upper))
+            minimum, alpha = values[:2]
+            return lambda rng: int(min(round(minimum * rng.paretovariate(alpha)), upper))
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid distribution {spec!r}; use N, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA[,MAX] or pareto:MIN,ALPHA[,MAX].")
+
+
+class UserGenerator:
+    """Generates one user's budgets and receipts from its own seeded random stream."""
+
+    def __init__(self, seed, index, start, days, receipts, budgets):
+        self.rng = random.Random(f"{seed}:{index}")
+        self.receipts = max(receipts(self.rng), 0)
+        self.budgets = max(budgets(self.rng), 0)
+        self.start = start
+        # Receipts fall within the budget months unless told otherwise, so most of them get linked
+        self.days = days or max((self.budgets * 365) // 12, 30)
+        self.categories = list(CATALOG)
+        self.weights = [CATALOG[category].weight for category in self.categories]
+
+    def budget_rows(self, user_id):
+        """Consecutive monthly budgets from `start`, some of them limited to one or two categories."""
+        rows = []
+        month_start = self.start.replace(day=1)
+        for index in range(self.budgets):
+            next_month = (month_start + timedelta(days=32)).replace(day=1)
+            filters = self.rng.sample(self.categories, self.rng.choice((0, 0, 1, 2)))
+            rows.append(Budget(
+                user_id=user_id,
+                name=f"{month_start:%B %Y}" + (f" ({', '.join(filters)})" if filters else ""),
+                category=filters[0] if filters else CategoryChoices.OTHER,
+                filter_categories=filters,
+                limit_amount=_money(self.rng.uniform(200, 3000)),
+                start_date=month_start,
+                end_date=next_month - timedelta(days=1),
+            ))
+            month_start = next_month
+        return rows
+
+    def receipt(self, user_id):
+        """Return `(receipt, expenses, day)` for one random receipt."""
+        rng = self.rng
+        category = rng.choices(self.categories, self.weights)[0]
+        profile = CATALOG[category]
+        low, mode, high = profile.item_counts
+        items = []
+        for _ in range(int(round(rng.triangular(low, high, mode)))):
+            description, min_price, max_price = rng.choice(profile.items)
+            quantity = rng.choice((1, 1, 1, 2, 3))
+            items.append(ParsedItem(description, str(quantity), _money(rng.uniform(min_price, max_price) * quantity)))
+        day = self.start + timedelta(days=rng.randrange(self.days))
+        merchant = rng.choice(profile.merchants)
+        transaction_date = make_aware(datetime.combine(day, time(rng.randrange(7, 22), rng.randrange(60))), get_current_timezone())
+        receipt = Receipt(
+            user_id=user_id,
+            merchant=merchant,
+            total_amount=sum((item.total_price for item in items), Decimal("0.00")),
+            parsed_items=[item.as_json() for item in items],
+            transaction_date=transaction_date,
+            uploaded_at=transaction_date + timedelta(minutes=rng.randrange(5, 3 * 24 * 60)),
+            receipt_category=category,
+        )
+        expenses = [
+            Expense(user_id=user_id, amount=item.total_price, category=category, date=day, vendor=merchant)
+            for item in items
+        ]
+        return receipt, expenses, day
+
+
+def seed_dataset(users=1, receipts_per_user=10, *, budgets_per_user=3, seed=0, email_prefix="seed",
+                 start=date(2024, 1, 1), days=None, batch_size=2000, workers=1, on_chunk=None):
+    """
+    Create `users` users and return their ids, in index order.
+
+    `receipts_per_user` and `budgets_per_user` are ints or parse_distribution()
+    specs. With `workers` above 1, chunks of users are seeded in parallel
+    processes. `on_chunk` is called with a Counter of the rows each chunk
+    created. Rows are committed a batch at a time.
+    """
+    parse_distribution(receipts_per_user), parse_distribution(budgets_per_user)  # Fail before any work
+    options = (seed, email_prefix, start, days, receipts_per_user, budgets_per_user, batch_size, make_password(SEED_PASSWORD))
+    if workers > 1:
+        chunk_size = max(1, min(batch_size, math.ceil(users / (workers * 8))))  # Several chunks per worker to balance the tail
+    else:
+        chunk_size = batch_size
+    chunks = [range(first, min(first + chunk_size, users)) for first in range(0, users, chunk_size)]
+
+    if workers > 1 and len(chunks) > 1:
+        connections.close_all()  # The workers open their own
+        # Set up Django before the workers unpickle _seed_chunk, which imports the models
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup)
+        results = executor.map(_seed_chunk, chunks, *[[option] * len(chunks) for option in options])
+    else:
+        executor = None
+        results = (_seed_chunk(chunk, *options) for chunk in chunks)
+
+    user_ids = []
+    try:
+        for chunk_ids, counts in results:
+            user_ids.extend(chunk_ids)
+            if on_chunk:
+                on_chunk(counts)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return user_ids
+
+
+def _seed_chunk(indexes, seed, email_prefix, start, days, receipts_per_user, budgets_per_user, batch_size, password):
+    """Seed the users with the given indexes; returns their ids and a Counter of the rows created."""
+    for connection in connections.all():
+        if connection.vendor == "sqlite" and connection.connection is None:
+            # Parallel workers take turns at SQLite's single writer lock; wait for it rather than fail
+            connection.settings_dict["OPTIONS"].setdefault("timeout", 120)
+    receipts, budgets = parse_distribution(receipts_per_user), parse_distribution(budgets_per_user)
+    counts = Counter()
+    with transaction.atomic():
+        created = User.objects.bulk_create(
+            [User(email=f"{email_prefix}-{seed}-{index}@example.com", password=password, full_name=f"Seed User {index}") for index in indexes],
+            batch_size=batch_size,
+        )
+        generators = {user.pk: UserGenerator(seed, index, start, days, receipts, budgets) for user, index in zip(created, indexes)}
+        budget_rows = Budget.objects.bulk_create(
+            [budget for user_id, generator in generators.items() for budget in generator.budget_rows(user_id)],
+            batch_size=batch_size,
+        )
+        filter_rows = BudgetFilterCategory.objects.bulk_create(
+            [BudgetFilterCategory(budget=budget, category=category) for budget in budget_rows for category in budget.filter_categories],
+            batch_size=batch_size,
+        )
+    counts.update(users=len(created), budgets=len(budget_rows), budget_filters=len(filter_rows))
+    budgets_by_user = defaultdict(list)
+    for budget in budget_rows:
+        budgets_by_user[budget.user_id].append(budget)
+
+    spending = defaultdict(Decimal)
+    pending = []
+
+    def flush():
+        with transaction.atomic():
+            receipt_rows = Receipt.objects.bulk_create([receipt for receipt, _, _ in pending], batch_size=batch_size)
+            expense_rows = Expense.objects.bulk_create([expense for _, expenses, _ in pending for expense in expenses], batch_size=batch_size)
+            item_rows = ReceiptItem.objects.bulk_create(
+                ReceiptItem.for_receipts(receipt_rows, [expenses for _, expenses, _ in pending]), batch_size=batch_size,
+            )
+            links = []
+            for receipt, (_, _, day) in zip(receipt_rows, pending):
+                for budget in budgets_by_user[receipt.user_id]:
+                    if budget.start_date <= day <= budget.end_date and Budget.category_counts(budget.filter_categories, receipt.receipt_category):
+                        links.append(Receipt.budget.through(receipt_id=receipt.pk, budget_id=budget.pk))
+                        spending[budget.pk] += receipt.total_amount
+            Receipt.budget.through.objects.bulk_create(links, batch_size=batch_size)
+            documents = index_documents(receipt_rows, expense_rows, batch_size=batch_size)
+        counts.update(receipts=len(receipt_rows), expenses=len(expense_rows), receipt_items=len(item_rows), budget_links=len(links), search_documents=documents)
+        pending.clear()
+
+    for user_id, generator in generators.items():
+        for _ in range(generator.receipts):
+            pending.append(generator.receipt(user_id))
+            if len(pending) >= batch_size:
+                flush()
+    if pending:
+        flush()
+
+    for budget in budget_rows:
+        budget.current_spending = spending[budget.pk]
+    Budget.objects.bulk_update(budget_rows, ["current_spending"], batch_size=500)
+    # The users are new, so building their rollups in one grouped pass beats maintaining them per batch
+    counts.update(spending_rollups=rebuild_spending_rollups(list(generators), batch_size=max(len(generators), 1)))
+    return list(generators), counts
@@ -1,16 +1,27 @@
 from .models import *
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from .metrics import timed
+from .storage import get_image_storage
 
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
+
+class TimedSerializerMixin:
+    """ Count to_representation() towards the request's `serialize` span (see metrics.py). """
+
+    def to_representation(self, instance):
+        with timed("serialize"):
+            return super().to_representation(instance)
+
+
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'email', 'full_name', 'date_of_birth']
         read_only_fields = ['id']
 
-class UserCreateSerializer(serializers.ModelSerializer):
+class UserCreateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['email', 'full_name', 'date_of_birth', 'password']
@@ -25,7 +36,7 @@ class UserCreateSerializer(serializers.ModelSerializer):
         return user
 
 # Transaction Serializer
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Transaction
         fields = ['id', 'user', 'amount', 'category', 'date', 'description', 'created_at', 'updated_at']
@@ -33,7 +44,7 @@ class TransactionSerializer(serializers.ModelSerializer):
 
 
 # Income Serializer
-class IncomeSerializer(serializers.ModelSerializer):
+class IncomeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Income
         #fields = ['id', 'user', 'amount', 'category', 'date', 'source', 'created_at', 'updated_at']
@@ -49,7 +60,7 @@ class IncomeSerializer(serializers.ModelSerializer):
 '''
 
 # Expense Serializer
-class ExpenseSerializer(serializers.ModelSerializer):
+class ExpenseSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     
     class Meta:
         model = Expense
@@ -74,7 +85,7 @@ class ReceiptSerializer(serializers.ModelSerializer):
         receipt = Receipt.objects.create(transaction=transaction, **validated_data)
         return receipt
 '''
-class ReceiptSerializer(serializers.ModelSerializer):
+class ReceiptSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     transaction_date = serializers.DateTimeField(format="%d-%m-%Y", required=False)  # Ensure it's a DateField
     uploaded_at = serializers.DateTimeField(format="%d-%m-%Y", required=False)
 
@@ -83,10 +94,50 @@ class ReceiptSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'image_url', 'merchant', 'total_amount','transaction_date', 'parsed_items', 'receipt_category', 'uploaded_at']
         extra_kwargs = {'user': {'read_only': True},'uploaded_at': {'read_only': True}}
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.image_key:
+            # Stored images get a short-lived signed URL instead of a stored one
+            url = get_image_storage().url(instance.image_key)
+            request = self.context.get('request')
+            data['image_url'] = request.build_absolute_uri(url) if request else url
+        return data
+
+
+class DynamicFieldsMixin:
+    """
+    Trim a serializer with `?fields=a,b` and opt into the expensive fields
+    listed in `Meta.expandable_fields` with `?expand=name`. The same options
+    ('fields', 'expand', 'exclude') can be passed in the serializer context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        expand = set(self._option('expand'))
+        for name in getattr(self.Meta, 'expandable_fields', []):
+            if name not in expand:
+                self.fields.pop(name, None)
+        selected = self._option('fields')
+        if selected:
+            for name in set(self.fields) - set(selected) - expand:
+                self.fields.pop(name)
+        for name in self._option('exclude'):
+            self.fields.pop(name, None)
+
+    def _option(self, name):
+        if name in self.context:
+            return list(self.context[name])
+        request = self.context.get('request')
+        if request is None:
+            return []
+        return [part.strip() for part in request.query_params.get(name, '').split(',') if part.strip()]
+
 
 # Budget Serializer
-class BudgetSerializer(serializers.ModelSerializer):
-    receipts = ReceiptSerializer(many=True, read_only=True)  # Show receipts under budget
+class BudgetSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    receipts = ReceiptSerializer(many=True, read_only=True)  # Full receipts, only with ?expand=receipts
+    receipt_ids = serializers.SerializerMethodField()
+    receipt_count = serializers.SerializerMethodField()
     start_date = serializers.DateField(format="%d-%m-%Y")
     end_date = serializers.DateField(format="%d-%m-%Y")
  
@@ -94,6 +145,22 @@ class BudgetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Budget
-        fields = ['id', 'user', 'name', 'category', 'filter_categories','limit_amount', 'current_spending', 'start_date', 'end_date', 'receipts']
+        fields = ['id', 'user', 'name', 'category', 'filter_categories','limit_amount', 'current_spending', 'start_date', 'end_date', 'receipt_count', 'receipt_ids', 'receipts']
         read_only_fields = ['current_spending']
         extra_kwargs = {'user': {'read_only': True}}
+        expandable_fields = ['receipts']
+
+    def get_receipt_ids(self, budget):
+        return [receipt.pk for receipt in budget.receipts.all()]  # Served from BudgetViewSet's prefetch
+
+    def get_receipt_count(self, budget):
+        return budget.receipts.count()
+
+
+class ReceiptJobSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    receipt = ReceiptSerializer(read_only=True)
+
+    class Meta:
+        model = ReceiptJob
+        fields = ['id', 'status', 'attempts', 'error', 'receipt', 'created_at', 'updated_at']
+        read_only_fields = fields
@@ -0,0 +1,163 @@
+from django.db.models import Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from .analytics import EXPENSES, RECEIPTS, rollup_deltas
+from .authentication import invalidate_cached_user
+from .search import update_document
+from .models import Budget, Expense, Receipt, ReceiptItem, SpendingRollup, User, as_money
+
+
+def _receipt_deltas(budget_rows, before, after):
+    """Spending change for each `(budget_id, filter_categories)` when a receipt moves from `before` to `after`."""
+    deltas = {}
+    for budget_id, filter_categories in budget_rows:
+        delta = as_money(0)
+        if after is not None and Budget.category_counts(filter_categories, after[1]):
+            delta += after[0]
+        if before is not None and Budget.category_counts(filter_categories, before[1]):
+            delta -= before[0]
+        deltas[budget_id] = delta
+    return deltas
+
+
+@receiver(m2m_changed, sender=Receipt.budget.through)
+def track_budget_links(sender, instance, action, reverse, pk_set, **kwargs):
+    """Add or remove a receipt's total from the budgets it is linked to or unlinked from."""
+    if action == "pre_clear":
+        related = instance.receipts if reverse else instance.budget
+        instance._cleared_pks = set(related.values_list("pk", flat=True))
+        return
+    if action == "post_clear":
+        pk_set = instance.__dict__.pop("_cleared_pks", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+    if not pk_set:
+        return
+    sign = 1 if action == "post_add" else -1
+
+    if reverse:
+        # budget.receipts.add(...): total the affected receipts in one query
+        receipts = Receipt.objects.filter(pk__in=pk_set).exclude(total_amount=None)
+        if instance.filter_categories:
+            receipts = receipts.filter(receipt_category__in=instance.filter_categories)
+        total = receipts.aggregate(total=Sum("total_amount"))["total"] or 0
+        Budget.apply_spending_deltas({instance.pk: sign * as_money(total)}, touched=[instance.pk])
+    else:
+        budget_rows = Budget.objects.filter(pk__in=pk_set).values_list("pk", "filter_categories")
+        key = instance.spending_key()
+        deltas = _receipt_deltas(budget_rows, None, key) if sign > 0 else _receipt_deltas(budget_rows, key, None)
+        Budget.apply_spending_deltas(deltas, touched=pk_set)
+
+
+@receiver(pre_save, sender=Receipt)
+def snapshot_receipt_spending(sender, instance, **kwargs):
+    """Remember the stored spending and rollup entry of receipts that were not loaded through from_db."""
+    missing = [name for name in ("_loaded_spending", "_loaded_rollup") if not hasattr(instance, name)]
+    if instance.pk and missing:
+        stored = Receipt.objects.only(*Receipt.SPENDING_FIELDS).filter(pk=instance.pk).first()
+        for name in missing:
+            setattr(instance, name, getattr(stored, name, None))
+
+
+@receiver(post_save, sender=Receipt)
+def track_receipt_spending(sender, instance, created, **kwargs):
+    """Apply the difference when an already linked receipt is edited or re-categorised."""
+    before = instance.__dict__.get("_loaded_spending")
+    after = instance.spending_key()
+    instance._loaded_spending = after
+    if created:
+        return
+    budget_rows = list(Budget.objects.filter(receipts=instance).values_list("pk", "filter_categories"))
+    deltas = {} if before is None or before == after else _receipt_deltas(budget_rows, before, after)
+    Budget.apply_spending_deltas(deltas, touched=[budget_id for budget_id, _ in budget_rows])
+
+
+@receiver(pre_delete, sender=Receipt)
+def release_receipt_spending(sender, instance, **kwargs):
+    """Take a deleted receipt's total back out of its budgets."""
+    budget_rows = list(Budget.objects.filter(receipts=instance).values_list("pk", "filter_categories"))
+    Budget.apply_spending_deltas(
+        _receipt_deltas(budget_rows, instance.spending_key(), None),
+        touched=[budget_id for budget_id, _ in budget_rows],
+    )
+
+
+@receiver(pre_save, sender=Expense)
+def snapshot_expense_rollup(sender, instance, **kwargs):
+    """Remember the stored rollup entry of expenses that were not loaded through from_db."""
+    if instance.pk and not hasattr(instance, "_loaded_rollup"):
+        stored = Expense.objects.only(*Expense.ROLLUP_FIELDS).filter(pk=instance.pk).first()
+        instance._loaded_rollup = stored._loaded_rollup if stored else None
+
+
+@receiver(post_save, sender=Receipt)
+@receiver(post_save, sender=Expense)
+def track_spending_rollup(sender, instance, created, **kwargs):
+    """Move a saved receipt or expense between SpendingRollup rows, or add it to one."""
+    kind = RECEIPTS if sender is Receipt else EXPENSES
+    before = None if created else instance.__dict__.get("_loaded_rollup")
+    after = instance.rollup_entry()
+    instance._loaded_rollup = after
+    if before == after:
+        return
+    deltas = rollup_deltas([after], kind)
+    if before is not None:
+        rollup_deltas([before], kind, sign=-1, deltas=deltas)
+    SpendingRollup.apply_deltas(deltas)
+
+
+@receiver(post_save, sender=Receipt)
+def sync_receipt_items(sender, instance, created, **kwargs):
+    """Mirror a new or changed parsed_items into ReceiptItem rows."""
+    loaded = "_loaded_parsed_items" in instance.__dict__
+    before = instance.__dict__.get("_loaded_parsed_items")
+    instance._loaded_parsed_items = instance.parsed_items
+    if created:
+        ReceiptItem.objects.bulk_create(instance.item_rows())
+    elif not loaded or before != instance.parsed_items:
+        instance.sync_items()
+
+
+@receiver(post_save, sender=Receipt)
+@receiver(post_save, sender=Expense)
+def index_search_document(sender, instance, **kwargs):
+    """Keep the saved receipt or expense searchable; deleting it cascades to its SearchDocument."""
+    update_document(instance)
+
+
+@receiver(post_delete, sender=Receipt)
+@receiver(post_delete, sender=Expense)
+def release_spending_rollup(sender, instance, **kwargs):
+    """Take a deleted receipt or expense back out of its SpendingRollup row."""
+    entry = instance.__dict__.get("_loaded_rollup") or instance.rollup_entry()
+    SpendingRollup.apply_deltas(rollup_deltas([entry], RECEIPTS if sender is Receipt else EXPENSES, sign=-1))
+
+
+@receiver(pre_save, sender=Budget)
+def snapshot_budget_filters(sender, instance, **kwargs):
+    if instance.pk and not hasattr(instance, "_loaded_filter_categories"):
+        stored = Budget.objects.filter(pk=instance.pk).values_list("filter_categories", flat=True).first()
+        instance._loaded_filter_categories = list(stored or []) if stored is not None else None
+
+
+@receiver(post_save, sender=Budget)
+def recompute_on_filter_change(sender, instance, created, **kwargs):
+    """Changing a budget's filter categories changes which linked receipts count, so recompute it once."""
+    before = instance.__dict__.get("_loaded_filter_categories")
+    after = list(instance.filter_categories or [])
+    instance._loaded_filter_categories = after
+    if created:
+        instance.sync_filter_categories()
+    elif before is None or sorted(before) != sorted(after):
+        instance.sync_filter_categories()
+        instance.update_spending()
+    else:
+        Budget.touch([instance.pk])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_jwt_user(sender, instance, **kwargs):
+    """Password changes, deactivation and deletion must reach JWT requests straight away."""
+    invalidate_cached_user(getattr(instance, jwt_settings.USER_ID_FIELD))
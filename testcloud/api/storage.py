@@ -0,0 +1,136 @@
+"""
+Storage for processed receipt images.
+
+Receipts keep only the storage key of their image. Read URLs are signed on
+demand with a short lifetime, and cached until shortly before they expire.
+The backend is selected by settings.RECEIPT_STORAGE.
+"""
+import mimetypes
+import os
+import shutil
+import threading
+from datetime import timedelta
+from azure.storage.blob import BlobSasPermissions, ContentSettings, generate_blob_sas
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils._os import safe_join
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+from .clients import get_blob_service_client
+
+DEFAULT_RECEIPT_STORAGE = {
+    "BACKEND": "api.storage.AzureBlobStorage",
+    "URL_TTL": 3600,  # Seconds a signed read URL stays valid
+    "URL_REFRESH_MARGIN": 300,  # Stop handing out a cached URL this many seconds before it expires
+    "CACHE": "default",
+    "LOCATION": None,  # LocalFileStorage directory, defaults to MEDIA_ROOT/receipt_images
+}
+
+
+def get_storage_settings():
+    """Return the RECEIPT_STORAGE settings merged over the defaults."""
+    return {**DEFAULT_RECEIPT_STORAGE, **getattr(settings, "RECEIPT_STORAGE", {})}
+
+
+class BaseImageStorage:
+    """Stores receipt images under a key and hands out short-lived read URLs for them."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def save(self, key, stream, length, content_type):
+        """Store `length` bytes from `stream` under `key` and return the key."""
+        raise NotImplementedError
+
+    def sign(self, key, ttl):
+        """Return a URL that allows reading `key` for `ttl` seconds."""
+        raise NotImplementedError
+
+    def url(self, key):
+        """Return a read URL for `key`, reusing a cached signature while it has enough life left."""
+        cache = caches[self.config["CACHE"]]
+        cache_key = f"receipt-image-url:{type(self).__name__}:{key}"
+        url = cache.get(cache_key)
+        if url is None:
+            url = self.sign(key, self.config["URL_TTL"])
+            cache.set(cache_key, url, timeout=self.config["URL_TTL"] - self.config["URL_REFRESH_MARGIN"])
+        return url
+
+
+class AzureBlobStorage(BaseImageStorage):
+    """Azure Blob Storage container from settings.AZURE_STORAGE, read through SAS URLs."""
+
+    def save(self, key, stream, length, content_type):
+        blob_client = get_blob_service_client().get_blob_client(container=settings.AZURE_STORAGE["CONTAINER"], blob=key)
+        # Content settings travel with the upload instead of a separate set_http_headers call
+        blob_client.upload_blob(stream, length=length, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+        return key
+
+    def sign(self, key, ttl):
+        config = settings.AZURE_STORAGE
+        sas_token = generate_blob_sas(
+            account_name=config["ACCOUNT_NAME"],
+            container_name=config["CONTAINER"],
+            blob_name=key,
+            account_key=config["ACCOUNT_KEY"],
+            permission=BlobSasPermissions(read=True),
+            expiry=now() + timedelta(seconds=ttl),
+        )
+        return f"https://{config['ACCOUNT_NAME']}.blob.core.windows.net/{config['CONTAINER']}/{key}?{sas_token}"
+
+
+class LocalFileStorage(BaseImageStorage):
+    """
+    Files under a local directory, served by ReceiptImageView through signed
+    URLs. For development, tests and benchmarks; runs without network access.
+    """
+    salt = "api.storage.LocalFileStorage"
+
+    @property
+    def location(self):
+        return self.config["LOCATION"] or os.path.join(settings.MEDIA_ROOT, "receipt_images")
+
+    def path(self, key):
+        return safe_join(self.location, key)
+
+    def save(self, key, stream, length, content_type):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as destination:
+            shutil.copyfileobj(stream, destination)
+        return key
+
+    def sign(self, key, ttl):
+        token = signing.dumps(key, salt=self.salt)
+        return reverse("receipt-image", args=[token])
+
+    def open(self, token):
+        """Return `(file, content_type)` for a token from sign(), or raise signing.BadSignature."""
+        key = signing.loads(token, salt=self.salt, max_age=self.config["URL_TTL"])
+        return open(self.path(key), "rb"), mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_image_storage():
+    """Return the process-wide storage backend configured in RECEIPT_STORAGE."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            config = get_storage_settings()
+            _storage = import_string(config["BACKEND"])(config)
+        return _storage
+
+
+@receiver(setting_changed)
+def reset_image_storage(*, setting, **kwargs):
+    global _storage
+    if setting in ("RECEIPT_STORAGE", "MEDIA_ROOT"):
+        with _storage_lock:
+            _storage = None
@@ -1,12 +1,57 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Expense, Receipt, Budget
-from datetime import date
-from .models import CategoryChoices
-from io import BytesIO
+from .models import Budget, CategoryChoices, Expense, Receipt, ReceiptImageCache, ReceiptItem, ReceiptJob, SearchDocument, SpendingRollup
+from datetime import date, datetime, timedelta
+from django.utils import timezone
+from io import BytesIO, StringIO
+from decimal import Decimal
+from django.core.management import CommandError, call_command
+from django.core.cache import caches
 from openpyxl import load_workbook
+from unittest import mock, skipUnless
+from django.db import IntegrityError, connection, transaction
+from rest_framework_simplejwt.tokens import RefreshToken
+from django.test.utils import CaptureQueriesContext
+import csv
+import json
+import hashlib
+import tempfile
+from azure.ai.documentintelligence.models import AnalyzeResult
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+from .budgeting import link_budget_to_receipts, link_receipts_to_budgets
+from .jobs import get_job_settings, ready_job_ids, run_job
+from .processing import (
+    ReceiptProcessingError,
+    _map_concurrently,
+    compress_image,
+    create_receipt_from_result,
+    create_receipts_from_results,
+    get_image_cache_stats,
+    process_receipt,
+    read_receipt_image,
+)
+from .imaging import ImageRejected, preprocess_image
+from .clients import close_clients, get_blob_service_client, get_connection_stats, get_document_intelligence_client, get_http_session
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import os
+import random
+import shutil
+from urllib.parse import parse_qs, urlsplit
+from .storage import get_image_storage, get_storage_settings
+from .analysis import ParsedItem, ParsedReceipt, get_receipt_analyser
+from . import metrics
+from .benchmarks import compare_results
+from .seeding import SEED_PASSWORD, parse_distribution, seed_dataset
+from .analytics import rebuild_spending_rollups
+from .search import search_documents
+from .authentication import CachedBasicAuthentication, CachedJWTAuthentication, VerifiedCredentialCache, invalidate_cached_user
+from rest_framework.authentication import BasicAuthentication
+import base64
+import time
 
 User = get_user_model()
 
@@ -65,7 +110,7 @@ class ExpenseTests(TestCase):
         """Ensure expenses are listed for the authenticated user."""
         response = self.client.get('/api/expenses/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
 '''
 class BudgetTests(TestCase):
@@ -101,7 +146,7 @@ class BudgetTests(TestCase):
         """Ensure only the authenticated user's budgets are listed."""
         response = self.client.get('/api/budgets/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
         
     
     def test_budget_filtering_receipts(self):
@@ -163,7 +208,7 @@ class ReceiptTests(TestCase):
         """Ensure only the authenticated user's receipts are listed."""
         response = self.client.get('/api/receipts/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
 
 class ProcessReceiptTests(TestCase):
@@ -243,3 +288,1448 @@ class ExportReceiptsXlsxViewTest(TestCase):
         self.assertEqual(sheet.cell(row=3, column=3).value, "30.00")  # Second receipt amount
 
         print("Exported Receipts:", sheet_headers)  # Debugging
+
+    def test_export_receipts_csv_is_streamed(self):
+        """Ensure the CSV export streams one line per row."""
+        self.receipt1.parsed_items = [
+            {"description": {"value": "Soup"}, "total_price": {"value": "12.00"}},
+            {"description": {"value": "Bread"}, "total_price": {"value": "8.00"}},
+        ]
+        self.receipt1.save()
+        response = self.client.get(f'/api/export/budget/{self.budget.id}/?export_format=csv')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "ID,Merchant,Total Amount,Transaction Date,Receipt Category,Item Name,Item Price")
+        self.assertEqual(lines[1].split(",")[2:], ["20.00", "10/02/2024", "Meal", "Soup", "12.00"])
+        self.assertEqual(lines[2], ",,,,,Bread,8.00")
+        self.assertEqual(len(lines), 4)
+
+    def test_streamed_xlsx_export_sizes_columns(self):
+        response = self.client.get('/api/export/receipts/?stream=true')
+        self.assertTrue(response.streaming)
+        sheet = load_workbook(BytesIO(b"".join(response.streaming_content))).active
+        self.assertEqual(sheet.max_row, 3)
+        self.assertEqual(sheet.column_dimensions["C"].width, len("Total Amount") + 2)
+
+
+def make_analyze_result(merchant="Cafe", total=7.5, category="Meal", items=(("Coffee", 3.5), ("Bagel", 4.0))):
+    """Build an AnalyzeResult shaped like the prebuilt receipt model output."""
+    return AnalyzeResult({
+        "apiVersion": "2024-11-30",
+        "modelId": "prebuilt-receipt",
+        "content": "",
+        "documents": [{
+            "docType": "receipt",
+            "confidence": 1.0,
+            "fields": {
+                "MerchantName": {"type": "string", "valueString": merchant},
+                "Total": {"type": "currency", "valueCurrency": {"amount": total}},
+                "TransactionDate": {"type": "date", "valueDate": "2024-02-10"},
+                "ReceiptType": {"type": "string", "valueString": category},
+                "Items": {"type": "array", "valueArray": [
+                    {"type": "object", "valueObject": {
+                        "Description": {"type": "string", "valueString": description},
+                        "TotalPrice": {"type": "currency", "valueCurrency": {"amount": price}},
+                    }} for description, price in items
+                ]},
+            },
+        }],
+    })
+
+
+def make_parsed_receipt(**kwargs):
+    return ParsedReceipt.from_analyze_result(make_analyze_result(**kwargs))
+
+
+def make_image_upload(name="receipt.png", color="white"):
+    buffer = BytesIO()
+    Image.new("RGB", (20, 20), color).save(buffer, format="PNG")
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+
+@override_settings(
+    RECEIPT_JOBS={'BACKEND': 'api.jobs.InlineJobBackend', 'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 0},
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class ReceiptJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="jobuser@example.com", password="jobpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("api.processing.analyse_receipt_image", return_value=make_parsed_receipt())
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_async_upload_is_processed_in_background(self, upload, analyse):
+        """Ensure job mode answers 202 and the worker creates the receipt and expenses."""
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post('/api/process-receipt/?async=true', {'image': make_image_upload()}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], ReceiptJob.Status.PENDING)
+        upload.assert_not_called()
+
+        for callback in callbacks:
+            callback()
+
+        response = self.client.get(f"/api/receipt-jobs/{response.data['id']}/")
+        self.assertEqual(response.data['status'], ReceiptJob.Status.SUCCEEDED)
+        self.assertEqual(response.data['receipt']['merchant'], "Cafe")
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 2)
+        self.assertFalse(ReceiptJob.objects.get().image_file)
+
+    @mock.patch("api.processing.analyse_receipt_image", side_effect=[RuntimeError("timeout"), make_parsed_receipt()])
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_failed_attempt_is_retried(self, upload, analyse):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/process-receipt/', {'image': make_image_upload(), 'async': 'true'}, format='multipart')
+        job = ReceiptJob.objects.get(pk=response.data['id'])
+        self.assertEqual(job.status, ReceiptJob.Status.SUCCEEDED)
+        self.assertEqual(job.attempts, 2)
+
+    @mock.patch("api.processing.analyse_receipt_image", side_effect=RuntimeError("service unavailable"))
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_job_fails_after_max_attempts(self, upload, analyse):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/process-receipt/?async=1', {'image': make_image_upload()}, format='multipart')
+        job = ReceiptJob.objects.get(pk=response.data['id'])
+        self.assertEqual(job.status, ReceiptJob.Status.FAILED)
+        self.assertEqual(job.error, "service unavailable")
+        self.assertEqual(analyse.call_count, 2)
+
+    def make_job(self, **fields):
+        return ReceiptJob.objects.create(user=self.user, image_file=make_image_upload(), **fields)
+
+    @mock.patch("api.processing.analyse_receipt_image", return_value=make_parsed_receipt())
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_job_abandoned_by_its_worker_is_requeued_after_the_lease(self, upload, analyse):
+        expired = timezone.now() - timedelta(seconds=get_job_settings()["LEASE"] + 1)
+        abandoned = self.make_job(status=ReceiptJob.Status.RUNNING, attempts=1, claimed_at=expired)
+        busy = self.make_job(status=ReceiptJob.Status.RUNNING, attempts=1, claimed_at=timezone.now())
+        self.assertEqual(ready_job_ids(10), [abandoned.pk])
+
+        self.assertIsNone(run_job(busy.pk))
+        analyse.assert_not_called()
+        run_job(abandoned.pk)
+        abandoned.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.attempts), (ReceiptJob.Status.SUCCEEDED, 2))
+
+        last_try = self.make_job(status=ReceiptJob.Status.RUNNING, attempts=2, claimed_at=expired)
+        run_job(last_try.pk)
+        last_try.refresh_from_db()
+        self.assertEqual(last_try.status, ReceiptJob.Status.FAILED)
+        self.assertEqual(analyse.call_count, 1)
+
+    @mock.patch("api.processing.analyse_receipt_image", side_effect=RuntimeError("timeout"))
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_retry_is_scheduled_not_slept(self, upload, analyse):
+        job = self.make_job()
+        with self.settings(RECEIPT_JOBS={'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 60}):
+            self.assertEqual(run_job(job.pk), 60)
+            job.refresh_from_db()
+            self.assertEqual(job.status, ReceiptJob.Status.PENDING)
+            self.assertGreater(job.available_at, timezone.now() + timedelta(seconds=50))
+            self.assertEqual(ready_job_ids(10), [])
+            self.assertIsNone(run_job(job.pk))  # Not due yet
+        self.assertEqual(analyse.call_count, 1)
+
+    def test_jobs_are_scoped_to_user(self):
+        other = User.objects.create_user(email="other@example.com", password="otherpass")
+        job = ReceiptJob.objects.create(user=other, image_url="https://example.com/r.jpg")
+        response = self.client.get(f"/api/receipt-jobs/{job.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProcessReceiptBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="batchuser@example.com", password="batchpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("api.processing.get_http_session", return_value=mock.MagicMock(**{"get.return_value.__enter__.return_value.status_code": 404}))
+    @mock.patch("api.processing.analyse_receipt_image", return_value=make_parsed_receipt())
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_batch_reports_per_item_results(self, upload, analyse, download):
+        """Ensure every source gets a result and successful ones are written in bulk."""
+        response = self.client.post('/api/process-receipts/batch/', {
+            'images': [make_image_upload("a.png"), make_image_upload("b.png")],
+            'image_urls': ["https://example.com/missing.jpg"],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([r['status'] for r in response.data['results']], ["created", "created", "failed"])
+        self.assertEqual(response.data['results'][2]['error'], "Failed to download image from URL.")
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 4)
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post('/api/process-receipts/batch/', {}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ReceiptImageCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="cacheuser@example.com", password="cachepass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("api.processing.analyse_receipt_image", return_value=make_parsed_receipt())
+    @mock.patch("api.processing.store_receipt_image", return_value="r.jpg")
+    def test_repeat_upload_skips_upload_and_analysis(self, upload, analyse):
+        """Ensure a re-uploaded image is served from the content-hash cache."""
+        before = get_image_cache_stats()
+        for _ in range(2):
+            response = self.client.post('/api/process-receipt/', {'image': make_image_upload()}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data['merchant'], "Cafe")
+
+        self.assertEqual(upload.call_count, 1)
+        self.assertEqual(analyse.call_count, 1)
+        blob_name = upload.call_args.args[1]
+        entry = ReceiptImageCache.objects.get()
+        self.assertEqual(blob_name, f"{entry.content_hash}.jpg")
+        self.assertEqual(entry.hits, 1)
+        after = get_image_cache_stats()
+        self.assertEqual(after["hits"] - before["hits"], 1)
+        self.assertEqual(after["misses"] - before["misses"], 1)
+
+
+class BudgetSpendingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="spender@example.com", password="spendpass")
+        self.budget = Budget.objects.create(
+            user=self.user,
+            name="Meals",
+            filter_categories=[CategoryChoices.MEAL.value],
+            limit_amount=500,
+            start_date="2024-02-01",
+            end_date="2024-02-28",
+        )
+        self.receipt = Receipt.objects.create(
+            user=self.user,
+            total_amount=Decimal("20.10"),
+            transaction_date="2024-02-10T00:00:00Z",
+            receipt_category=CategoryChoices.MEAL.value,
+        )
+        self.receipt.budget.add(self.budget)
+
+    def assertSpending(self, amount):
+        self.budget.refresh_from_db()
+        self.assertEqual(self.budget.current_spending, Decimal(amount))
+
+    def test_spending_follows_receipt_changes(self):
+        """Ensure current_spending is maintained on add, edit, re-categorise and delete."""
+        self.assertSpending("20.10")
+
+        receipt = Receipt.objects.get(pk=self.receipt.pk)
+        receipt.total_amount = Decimal("25.35")
+        receipt.save()
+        self.assertSpending("25.35")
+
+        receipt.receipt_category = CategoryChoices.HEALTHCARE.value  # Not in filter categories
+        receipt.save()
+        self.assertSpending("0.00")
+
+        receipt.receipt_category = CategoryChoices.MEAL.value
+        receipt.save()
+        other = Receipt.objects.create(user=self.user, total_amount=Decimal("0.20"), receipt_category=CategoryChoices.MEAL.value)
+        self.budget.receipts.add(other)
+        self.assertSpending("25.55")
+
+        receipt.delete()
+        self.assertSpending("0.20")
+
+    def test_filter_change_recomputes(self):
+        self.budget.filter_categories = [CategoryChoices.HOTEL.value]
+        self.budget.save()
+        self.assertSpending("0.00")
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        Budget.objects.filter(pk=self.budget.pk).update(current_spending=Decimal("99.00"))
+        output = StringIO()
+        call_command("reconcile_budget_spending", stdout=output)
+        self.assertIn("drift 78.90", output.getvalue())
+        self.assertSpending("99.00")
+
+        call_command("reconcile_budget_spending", "--fix", stdout=StringIO())
+        self.assertSpending("20.10")
+
+
+class BudgetMatchingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="matcher@example.com", password="matchpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def make_budget(self, **kwargs):
+        fields = dict(user=self.user, limit_amount=500, start_date="2024-02-01", end_date="2024-02-28")
+        fields.update(kwargs)
+        return Budget.objects.create(**fields)
+
+    def make_receipt(self, category, total="10.00", day="2024-02-10"):
+        return Receipt.objects.create(user=self.user, total_amount=Decimal(total), transaction_date=f"{day}T12:00:00Z", receipt_category=category)
+
+    def test_assign_matches_by_period_and_category(self):
+        """Ensure only budgets covering the date with an allowed category are linked."""
+        meals = self.make_budget(filter_categories=[CategoryChoices.MEAL.value])
+        everything = self.make_budget()
+        self.make_budget(filter_categories=[CategoryChoices.COMMUNICATION_SUBSCRIPTIONS.value])
+        self.make_budget(start_date="2024-03-01", end_date="2024-03-31")
+
+        receipt = self.make_receipt(CategoryChoices.MEAL.value, total="12.34")
+        receipt.assign_to_budget()
+
+        self.assertEqual(set(receipt.budget.values_list("pk", flat=True)), {meals.pk, everything.pk})
+        meals.refresh_from_db()
+        self.assertEqual(meals.current_spending, Decimal("12.34"))
+
+    def test_assign_query_count_does_not_grow_with_budgets(self):
+        for _ in range(10):
+            self.make_budget()
+        receipt = self.make_receipt(CategoryChoices.MEAL.value)
+        with self.assertNumQueries(5):  # match, lock, existing links, bulk insert, spending update
+            receipt.assign_to_budget()
+        self.assertEqual(receipt.budget.count(), 10)
+
+    def test_link_inserted_concurrently_is_not_counted_twice(self):
+        budget = self.make_budget()
+        receipt = self.make_receipt(CategoryChoices.MEAL.value, total="3.00")
+        budget.receipts.add(receipt)  # Inserted after this caller decided the link was missing
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            link_receipts_to_budgets([receipt], created=True)
+        budget.refresh_from_db()
+        self.assertEqual(budget.current_spending, Decimal("3.00"))
+
+    def test_new_budget_picks_up_existing_receipts(self):
+        self.make_receipt(CategoryChoices.MEAL.value, total="5.00")
+        self.make_receipt(CategoryChoices.HOTEL.value, total="50.00")
+        self.make_receipt(CategoryChoices.MEAL.value, total="7.00", day="2024-04-01")
+
+        response = self.client.post('/api/budgets/', {
+            'name': "Food",
+            'filter_categories': [CategoryChoices.MEAL.value],
+            'limit_amount': "100.00",
+            'start_date': "2024-02-01",
+            'end_date': "2024-02-28",
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        budget = Budget.objects.get(pk=response.data['id'])
+        self.assertEqual(budget.receipts.count(), 1)
+        self.assertEqual(budget.current_spending, Decimal("5.00"))
+
+
+    def test_new_budget_links_what_receipt_matching_would(self):
+        """Ensure retroactive linking covers both period ends and the upload-time fallback, and keeps other links."""
+        first = self.make_receipt(CategoryChoices.MEAL.value, total="1.00", day="2024-02-01")
+        last = self.make_receipt(CategoryChoices.MEAL.value, total="2.00", day="2024-02-28")
+        self.make_receipt(CategoryChoices.MEAL.value, total="4.00", day="2024-03-01")
+        hotel = self.make_receipt(CategoryChoices.HOTEL.value, total="8.00")
+        undated = self.make_receipt(CategoryChoices.MEAL.value, total="16.00")
+        Receipt.objects.filter(pk=undated.pk).update(transaction_date=None, uploaded_at="2024-02-15T12:00:00Z")
+        other = self.make_budget(name="Manual", start_date="2023-01-01", end_date="2023-01-31")
+        other.receipts.add(first)
+
+        budget = self.make_budget(filter_categories=[CategoryChoices.MEAL.value])
+        link_budget_to_receipts(budget)
+
+        self.assertEqual(set(budget.receipts.values_list("pk", flat=True)), {first.pk, last.pk, undated.pk})
+        self.assertEqual(Budget.objects.get(pk=budget.pk).current_spending, Decimal("19.00"))
+        self.assertIn(other.pk, set(first.budget.values_list("pk", flat=True)))
+        self.assertFalse(hotel.budget.filter(pk=budget.pk).exists())
+
+class BudgetReportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="reporter@example.com", password="reportpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.budget = Budget.objects.create(user=self.user, limit_amount=500, start_date="2024-02-01", end_date="2024-02-28")
+        caches['reports'].clear()
+
+    def add_receipts(self, count, category=CategoryChoices.MEAL.value, parsed_items=None):
+        for _ in range(count):
+            receipt = Receipt.objects.create(user=self.user, total_amount=Decimal("2.50"), receipt_category=category, parsed_items=parsed_items)
+            receipt.budget.add(self.budget)
+
+    def test_report_totals_are_aggregated_per_category(self):
+        """Ensure spending and item counts match the per-receipt rules."""
+        two_items = [{"description": {"value": "Tea"}}, {"description": {"value": "Cake"}}]
+        self.add_receipts(2, parsed_items=two_items)
+        self.add_receipts(1, parsed_items=[])
+        self.add_receipts(1, category=CategoryChoices.HOTEL.value)
+
+        response = self.client.get(f'/api/budget-report/{self.budget.id}/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_spent'], Decimal("10.00"))
+        self.assertEqual(response.data['category_spending'], {"Meal": Decimal("7.50"), "Hotel": Decimal("2.50")})
+        self.assertEqual(response.data['category_items'], {"Meal": 5, "Hotel": 1})
+        self.assertEqual(response.data['total_items'], 6)
+        self.assertEqual(response.data['receipts_count'], 4)
+        self.assertNotIn('receipts', response.data['budget'])
+
+    def test_report_query_count_is_constant(self):
+        self.add_receipts(3)
+        with self.assertNumQueries(4):  # budget, aggregate, receipt count, receipt page
+            self.client.get(f'/api/budget-report/{self.budget.id}/?page_size=2')
+        self.add_receipts(30)
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/budget-report/{self.budget.id}/?page_size=2')
+        self.assertEqual(len(response.data['receipts']), 2)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/budget-report/{self.budget.id}/?include_receipts=false')
+        self.assertNotIn('receipts', response.data)
+
+
+class BudgetReportCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="snapshot@example.com", password="snappass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.budget = Budget.objects.create(user=self.user, limit_amount=500, start_date="2024-02-01", end_date="2024-02-28")
+        self.receipt = Receipt.objects.create(user=self.user, merchant="Bakery", total_amount=Decimal("4.00"))
+        self.receipt.budget.add(self.budget)
+        self.url = f'/api/budget-report/{self.budget.id}/'
+        caches['reports'].clear()
+
+    def test_snapshot_is_reused_until_a_linked_receipt_changes(self):
+        """Ensure repeat hits are served from the cache and receipt edits invalidate it."""
+        first = self.client.get(self.url)
+        with self.assertNumQueries(1):  # Only the budget lookup
+            second = self.client.get(self.url)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(second.data['receipts'][0]['merchant'], "Bakery")
+
+        receipt = Receipt.objects.get(pk=self.receipt.pk)
+        receipt.merchant = "Cafe"
+        receipt.save()
+        third = self.client.get(self.url)
+        self.assertNotEqual(third['ETag'], first['ETag'])
+        self.assertEqual(third.data['receipts'][0]['merchant'], "Cafe")
+
+        unlinked = Receipt.objects.create(user=self.user, total_amount=Decimal("1.00"))
+        self.budget.receipts.add(unlinked)
+        self.assertEqual(self.client.get(self.url).data['total_spent'], Decimal("5.00"))
+
+    def test_conditional_requests_get_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertIn('Last-Modified', response)
+        not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual((not_modified['ETag'], not_modified['Last-Modified']), (response['ETag'], response['Last-Modified']))
+        not_modified = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        self.budget.name = "Renamed"
+        self.budget.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_200_OK)
+
+    def test_validators_roll_over_with_the_url_signing_window(self):
+        """Ensure a revalidation after the image URLs' signing window gets a fresh body, not a 304."""
+        response = self.client.get(self.url)
+        later = time.time() + get_storage_settings()['URL_REFRESH_MARGIN']
+        with mock.patch("api.views.time.time", return_value=later):
+            refreshed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(refreshed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(refreshed['ETag'], response['ETag'])
+
+        without_receipts = f'{self.url}?include_receipts=false'
+        response = self.client.get(without_receipts)
+        with mock.patch("api.views.time.time", return_value=later):
+            not_modified = self.client.get(without_receipts, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_reconcile_fix_invalidates_the_snapshot(self):
+        Budget.objects.filter(pk=self.budget.pk).update(current_spending=Decimal("9.00"))
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['budget']['current_spending'], "9.00")
+
+        call_command("reconcile_budget_spending", "--fix", stdout=StringIO())
+        refreshed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(refreshed.status_code, status.HTTP_200_OK)
+        self.assertEqual(refreshed.data['budget']['current_spending'], "4.00")
+
+    def test_file_based_backend(self):
+        location = tempfile.mkdtemp()
+        file_caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'reports': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }
+        with self.settings(CACHES=file_caches):
+            self.client.get(self.url)
+            with self.assertNumQueries(1):
+                response = self.client.get(self.url)
+        self.assertEqual(response.data['total_spent'], Decimal("4.00"))
+
+
+class BudgetListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="lister@example.com", password="listpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def add_budgets(self, count, receipts_each=3):
+        for _ in range(count):
+            budget = Budget.objects.create(user=self.user, limit_amount=100, start_date="2024-02-01", end_date="2024-02-28")
+            for _ in range(receipts_each):
+                receipt = Receipt.objects.create(user=self.user, total_amount=Decimal("1.00"), parsed_items=[{"description": {"value": "x"}}])
+                receipt.budget.add(budget)
+
+    def test_list_query_count_is_fixed(self):
+        """Ensure listing budgets costs the same number of queries for 1 or 10 budgets."""
+        self.add_budgets(1)
+        with self.assertNumQueries(2):
+            self.client.get('/api/budgets/')
+        self.add_budgets(9)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/budgets/')
+        with self.assertNumQueries(2):
+            self.client.get('/api/budgets/?expand=receipts')
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_lean_representation_and_field_selection(self):
+        self.add_budgets(1, receipts_each=2)
+        budget = self.client.get('/api/budgets/').data['results'][0]
+        self.assertEqual(budget['receipt_count'], 2)
+        self.assertEqual(len(budget['receipt_ids']), 2)
+        self.assertNotIn('receipts', budget)
+
+        budget = self.client.get('/api/budgets/?expand=receipts').data['results'][0]
+        self.assertEqual(budget['receipts'][0]['parsed_items'], [{"description": {"value": "x"}}])
+
+        budget = self.client.get('/api/budgets/?fields=id,name').data['results'][0]
+        self.assertEqual(set(budget), {'id', 'name'})
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="pager@example.com", password="pagepass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def collect(self, url):
+        pages, ids = 0, []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [row['id'] for row in response.data['results']]
+            url, pages = response.data['next'], pages + 1
+        return ids, pages
+
+    def test_walks_expenses_with_duplicate_and_null_dates(self):
+        """Ensure every expense is returned exactly once, newest first, with undated ones last."""
+        dates = ["2024-01-03", "2024-01-02", "2024-01-02", None, "2024-01-02", None, "2024-01-01"]
+        for date in dates:
+            Expense.objects.create(user=self.user, amount=1, category="Meal", date=date)
+        expected = list(Expense.objects.filter(date__isnull=False).order_by('-date', '-id').values_list('id', flat=True))
+        expected += list(Expense.objects.filter(date__isnull=True).order_by('-id').values_list('id', flat=True))
+
+        ids, pages = self.collect('/api/expenses/?page_size=2')
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 4)
+
+    def test_previous_link_returns_the_earlier_page(self):
+        now_ = timezone.now()
+        for offset in range(5):
+            Receipt.objects.create(user=self.user, total_amount=1, uploaded_at=now_ - timedelta(minutes=offset))
+        first = self.client.get('/api/receipts/?page_size=2')
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual([r['id'] for r in back.data['results']], [r['id'] for r in first.data['results']])
+        self.assertIsNone(first.data['previous'])
+
+    @skipUnless(connection.vendor == "sqlite", "Reads SQLite query plans")
+    def test_page_cost_does_not_grow_with_depth(self):
+        """Ensure a deep page seeks to its cursor on the index instead of scanning the user's earlier rows."""
+        now_ = timezone.now()
+        for offset in range(6):
+            Receipt.objects.create(user=self.user, total_amount=1, uploaded_at=now_ - timedelta(minutes=offset))
+            Expense.objects.create(user=self.user, amount=1, category="Meal", date=date(2024, 1, 1 + offset % 3))
+        Expense.objects.create(user=self.user, amount=1, category="Meal")
+
+        for url, column in (('/api/receipts/?page_size=2', 'uploaded_at'), ('/api/expenses/?page_size=2', 'date')):
+            url = self.client.get(url).data['next']
+            url = self.client.get(url).data['next']
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            page_queries = [q['sql'] for q in queries if 'ORDER BY' in q['sql']]
+            self.assertTrue(page_queries)
+            for sql in page_queries:  # The dated rows after the cursor, then (for expenses) the undated ones
+                with connection.cursor() as cursor:
+                    cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                    plan = " ".join(row[-1] for row in cursor.fetchall())
+                self.assertRegex(plan, rf"USING (COVERING )?INDEX \w+ \(user_id=\? AND {column}[<>=]")
+
+    def test_rejects_tampered_cursor(self):
+        response = self.client.get('/api/receipts/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ReceiptWriteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="writer@example.com", password="writepass")
+        Budget.objects.create(user=self.user, limit_amount=100, start_date="2024-02-01", end_date="2024-02-29")
+
+    def test_query_count_does_not_grow_with_items(self):
+        small = make_parsed_receipt(items=[("Item", 1.0)] * 2)
+        large = make_parsed_receipt(items=[("Item", 1.0)] * 40)
+        with CaptureQueriesContext(connection) as small_queries:
+            create_receipt_from_result(self.user, None, small)
+        with CaptureQueriesContext(connection) as large_queries:
+            create_receipt_from_result(self.user, None, large)
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 42)
+
+    def test_failure_leaves_no_partial_rows(self):
+        """Ensure a failure while linking budgets rolls back the receipt and its expenses."""
+        with mock.patch("api.processing.link_receipts_to_budgets", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                create_receipt_from_result(self.user, None, make_parsed_receipt())
+        self.assertFalse(Receipt.objects.exists())
+        self.assertFalse(Expense.objects.exists())
+
+    def test_benchmark_command_reports_both_paths(self):
+        out = StringIO()
+        call_command("benchmark", "receipt_write", "--repeat", "1", stdout=out)
+        result = json.loads(out.getvalue())["results"]["receipt_write"]
+        self.assertEqual(set(result), {"items", "per_item", "bulk"})
+        self.assertFalse(User.objects.filter(email__startswith="benchmark-").exists())
+
+
+@override_settings(RECEIPT_IMAGES={'MAX_DIMENSION': 100, 'MAX_PIXELS': 1_000_000, 'WORKERS': 0})
+class ImagePreprocessingTests(TestCase):
+    def jpeg(self, size, **save_options):
+        buffer = BytesIO()
+        Image.new("RGB", size, "white").save(buffer, format="JPEG", **save_options)
+        return buffer.getvalue()
+
+    def test_downscales_to_max_dimension(self):
+        output = Image.open(BytesIO(preprocess_image(self.jpeg((600, 300)))))
+        self.assertEqual(output.size, (100, 50))
+        self.assertEqual(output.format, "JPEG")
+
+    def test_applies_exif_orientation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees clockwise
+        output = Image.open(BytesIO(preprocess_image(self.jpeg((80, 40), exif=exif))))
+        self.assertEqual(output.size, (40, 80))
+
+    def test_rejects_oversized_and_unreadable_images(self):
+        """Ensure decompression bombs and garbage are rejected before being decoded."""
+        with self.assertRaises(ImageRejected):
+            preprocess_image(self.jpeg((1001, 1000)))
+        with self.assertRaises(ImageRejected):
+            preprocess_image(b"not an image")
+        with self.assertRaises(ReceiptProcessingError):
+            compress_image(BytesIO(b"not an image"))
+
+    def test_runs_on_process_pool(self):
+        with self.settings(RECEIPT_IMAGES={'MAX_DIMENSION': 100, 'WORKERS': 1}):
+            output = Image.open(BytesIO(preprocess_image(self.jpeg((300, 300)))))
+            spooled = read_receipt_image(image_file=BytesIO(self.jpeg((200, 400))))
+            self.addCleanup(spooled.close)
+            from_path = Image.open(BytesIO(preprocess_image(spooled.file)))  # Handed over by path
+        self.assertEqual(output.size, (100, 100))
+        self.assertEqual(from_path.size, (50, 100))
+
+
+class ClientRegistryTests(TestCase):
+    def tearDown(self):
+        close_clients()
+
+    def test_clients_are_created_once_per_process(self):
+        self.assertIs(get_blob_service_client(), get_blob_service_client())
+        self.assertIs(get_document_intelligence_client(), get_document_intelligence_client())
+        session = get_http_session()
+        self.assertIs(session, get_http_session())
+        close_clients()
+        self.assertIsNot(session, get_http_session())
+
+    def test_keep_alive_connections_are_reused(self):
+        """Ensure consecutive downloads from one host share a single connection."""
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/receipt.jpg"
+
+        before = get_connection_stats()
+        for _ in range(3):
+            image = read_receipt_image(image_url=url)
+            self.assertEqual(image.file.read(), b"ok")
+            image.close()
+        after = get_connection_stats()
+        self.assertEqual(after["requests"] - before["requests"], 3)
+        self.assertEqual(after["connections_opened"] - before["connections_opened"], 1)
+
+
+@override_settings(RECEIPT_IMAGES={'MAX_BYTES': 1000, 'CHUNK_SIZE': 64, 'WORKERS': 0})
+class ImageIngestionTests(TestCase):
+    def remote(self, chunks, headers):
+        response = mock.MagicMock(status_code=200, headers=headers)
+        response.iter_content.return_value = iter(chunks)
+        session = mock.MagicMock(**{"get.return_value.__enter__.return_value": response})
+        return mock.patch("api.processing.get_http_session", return_value=session)
+
+    def test_upload_is_spooled_and_hashed(self):
+        data = bytes(range(256)) * 3
+        image = read_receipt_image(image_file=BytesIO(data))
+        self.addCleanup(image.close)
+        self.assertEqual(image.content_hash, hashlib.sha256(data).hexdigest())
+        self.assertEqual(image.size, len(data))
+        self.assertEqual(image.file.read(), data)
+
+    def test_download_streams_in_chunks(self):
+        with self.remote([b"a" * 64, b"b" * 10], {"Content-Type": "image/jpeg"}) as session:
+            image = read_receipt_image(image_url="https://example.com/r.jpg")
+        self.addCleanup(image.close)
+        self.assertEqual(image.file.read(), b"a" * 64 + b"b" * 10)
+        session.return_value.get.assert_called_once_with("https://example.com/r.jpg", timeout=10, stream=True)
+
+    def test_oversized_images_are_rejected(self):
+        """Ensure the byte cap applies from Content-Length, while streaming, and to uploads."""
+        with self.remote([], {"Content-Type": "image/jpeg", "Content-Length": "5000"}):
+            with self.assertRaisesMessage(ReceiptProcessingError, "larger than"):
+                read_receipt_image(image_url="https://example.com/r.jpg")
+        with self.remote([b"x" * 600, b"x" * 600], {"Content-Type": "image/jpeg"}):
+            with self.assertRaisesMessage(ReceiptProcessingError, "larger than"):
+                read_receipt_image(image_url="https://example.com/r.jpg")
+        with self.assertRaisesMessage(ReceiptProcessingError, "larger than"):
+            read_receipt_image(image_file=BytesIO(b"x" * 1001))
+
+    def test_non_image_content_type_is_rejected_before_reading(self):
+        with self.remote([b"<html>"], {"Content-Type": "text/html; charset=utf-8"}) as session:
+            with self.assertRaisesMessage(ReceiptProcessingError, "does not point to an image"):
+                read_receipt_image(image_url="https://example.com/page")
+        session.return_value.get.return_value.__enter__.return_value.iter_content.assert_not_called()
+
+
+class ReceiptImageStorageTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        override = self.settings(RECEIPT_STORAGE={'BACKEND': 'api.storage.LocalFileStorage', 'LOCATION': self.location})
+        override.enable()
+        self.addCleanup(override.disable)
+        caches['default'].clear()
+        self.user = User.objects.create_user(email="storage@example.com", password="storagepass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_local_images_are_served_through_signed_urls(self):
+        get_image_storage().save("abc.jpg", BytesIO(b"jpeg-bytes"), 10, "image/jpeg")
+        receipt = Receipt.objects.create(user=self.user, image_key="abc.jpg", total_amount=1)
+
+        image_url = self.client.get(f'/api/receipts/{receipt.pk}/').data['image_url']
+        self.assertTrue(image_url.startswith("http://testserver/api/receipt-images/"))
+
+        anonymous = APIClient()
+        response = anonymous.get(image_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], "image/jpeg")
+        self.assertEqual(b"".join(response.streaming_content), b"jpeg-bytes")
+        self.assertEqual(anonymous.get(image_url.replace("receipt-images/", "receipt-images/x")).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_urls_are_cached_until_near_expiry(self):
+        storage = get_image_storage()
+        with mock.patch.object(storage, "sign", return_value="/signed") as sign:
+            self.assertEqual(storage.url("a.jpg"), "/signed")
+            self.assertEqual(storage.url("a.jpg"), "/signed")
+        sign.assert_called_once_with("a.jpg", 3600)
+
+    @mock.patch("api.processing.analyse_receipt_image", return_value=make_parsed_receipt())
+    def test_pipeline_stores_key_not_url(self, analyse):
+        with self.settings(RECEIPT_IMAGES={'WORKERS': 0}):
+            receipt = process_receipt(self.user, image_file=make_image_upload())
+        self.assertRegex(receipt.image_key, r"^[0-9a-f]{64}\.jpg$")
+        self.assertIsNone(receipt.image_url)
+        self.assertTrue(os.path.exists(os.path.join(self.location, receipt.image_key)))
+
+
+class AzureBlobStorageTests(TestCase):
+    @override_settings(RECEIPT_STORAGE={'BACKEND': 'api.storage.AzureBlobStorage'})
+    def test_upload_sends_content_settings_in_one_call(self):
+        blob_client = mock.Mock()
+        with mock.patch("api.storage.get_blob_service_client") as service:
+            service.return_value.get_blob_client.return_value = blob_client
+            get_image_storage().save("k.jpg", BytesIO(b"x"), 1, "image/jpeg")
+        blob_client.upload_blob.assert_called_once()
+        self.assertEqual(blob_client.upload_blob.call_args.kwargs["content_settings"].content_type, "image/jpeg")
+        blob_client.set_http_headers.assert_not_called()
+
+    @override_settings(RECEIPT_STORAGE={'BACKEND': 'api.storage.AzureBlobStorage', 'URL_TTL': 600})
+    def test_sas_urls_are_short_lived(self):
+        url = get_image_storage().sign("k.jpg", 600)
+        expiry = parse_qs(urlsplit(url).query)["se"][0]
+        self.assertLess(datetime.fromisoformat(expiry.replace("Z", "+00:00")), timezone.now() + timedelta(minutes=11))
+
+
+class ReceiptAnalysisTests(TestCase):
+    def test_parses_analyze_result_once_into_compact_structure(self):
+        parsed = make_parsed_receipt(category="Supplies.Grocery")
+        self.assertEqual(parsed.merchant, "Cafe")
+        self.assertEqual(parsed.total, Decimal("7.5"))
+        self.assertEqual([item.total_price for item in parsed.items], [Decimal("3.5"), Decimal("4.0")])
+        self.assertEqual(parsed.receipt_fields()["receipt_category"], CategoryChoices.SUPPLIES)
+        self.assertEqual(parsed.receipt_fields()["parsed_items"][0], {"description": {"value": "Coffee"}, "total_price": {"value": "3.5"}})
+        self.assertEqual(len(parsed.expense_fields()), 2)
+        self.assertEqual(ParsedReceipt.from_dict(parsed.to_dict()), parsed)
+
+    def test_cached_raw_results_are_still_readable(self):
+        """Ensure cache entries written before parsing moved into the analyser still load."""
+        self.assertEqual(ParsedReceipt.from_dict(make_analyze_result().as_dict()), make_parsed_receipt())
+
+    @override_settings(RECEIPT_ANALYSER={'BACKEND': 'api.analysis.FixtureReceiptAnalyser', 'LATENCY': 0.25})
+    def test_fixture_analyser_is_deterministic(self):
+        analyser = get_receipt_analyser()
+        with mock.patch("api.analysis.time.sleep") as sleep:
+            first = analyser.analyse("0123abcd.jpg")
+            self.assertEqual(analyser.analyse("0123abcd.jpg"), first)
+            self.assertEqual(analyser.analyse("fuel.jpg").merchant, "City Fuel")
+        sleep.assert_called_with(0.25)
+        self.assertEqual(sleep.call_count, 3)
+
+    @override_settings(
+        RECEIPT_ANALYSER={'BACKEND': 'api.analysis.FixtureReceiptAnalyser'},
+        RECEIPT_IMAGES={'WORKERS': 0},
+    )
+    def test_pipeline_runs_offline(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        user = User.objects.create_user(email="offline@example.com", password="offlinepass")
+        client = APIClient()
+        client.force_authenticate(user=user)
+        with self.settings(RECEIPT_STORAGE={'BACKEND': 'api.storage.LocalFileStorage', 'LOCATION': location}):
+            response = client.post('/api/process-receipt/', {'image': make_image_upload()}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        receipt = Receipt.objects.get(user=user)
+        self.assertEqual(Expense.objects.filter(user=user).count(), len(receipt.parsed_items))
+
+
+class AuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="auth@example.com", password="authpass")
+        CachedBasicAuthentication.get_cache().clear()
+
+    def basic_client(self, password="authpass"):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Basic " + base64.b64encode(f"auth@example.com:{password}".encode()).decode())
+        return client
+
+    def test_login_exchanges_password_for_bearer_token(self):
+        response = APIClient().post('/login/', {'email': "auth@example.com", 'password': "authpass"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['Authorization'].startswith("Bearer "))
+        self.assertNotIn("authpass", str(response.data))
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=response.data['Authorization'])
+        self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        refreshed = APIClient().post('/api/token/refresh/', {'refresh': response.data['refresh']})
+        self.assertEqual(refreshed.status_code, status.HTTP_200_OK)
+
+    def test_repeat_basic_requests_skip_the_password_hasher(self):
+        client = self.basic_client()
+        with mock.patch("rest_framework.authentication.BasicAuthentication.authenticate_credentials",
+                        autospec=True, side_effect=BasicAuthentication.authenticate_credentials) as verify:
+            for _ in range(3):
+                self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        self.assertEqual(verify.call_count, 1)
+
+    def test_password_change_and_deactivation_invalidate_cached_credentials(self):
+        client = self.basic_client()
+        self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        self.user.set_password("newpass")
+        self.user.save()
+        self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        client = self.basic_client("newpass")
+        self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_200_OK)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_wrong_password_is_never_cached(self):
+        self.assertEqual(self.basic_client("wrong").get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(len(CachedBasicAuthentication.get_cache()._entries), 0)
+
+    def test_cache_is_bounded_and_expires(self):
+        cache = VerifiedCredentialCache(max_entries=2, ttl=60)
+        for name in "abc":
+            cache.set(name, 1, "hash")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), (1, "hash"))
+        with mock.patch("api.authentication.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get("c"))
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="jwt@example.com", password="jwtpass")
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(self.user).access_token}")
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/receipts/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [q['sql'] for q in queries if 'FROM "api_user"' in q['sql']]
+
+    def test_repeat_requests_skip_the_user_query(self):
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(self.user_queries(), [])
+        invalidate_cached_user(self.user.pk)
+        self.assertEqual(len(self.user_queries()), 1)
+
+    def test_cache_holds_no_password_hash(self):
+        self.user_queries()
+        entry = caches['default'].get(f"jwt-user:{self.user.pk}")
+        self.assertNotIn(self.user.password, repr(entry))
+
+        token = RefreshToken.for_user(self.user).access_token
+        user = CachedJWTAuthentication().get_user(token)
+        self.assertEqual((user.pk, user.email, user.is_active), (self.user.pk, "jwt@example.com", True))
+        self.assertIn("password", user.get_deferred_fields())
+        user.full_name = "Renamed"
+        user.save()
+        self.assertTrue(User.objects.get(pk=self.user.pk).check_password("jwtpass"))
+
+    def test_saving_the_user_invalidates_the_cache(self):
+        self.user_queries()
+        self.user.set_password("changed")
+        self.user.save()
+        self.assertEqual(len(self.user_queries()), 1)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user_is_rejected(self):
+        self.user_queries()
+        self.user.delete()
+        self.assertEqual(self.client.get('/api/receipts/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="metrics@example.com", password="metricspass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    def server_timing(self, response):
+        return dict(
+            (entry.split(";")[0], entry) for entry in response["Server-Timing"].split(", ")
+        )
+
+    def test_server_timing_counts_queries_serialization_and_rendering(self):
+        Receipt.objects.create(user=self.user, merchant="Cafe", total_amount=Decimal("4.50"))
+        response = self.client.get('/api/receipts/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timing = self.server_timing(response)
+        self.assertIn('desc="1 queries"', timing["db"])  # One keyset page; force_authenticate needs no user query
+        self.assertIn("serialize", timing)
+        self.assertIn("render", timing)
+        self.assertIn("total", timing)
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('api_request_duration_seconds_count{view="receipts-list",method="GET",status="200"} 1', body)
+        self.assertIn('api_request_db_queries_bucket{view="receipts-list",le="1"} 1', body)
+        self.assertIn('api_request_span_duration_seconds_count{view="receipts-list",span="serialize"} 1', body)
+        self.assertIn("api_receipt_image_cache_hits_total", body)
+
+    @override_settings(
+        RECEIPT_ANALYSER={'BACKEND': 'api.analysis.FixtureReceiptAnalyser'},
+        RECEIPT_IMAGES={'WORKERS': 0},
+    )
+    def test_external_calls_are_timed_including_batch_worker_threads(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        with self.settings(RECEIPT_STORAGE={'BACKEND': 'api.storage.LocalFileStorage', 'LOCATION': location}):
+            single = self.client.post('/api/process-receipt/', {'image': make_image_upload()}, format='multipart')
+            batch = self.client.post('/api/process-receipts/batch/', {
+                'images': [make_image_upload("a.png", "red"), make_image_upload("b.png", "blue")],
+            }, format='multipart')
+        self.assertEqual(single.status_code, status.HTTP_201_CREATED)
+        for response in (single, batch):
+            self.assertLessEqual({"preprocess", "blob_upload", "analysis", "serialize"}, set(self.server_timing(response)))
+
+    def test_queries_from_batch_worker_threads_are_counted(self):
+        def query(item):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT %s", [item])
+            finally:
+                connection.close()  # The worker thread's own connection
+
+        timings = metrics.RequestTimings()
+        with metrics.collect_timings(timings), metrics.count_queries(timings):
+            _map_concurrently(query, [1, 2, 3], max_workers=3)
+            Receipt.objects.exists()
+        self.assertEqual(timings.queries, 4)
+
+    def test_streamed_export_is_observed_once_the_body_is_sent(self):
+        Receipt.objects.create(user=self.user, merchant="Cafe", total_amount=Decimal("4.50"))
+        response = self.client.get('/api/export/receipts/?export_format=csv')
+        self.assertNotIn('view="export-receipts"', metrics.render_metrics())
+        b"".join(response.streaming_content)
+        self.assertIn('api_request_db_queries_count{view="export-receipts"} 1', metrics.render_metrics())
+
+    def test_nested_spans_count_once(self):
+        timings = metrics.RequestTimings()
+        with metrics.collect_timings(timings):
+            with metrics.timed("serialize"):
+                with metrics.timed("serialize"):
+                    pass
+        self.assertEqual(list(timings.spans), ["serialize"])
+        with metrics.timed("serialize"):
+            pass  # Outside a request: nothing to record into
+
+    @override_settings(REQUEST_METRICS={'TOKEN': 'scrape-secret'})
+    def test_metrics_endpoint_can_require_a_token(self):
+        self.assertEqual(APIClient().get('/metrics').status_code, status.HTTP_401_UNAUTHORIZED)
+        response = APIClient().get('/metrics', HTTP_AUTHORIZATION="Bearer scrape-secret")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_seeded_datasets_are_deterministic_and_consistent(self):
+        first = seed_dataset(2, 15, seed=7, email_prefix="first")
+        second = seed_dataset(2, 15, seed=7, email_prefix="second")
+
+        def shape(user_ids):
+            return list(Receipt.objects.filter(user_id__in=user_ids).order_by("pk").values_list("merchant", "total_amount", "receipt_category"))
+
+        self.assertEqual(shape(first), shape(second))
+        self.assertEqual(Receipt.objects.filter(user_id__in=first).count(), 30)
+        receipt = Receipt.objects.filter(user_id=first[0]).first()
+        self.assertEqual(receipt.total_amount, sum(Decimal(item["total_price"]["value"]) for item in receipt.parsed_items))
+        self.assertEqual(Expense.objects.filter(user_id__in=first).count(), sum(len(r.parsed_items) for r in Receipt.objects.filter(user_id__in=first)))
+        self.assertTrue(self.client.login(email="first-7-0@example.com", password=SEED_PASSWORD))
+
+        for budget in Budget.objects.filter(user_id__in=first):
+            seeded = budget.current_spending
+            budget.update_spending()
+            self.assertEqual(seeded, budget.current_spending)
+            self.assertEqual(sorted(budget.category_filters.values_list("category", flat=True)), sorted(budget.filter_categories))
+
+    def test_compare_results_flags_regressions_beyond_tolerance(self):
+        baseline = {"list": {"median_ms": 10.0, "queries": 2, "per_sec": 100.0, "peak_kb": 100.0}}
+        within = {"list": {"median_ms": 12.0, "queries": 2, "per_sec": 90.0, "peak_kb": 110.0}}
+        self.assertEqual(compare_results(baseline, within, tolerance=0.25), [])
+        worse = {"list": {"median_ms": 20.0, "queries": 3, "per_sec": 50.0, "peak_kb": 100.0}, "new": {"queries": 9}}
+        self.assertEqual(len(compare_results(baseline, worse, tolerance=0.25)), 3)
+
+    def test_dataset_benchmarks_write_results_and_fail_on_regression(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        output = os.path.join(directory, "results.json")
+        call_command("benchmark", "receipt_list", "budget_report", "--repeat", "1", "--in-place", "--output", output, stdout=StringIO())
+        with open(output) as results_file:
+            report = json.load(results_file)
+        self.assertEqual(report["meta"]["dataset"]["name"], "smoke")
+        self.assertEqual(report["results"]["receipt_list"]["page_50"]["queries"], 1)
+        self.assertIn("peak_kb", report["results"]["budget_report"]["cold"])
+
+        report["results"]["receipt_list"]["page_50"]["queries"] = 0
+        with open(output, "w") as results_file:
+            json.dump(report, results_file)
+        with self.assertRaisesMessage(CommandError, "receipt_list.page_50.queries: 0 -> 1"):
+            call_command("benchmark", "receipt_list", "--repeat", "1", "--in-place", "--baseline", output, stdout=StringIO())
+
+
+class SeedDataTests(TestCase):
+    def test_distributions(self):
+        rng = random.Random(1)
+        self.assertEqual(parse_distribution(5)(rng), 5)
+        self.assertEqual(parse_distribution("fixed:7")(rng), 7)
+        self.assertTrue(all(2 <= parse_distribution("uniform:2,4")(rng) <= 4 for _ in range(50)))
+        self.assertTrue(all(0 <= parse_distribution("lognormal:100,2,500")(rng) <= 500 for _ in range(200)))
+        self.assertTrue(all(10 <= parse_distribution("pareto:10,1.5")(rng) for _ in range(50)))
+        for spec in ("normal:1,2", "uniform:1", "lognormal:x,1"):
+            with self.assertRaises(ValueError):
+                parse_distribution(spec)
+
+    def test_data_does_not_depend_on_how_users_are_chunked(self):
+        options = dict(budgets_per_user="uniform:0,3", seed=5)
+        whole = seed_dataset(4, "uniform:0,6", email_prefix="whole", batch_size=2000, **options)
+        split = seed_dataset(4, "uniform:0,6", email_prefix="split", batch_size=1, **options)
+
+        def per_user(user_ids):
+            return [
+                (list(Receipt.objects.filter(user_id=user_id).order_by("pk").values_list("merchant", "total_amount")),
+                 list(Budget.objects.filter(user_id=user_id).order_by("pk").values_list("start_date", "current_spending")))
+                for user_id in user_ids
+            ]
+
+        self.assertEqual(per_user(whole), per_user(split))
+
+    def test_command_reports_rows_and_refuses_to_reseed(self):
+        out = StringIO()
+        call_command("seed_data", "--users", "3", "--receipts", "uniform:2,4", "--budgets", "2", "--seed", "9", stdout=out)
+        self.assertEqual(User.objects.filter(email__startswith="seed-9-").count(), 3)
+        self.assertEqual(Budget.objects.filter(user__email__startswith="seed-9-").count(), 6)
+        self.assertIn("rows/s", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("seed_data", "--users", "1", "--seed", "9", stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command("seed_data", "--receipts", "sometimes", stdout=StringIO())
+
+
+class SpendingRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="rollup@example.com", password="rolluppass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def make_receipt(self, category, total, day):
+        return Receipt.objects.create(
+            user=self.user, merchant="Shop", total_amount=Decimal(total), receipt_category=category,
+            transaction_date=timezone.make_aware(datetime.fromisoformat(day)),
+        )
+
+    def rollups(self):
+        return list(SpendingRollup.objects.order_by("user_id", "day", "category").values_list(
+            "user_id", "category", "day", "receipt_total", "receipt_count", "expense_total", "expense_count"))
+
+    def assert_matches_rebuild(self):
+        maintained = self.rollups()
+        rebuild_spending_rollups()
+        self.assertEqual(maintained, self.rollups())
+
+    def test_single_writes_keep_rollups_current(self):
+        meal = self.make_receipt(CategoryChoices.MEAL.value, "10.00", "2024-01-05")
+        self.make_receipt(CategoryChoices.MEAL.value, "2.50", "2024-01-05")
+        self.assertEqual(self.rollups(), [(self.user.pk, "Meal", date(2024, 1, 5), Decimal("12.50"), 2, Decimal("0.00"), 0)])
+
+        response = self.client.post('/api/expenses/', {"amount": "4.00", "category": "Hotel", "date": "2024-01-06"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        meal.receipt_category = CategoryChoices.HOTEL.value
+        meal.transaction_date = timezone.make_aware(datetime(2024, 1, 6))
+        meal.save()
+        Receipt.objects.get(pk=meal.pk).save()  # Unchanged, must not move anything
+        expense = Expense.objects.get()
+        expense.amount = Decimal("5.00")
+        expense.save()
+        self.assertEqual(self.rollups(), [
+            (self.user.pk, "Meal", date(2024, 1, 5), Decimal("2.50"), 1, Decimal("0.00"), 0),
+            (self.user.pk, "Hotel", date(2024, 1, 6), Decimal("10.00"), 1, Decimal("5.00"), 1),
+        ])
+        self.assert_matches_rebuild()
+
+        Receipt.objects.filter(receipt_category=CategoryChoices.MEAL.value).delete()
+        Receipt(pk=meal.pk, user=self.user, total_amount=Decimal("1.00"), receipt_category="Hotel",
+                uploaded_at=meal.uploaded_at, transaction_date=meal.transaction_date).save()  # Not loaded through from_db
+        self.assertEqual(self.rollups(), [(self.user.pk, "Hotel", date(2024, 1, 6), Decimal("1.00"), 1, Decimal("5.00"), 1)])
+        self.assert_matches_rebuild()
+
+    def test_bulk_writes_keep_rollups_current(self):
+        seed_dataset(3, "uniform:5,20", budgets_per_user=1, seed=4)
+        self.assertTrue(self.rollups())
+        self.assert_matches_rebuild()
+        User.objects.filter(email__startswith="seed-4-").delete()
+        self.assertEqual(self.rollups(), [])
+
+    def test_apply_deltas_on_either_update_path(self):
+        meal, hotel = (self.user.pk, "Meal", date(2024, 1, 5)), (self.user.pk, "Hotel", date(2024, 1, 6))
+        for update_from in (True, False):
+            SpendingRollup.objects.all().delete()
+            with mock.patch.object(SpendingRollup, "_update_from_supported", return_value=update_from):
+                SpendingRollup.apply_deltas({meal: [Decimal("2.50"), 1, Decimal("0.00"), 0]})
+                SpendingRollup.apply_deltas({meal: [Decimal("1.25"), 1, Decimal("4.00"), 1], hotel: [Decimal("0.00"), 0, Decimal("3.00"), 1]})
+                SpendingRollup.apply_deltas({hotel: [Decimal("0.00"), 0, Decimal("-3.00"), -1]})
+            self.assertEqual(self.rollups(), [(*meal, Decimal("3.75"), 2, Decimal("4.00"), 1)])
+
+        lookup = SpendingRollup._ids_for
+        with mock.patch.object(SpendingRollup, "_ids_for", side_effect=[{}, lookup({meal: None})]):
+            # The row appears between the lookup and the insert, as if a concurrent writer created it
+            SpendingRollup.apply_deltas({meal: [Decimal("1.00"), 1, Decimal("0.00"), 0]})
+        self.assertEqual(self.rollups(), [(*meal, Decimal("4.75"), 3, Decimal("4.00"), 1)])
+
+    def test_backfill_command(self):
+        self.make_receipt(CategoryChoices.MEAL.value, "10.00", "2024-01-05")
+        SpendingRollup.objects.all().delete()
+        out = StringIO()
+        call_command("backfill_spending_rollups", stdout=out)
+        self.assertIn("Wrote 1 rollup rows", out.getvalue())
+        self.assertEqual(len(self.rollups()), 1)
+
+    def test_spending_endpoint(self):
+        self.make_receipt(CategoryChoices.MEAL.value, "10.00", "2024-01-01")  # Monday
+        self.make_receipt(CategoryChoices.MEAL.value, "5.00", "2024-01-07")
+        self.make_receipt(CategoryChoices.HOTEL.value, "80.00", "2024-01-08")
+        self.make_receipt(CategoryChoices.MEAL.value, "3.00", "2024-02-10")
+        other = User.objects.create_user(email="other-rollup@example.com", password="x")
+        Receipt.objects.create(user=other, total_amount=Decimal("99.00"), receipt_category="Meal")
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/analytics/spending/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row["period"], row["category"], row["receipt_total"], row["receipt_count"]) for row in response.data["results"]],
+            [(date(2024, 1, 1), "Hotel", "80.00", 1), (date(2024, 1, 1), "Meal", "15.00", 2), (date(2024, 2, 1), "Meal", "3.00", 1)],
+        )
+
+        response = self.client.get('/api/analytics/spending/', {"granularity": "week", "end": "2024-01-31", "by_category": "false"})
+        self.assertEqual([(row["period"], row["receipt_total"]) for row in response.data["results"]],
+                         [(date(2024, 1, 1), "15.00"), (date(2024, 1, 8), "80.00")])
+
+        response = self.client.get('/api/analytics/spending/', {"granularity": "day", "start": "2024-01-02", "category": "Meal"})
+        self.assertEqual([row["period"] for row in response.data["results"]], [date(2024, 1, 7), date(2024, 2, 10)])
+
+        for params in ({"granularity": "year"}, {"start": "01/02/2024"}, {"start": "2024-13-01"}, {"category": "Snacks"}):
+            self.assertEqual(self.client.get('/api/analytics/spending/', params).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="search@example.com", password="searchpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def make_receipt(self, merchant, *items, user=None):
+        return Receipt.objects.create(
+            user=user or self.user, merchant=merchant, total_amount=Decimal("10.00"),
+            parsed_items=[ParsedItem(description=item, total_price=Decimal("1.00")).as_json() for item in items],
+        )
+
+    def search(self, q, **params):
+        response = self.client.get('/api/search/', {"q": q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def found(self, q, **params):
+        return [(hit["type"], hit[hit["type"]]["id"]) for hit in self.search(q, **params).data["results"]]
+
+    def test_document_deleted_after_ranking_is_skipped(self):
+        cafe = self.make_receipt("Coffee Corner", "Coffee")
+        gone = self.make_receipt("Coffee Cart", "Coffee")
+        ranked = search_documents(self.user, "coffee", None)
+        with mock.patch("api.views.search_documents", return_value=ranked[:20]):
+            SearchDocument.objects.filter(receipt=gone).delete()
+            self.assertEqual(self.found("coffee"), [("receipt", cafe.pk)])
+
+    def test_ranked_search_over_merchants_items_and_vendors(self):
+        cafe = self.make_receipt("Coffee Corner", "Coffee", "Latte")
+        walmart = self.make_receipt("Walmart", "Coffee filter", "Paper towels", "Milk", "Bread", "Eggs")
+        self.make_receipt("Café Coffee", user=User.objects.create_user(email="other-search@example.com", password="x"))
+        response = self.client.post('/api/expenses/', {"amount": "4.00", "category": "Other", "vendor": "Walmart Supercenter"})
+        expense_id = response.data["id"]
+
+        self.assertEqual(self.found("coffee"), [("receipt", cafe.pk), ("receipt", walmart.pk)])
+        self.assertEqual(sorted(self.found("WALM")), [("expense", expense_id), ("receipt", walmart.pk)])
+        self.assertEqual(self.found("walmart", type="expense"), [("expense", expense_id)])
+        self.assertEqual(self.found("paper towel"), [("receipt", walmart.pk)])
+        self.assertEqual(self.found("coffee tea"), [])
+
+        page = self.search("coffee", page_size=1).data
+        self.assertEqual((page["count"], len(page["results"])), (2, 1))
+        self.assertEqual([hit["receipt"]["id"] for hit in self.client.get(page["next"]).data["results"]], [walmart.pk])
+
+        self.assertEqual(self.client.get('/api/search/').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/search/', {"q": "x", "type": "budget"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_index_follows_edits_and_deletes(self):
+        receipt = self.make_receipt("Target", "Shampoo")
+        receipt.merchant = "Costco"
+        receipt.parsed_items = []
+        receipt.save()
+        self.assertEqual(self.found("target"), [])
+        self.assertEqual(self.found("shampoo"), [])
+        self.assertEqual(self.found("costco"), [("receipt", receipt.pk)])
+        receipt.delete()
+        self.assertEqual(self.found("costco"), [])
+
+    def test_bulk_writes_are_indexed_and_can_be_rebuilt(self):
+        parsed = ParsedReceipt(merchant="Aldi", total=Decimal("3.00"), items=(ParsedItem(description="Bananas", total_price=Decimal("3.00")),))
+        create_receipts_from_results(self.user, [("", parsed)])
+        self.assertEqual(self.found("banana"), [("receipt", Receipt.objects.get().pk)])
+        self.assertEqual(len(self.found("aldi")), 2)  # The receipt and its expense
+
+        SearchDocument.objects.all().delete()
+        out = StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn("Indexed 2 receipts and expenses", out.getvalue())
+        self.assertEqual(len(self.found("aldi")), 2)
+
+
+    def test_migration_indexes_existing_receipts_and_expenses(self):
+        from importlib import import_module
+        from django.apps import apps as global_apps
+        receipt = self.make_receipt("Lidl", "Oat milk")
+        expense = Expense.objects.create(user=self.user, amount=Decimal("2.00"), category="Other", vendor="Lidl Express")
+        SearchDocument.objects.all().delete()
+        import_module("api.migrations.0009_searchdocument").index_existing_documents(global_apps, None)
+        self.assertEqual(sorted(self.found("lidl")), [("expense", expense.pk), ("receipt", receipt.pk)])
+        self.assertEqual(self.found("oat"), [("receipt", receipt.pk)])
+
+class ReceiptItemTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="items@example.com", password="itemspass")
+
+    def items(self, receipt):
+        return list(receipt.items.values_list("position", "description", "quantity", "total_price"))
+
+    def test_bulk_created_items_are_typed_and_linked_to_their_expenses(self):
+        parsed = ParsedReceipt(merchant="Cafe", total=Decimal("7.50"), items=(
+            ParsedItem(description="Coffee", quantity="2", total_price=Decimal("3.50")),
+            ParsedItem(description="Napkin", quantity="a few"),
+            ParsedItem(description="Bagel", total_price=Decimal("4.00")),
+        ))
+        [receipt] = create_receipts_from_results(self.user, [("", parsed)])
+
+        self.assertEqual(self.items(receipt), [
+            (0, "Coffee", Decimal("2.000"), Decimal("3.50")),
+            (1, "Napkin", None, None),
+            (2, "Bagel", None, Decimal("4.00")),
+        ])
+        linked = receipt.items.exclude(expense=None).values_list("description", "expense__amount")
+        self.assertEqual(sorted(linked), [("Bagel", Decimal("4.00")), ("Coffee", Decimal("3.50"))])
+
+    def test_migration_links_backfilled_items_to_their_expenses(self):
+        from importlib import import_module
+        from django.apps import apps as global_apps
+        parsed = ParsedReceipt(merchant="Cafe", total=Decimal("7.00"), transaction_date="2024-02-10", items=(
+            ParsedItem(description="Coffee", total_price=Decimal("3.50")),
+            ParsedItem(description="Napkin"),
+            ParsedItem(description="Coffee", total_price=Decimal("3.50")),
+        ))
+        create_receipts_from_results(self.user, [("", parsed), ("", parsed)])
+        Expense.objects.create(user=self.user, amount=Decimal("3.50"), category="Other", vendor="Other cafe", date="2024-02-10")
+        links = list(ReceiptItem.objects.order_by("receipt", "position").values_list("receipt", "position", "expense"))
+        self.assertEqual(len({expense for _, _, expense in links if expense}), 4)
+
+        ReceiptItem.objects.all().delete()
+        import_module("api.migrations.0010_receiptitem").populate_receipt_items(global_apps, None)
+        self.assertEqual(list(ReceiptItem.objects.order_by("receipt", "position").values_list("receipt", "position", "expense")), links)
+
+    def test_items_follow_parsed_items_edits(self):
+        receipt = Receipt.objects.create(user=self.user, total_amount=Decimal("5.00"), parsed_items=[
+            {"description": {"value": "Tea"}, "total_price": {"value": "1,250.5"}},
+            {"total_price": {"value": "1e12"}},  # Too large for the column
+            "not an item",
+        ])
+        self.assertEqual(self.items(receipt), [(0, "Tea", None, Decimal("1250.50")), (1, "", None, None)])
+
+        receipt = Receipt.objects.get(pk=receipt.pk)
+        receipt.merchant = "Tea Shop"
+        with CaptureQueriesContext(connection) as queries:
+            receipt.save()
+        self.assertFalse([q for q in queries if "api_receiptitem" in q["sql"]])
+
+        receipt.parsed_items = [{"description": {"value": "Scone"}}]
+        receipt.save()
+        self.assertEqual(self.items(receipt), [(0, "Scone", None, None)])
+
+    def test_data_migration_converts_existing_receipts(self):
+        from importlib import import_module
+        from django.apps import apps as global_apps
+        receipt = Receipt.objects.create(user=self.user, parsed_items=[{"description": {"value": "Soup"}, "quantity": {"value": 1}}])
+        Receipt.objects.create(user=self.user)
+        receipt.items.all().delete()
+        import_module("api.migrations.0010_receiptitem").populate_receipt_items(global_apps, None)
+        self.assertEqual(self.items(receipt), [(0, "Soup", Decimal("1.000"), None)])
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="import@example.com", password="importpass")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_csv_expenses_import_valid_rows_and_report_the_rest(self):
+        body = (
+            "﻿amount,category,date,vendor,payment_method\n"
+            "12.50,Supplies,2024-03-01,Aldi,card\n"
+            "abc,Supplies,2024-03-01,Aldi,card\n"
+            "3,Rocket fuel,,Shell,\n"
+            "4.00,meal,2024-03-02,\"Pizza, Inc.\",cash\n"
+            ",Other,2024-03-02,Nobody,\n"
+        ).encode()
+        response = self.client.generic("POST", "/api/import/expenses/?import_format=csv", body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data["imported"], response.data["failed"]), (2, 3))
+        self.assertEqual([error["line"] for error in response.data["errors"]], [3, 4, 6])
+        self.assertIn("amount is not a valid amount", response.data["errors"][0]["error"])
+
+        self.assertEqual(
+            sorted(Expense.objects.filter(user=self.user).values_list("vendor", "amount", "category")),
+            [("Aldi", Decimal("12.50"), "Supplies"), ("Pizza, Inc.", Decimal("4.00"), "Meal")],
+        )
+        self.assertEqual(SpendingRollup.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(SearchDocument.objects.filter(user=self.user, text="Pizza, Inc.").count(), 1)
+
+        self.assertEqual(self.client.post("/api/import/budgets/", {}).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.generic("POST", "/api/import/expenses/", b"amount\n", content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        upload = SimpleUploadedFile("more.csv", b"amount,vendor\r\n1.00,Kiosk\r\n", content_type="text/csv")
+        response = self.client.post("/api/import/expenses/", {"file": upload}, format="multipart")
+        self.assertEqual((response.status_code, response.data["imported"]), (status.HTTP_201_CREATED, 1))
+
+    def test_ndjson_receipts_are_linked_to_budgets_in_chunks(self):
+        budget = Budget.objects.create(
+            user=self.user, category=CategoryChoices.SUPPLIES, limit_amount=Decimal("100.00"),
+            start_date=date(2024, 3, 1), end_date=date(2024, 3, 31),
+        )
+        lines = [
+            {"merchant": "Aldi", "total_amount": "7.50", "transaction_date": "2024-03-05", "receipt_category": "Supplies",
+             "items": [{"description": "Bananas", "quantity": "2", "total_price": "2.50"}, {"description": "Bread", "total_price": "5.00"}]},
+            {"merchant": "Lidl", "total_amount": "2.00", "transaction_date": "2024-03-06T10:30:00"},
+            {"merchant": "Later", "total_amount": "1.00", "transaction_date": "2024-05-01"},
+            {"merchant": "Broken", "items": "bananas"},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+        with override_settings(IMPORT_CHUNK_SIZE=2):
+            response = self.client.generic("POST", "/api/import/receipts/", body.encode(), content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data["imported"], response.data["failed"]), (3, 2))
+        self.assertEqual([error["line"] for error in response.data["errors"]], [4, 5])
+
+        budget.refresh_from_db()
+        self.assertEqual(sorted(budget.receipts.values_list("merchant", flat=True)), ["Aldi", "Lidl"])
+        self.assertEqual(budget.current_spending, Decimal("9.50"))
+        aldi = Receipt.objects.get(merchant="Aldi")
+        self.assertEqual(list(aldi.items.values_list("description", "total_price")), [("Bananas", Decimal("2.50")), ("Bread", Decimal("5.00"))])
+        self.assertEqual(SearchDocument.objects.get(receipt=aldi).text, "Aldi Bananas Bread")
+        self.assertEqual(
+            SpendingRollup.objects.filter(user=self.user).values_list("receipt_total", flat=True).order_by("day")[0],
+            Decimal("7.50"),
+        )
+
+    def test_import_command_writes_the_error_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "receipts.csv")
+            errors = os.path.join(directory, "errors.csv")
+            with open(source, "w") as f:
+                f.write("merchant,total_amount,transaction_date\nAldi,1.00,2024-01-02\nLidl,2.00,yesterday\nNetto,3.00,\n")
+            out = StringIO()
+            call_command("import_data", "receipts", source, user="import@example.com", errors=errors, chunk_size=1, stdout=out)
+            with open(errors, newline="") as f:
+                rows = list(csv.reader(f))
+
+        self.assertIn("Imported 2 receipts (1 failed)", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertEqual(rows[0], ["line", "error", "row"])
+        self.assertEqual(rows[1][:2], ["3", "transaction_date must be an ISO date or date and time."])
+        self.assertEqual(json.loads(rows[1][2])["merchant"], "Lidl")
+        self.assertEqual(sorted(Receipt.objects.values_list("merchant", flat=True)), ["Aldi", "Netto"])
+        with self.assertRaises(CommandError):
+            call_command("import_data", "receipts", "-", user="nobody@example.com")
@@ -11,6 +11,7 @@ router.register('incomes', IncomeViewSet, basename='incomes')
 router.register('expenses', ExpenseViewSet, basename='expenses')
 router.register('receipts', ReceiptViewSet, basename='receipts')
 router.register('budgets', BudgetViewSet, basename='budgets')
+router.register('receipt-jobs', ReceiptJobViewSet, basename='receipt-jobs')
 #router.register('notifications', NotificationViewSet, basename='notifications')
 
 
@@ -20,11 +21,17 @@ urlpatterns = [
     path('', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('api/process-receipt/', ProcessReceiptView.as_view(), name='process-receipt'),
+    path('api/process-receipts/batch/', ProcessReceiptBatchView.as_view(), name='process-receipt-batch'),
+    path('api/receipt-images/<str:token>/', ReceiptImageView.as_view(), name='receipt-image'),
     path('api/login/', LoginView.as_view(), name='login'),
     path('api/export/receipts/', ExportReceiptsXlsxView.as_view(), name='export-receipts'),
     path("api/export/budget/<int:budget_id>/", ExportReceiptsXlsxView.as_view(), name="export_budget_receipts"),
     path("api/budget-report/<int:budget_id>/", BudgetReportView.as_view(), name="budget-report"),
+    path("api/analytics/spending/", SpendingAnalyticsView.as_view(), name="spending-analytics"),
+    path("api/search/", SearchView.as_view(), name="search"),
+    path("api/import/<str:kind>/", ImportView.as_view(), name="import"),
     path('login/', EmailPasswordLoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path("api/csrf/", CSRFTokenView.as_view(), name="csrf-token"),  # ✅ CSRF Token Endpoint
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -2,14 +2,22 @@ from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
 from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, ContentSettings
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.core import signing
 from django.middleware.csrf import get_token
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
 from rest_framework.authentication import SessionAuthentication
 from datetime import datetime, timedelta
 from rest_framework.parsers import MultiPartParser, FormParser
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Count, Max, Min, OuterRef, Subquery, Sum, Value, Prefetch
+from django.db.models.functions import Coalesce, Length
+from rest_framework.pagination import PageNumberPagination
 from django.core.files.storage import default_storage
-import base64
 import requests
 from django.core.files.base import ContentFile
 from django.shortcuts import render
@@ -22,7 +30,7 @@ from rest_framework.response import Response
 from rest_framework import status, generics
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from .models import Income, Expense, Budget, Receipt, User, CategoryChoices
+from .models import Income, Expense, Budget, Receipt, ReceiptItem, ReceiptJob, SearchDocument, User, CategoryChoices
 from .serializers import (
     UserCreateSerializer,
     UserSerializer,
@@ -30,9 +38,25 @@ from .serializers import (
     ExpenseSerializer,
     ReceiptSerializer,
     BudgetSerializer,
+    ReceiptJobSerializer,
     UserSerializer,
     UserCreateSerializer
 )
+from .analytics import GRANULARITIES, spending_series
+from .budgeting import link_budget_to_receipts
+from .pagination import KeysetPagination
+from .jobs import get_job_backend
+from .metrics import get_metrics_settings, render_metrics, timed
+from .processing import (
+    ReceiptProcessingError,
+    analyse_receipt_sources,
+    compress_image,
+    create_receipts_from_results,
+    process_receipt,
+)
+from .importing import DEFAULT_CHUNK_SIZE, FORMATS, IMPORTERS, decode_lines, import_rows
+from .search import search_documents
+from .storage import LocalFileStorage, get_image_storage, get_storage_settings
 from django.shortcuts import get_object_or_404
 from django_filters import rest_framework as filters
 from django.contrib.auth import get_user_model, authenticate, login, logout
@@ -48,9 +72,13 @@ from io import BytesIO
 import time
 import csv
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment
 from openpyxl.utils import get_column_letter
 import json
+import itertools
+import tempfile
+import hashlib
 
 User = get_user_model()
 
@@ -124,6 +152,8 @@ class IncomeViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = IncomeSerializer
     queryset = Income.objects.all()
+    pagination_class = KeysetPagination
+    ordering = ('-date', '-id')
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_fields = ['category', 'date', 'source']
     
@@ -137,6 +167,8 @@ class IncomeViewSet(viewsets.ModelViewSet):
 class ExpenseViewSet(viewsets.ModelViewSet):
     serializer_class = ExpenseSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    ordering = ('-date', '-id')
     def get_queryset(self):
         return Expense.objects.filter(user=self.request.user)    
     filter_backends = (filters.DjangoFilterBackend,)
@@ -149,18 +181,25 @@ class ExpenseViewSet(viewsets.ModelViewSet):
 
 # Budget ViewSet
 class BudgetViewSet(viewsets.ModelViewSet):
+    """ Budgets list their receipt ids; add `?expand=receipts` for full receipts and `?fields=` to trim the output. """
     serializer_class = BudgetSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    ordering = ('-start_date', '-id')
     def get_queryset(self):
-        return Budget.objects.filter(user=self.request.user)    
+        expand = self.request.query_params.get('expand', '').split(',')
+        receipts = Receipt.objects.all() if 'receipts' in expand else Receipt.objects.only('id')
+        return Budget.objects.filter(user=self.request.user).prefetch_related(Prefetch('receipts', queryset=receipts))
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_fields = ['id', 'start_date', 'end_date', 'filter_categories']
 
     def perform_create(self, serializer):
         """
-        Ensure that `current_spending` is initialized to zero upon creation.
+        Ensure that `current_spending` is initialized to zero upon creation,
+        then pick up the user's existing receipts that fall into the new budget.
         """
-        serializer.save(user=self.request.user)
+        budget = serializer.save(user=self.request.user)
+        link_budget_to_receipts(budget)
 
 def _format_price(price_dict):
     if price_dict is None:
@@ -170,6 +209,8 @@ def _format_price(price_dict):
 class ReceiptViewSet(viewsets.ModelViewSet):
     serializer_class = ReceiptSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    ordering = ('-uploaded_at', '-id')
     def get_queryset(self):
         return Receipt.objects.filter(user=self.request.user)
     filter_backends = (filters.DjangoFilterBackend,)
@@ -179,11 +220,6 @@ class ReceiptViewSet(viewsets.ModelViewSet):
 
         serializer.save(user=self.request.user)
 
-def generate_filename(filename):
-    timestamp = int(time.time())  # Get current timestamp
-    extension = filename.split('.')[-1]  # Extract file extension
-    return f"{timestamp}.{extension}"  # Return unique filename
-
 class ProcessReceiptView(APIView):
     #authentication_classes = [SessionAuthentication]  # No CSRF required
     permission_classes = [IsAuthenticated]
@@ -191,155 +227,94 @@ class ProcessReceiptView(APIView):
         
         image_url = request.data.get('image_url')
         uploaded_file = request.FILES.get('image')
-        
-        if uploaded_file:
-            blob_name = generate_filename(uploaded_file.name)
-            receiptUrl = upload_image_to_azure(uploaded_file, blob_name)
-        elif image_url:
-            try:
-                # Download the image from the URL
-                response = requests.get(image_url, timeout=10)
-                if response.status_code != 200:
-                    return Response({"error": "Failed to download image from URL."}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Convert to Django file and upload to Blob Storage
-                image_content = ContentFile(response.content)
-                blob_name = generate_filename("receipt_from_url.jpg")  # Naming for URL images
-                receiptUrl = upload_image_to_azure(image_content, blob_name)
-
-            except requests.exceptions.RequestException as e:
-                return Response({"error": f"Error fetching image from URL: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)        
-        else:
+
+        if not uploaded_file and not image_url:
             return Response({"error": "No image file or image_url provided."}, status=status.HTTP_400_BAD_REQUEST)
-        #endpoint = os.environ["DOCUMENTINTELLIGENCE_ENDPOINT"]
-        endpoint = "https://testcloud-receipt.cognitiveservices.azure.com/"
-        #key = os.environ["DOCUMENTINTELLIGENCE_API_KEY"]
-        key = "55ZEzXXYdoiuCQykzrZFzTMUxdD4gaw3kqUx8o1U0heIaVoXxu2vJQQJ99BAACi5YpzXJ3w3AAALACOGLe2w"
-
-        document_intelligence_client = DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key))
-        if receiptUrl:
-            # Process URL
-            poller = document_intelligence_client.begin_analyze_document(
-                "prebuilt-receipt",
-                AnalyzeDocumentRequest(url_source=receiptUrl)
-            )
-        
-        receipts: AnalyzeResult = poller.result()
-        
-        if receipts.documents:
-            for idx, receipt in enumerate(receipts.documents):
-                if receipt.fields:
-                    merchant_name = receipt.fields.get("MerchantName")
-                    total = receipt.fields.get("Total")
-                    items = receipt.fields.get("Items")
-                    transaction_date_field = receipt.fields.get("TransactionDate")
-                    receipt_category = receipt.fields.get("ReceiptType")
-                    receipt_items = []
-                    if items:
-                        for idx, item in enumerate(items.get("valueArray")):
-                            item_details = {}
-                            item_description = item.get("valueObject").get("Description")
-                            if item_description:
-                                item_details["description"] = {
-                                "value": item_description.get("valueString"),
-                                }
-
-                            item_quantity = item.get("valueObject").get("Quantity")
-                            if item_quantity:
-                                item_details["quantity"] = {
-                                "value": item_quantity.get("valueString"),
-                                }
-
-                            item_total_price = item.get("valueObject").get("TotalPrice")
-                            if item_total_price:
-                                item_details["total_price"] = {
-                                "value": str(item_total_price.get("valueCurrency").get("amount")),
-                                }
-                                category = receipt_category.get('valueString')
-                                category_choices = {c.value.lower(): c.value for c in CategoryChoices}
-                                assigned_category = category_choices.get(category.lower(), CategoryChoices.OTHER)
-                            Expense.objects.create(
-                                user=request.user,
-                                amount=item_total_price.get("valueCurrency").get("amount"),
-                                category=assigned_category,
-                                date=transaction_date_field.get("valueDate") if transaction_date_field else None,
-                                vendor=merchant_name.get('valueString') if merchant_name else "Unknown Merchant",
-                                payment_method=None,
-                            )
-                            receipt_items.append(item_details)
-        category = receipt_category.get('valueString').split(".")[0]
-        category_choices = {c.value.lower(): c.value for c in CategoryChoices}
-        assigned_category = category_choices.get(category.lower(), CategoryChoices.OTHER)
-        receipt = Receipt.objects.create(user=request.user,
-                                         image_url=receiptUrl if receiptUrl else None,
-                                         merchant=merchant_name.get('valueString') if merchant_name else "Unknown Merchant",
-                                         total_amount = float(total.get("valueCurrency", {}).get("amount")) if total else 0.00,
-                                         parsed_items=receipt_items,
-                                         transaction_date=transaction_date_field.get("valueDate") if transaction_date_field else None,
-                                         receipt_category=assigned_category,
-                                         )
-        receipt.assign_to_budget()
+
+        if _is_truthy(request.query_params.get('async', request.data.get('async'))):
+            # Job mode: store the upload and let a background worker do the OCR
+            job = ReceiptJob.objects.create(user=request.user, image_file=uploaded_file, image_url=None if uploaded_file else image_url)
+            transaction.on_commit(lambda: get_job_backend().enqueue(job.pk))
+            serializer = ReceiptJobSerializer(job, context={'request': request})
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+        try:
+            receipt = process_receipt(request.user, image_file=uploaded_file, image_url=image_url)
+        except ReceiptProcessingError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         serializer = ReceiptSerializer(receipt)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
-    
-def upload_image_to_azure(image_file, blob_name):
-    """Uploads an image to Azure Blob Storage and returns the URL."""
-    
-    #AZURE_STORAGE_ACCOUNT_NAME = os.environ["AZURE_STORAGE_ACCOUNT_NAME"]
-    AZURE_STORAGE_ACCOUNT_NAME = "testcloudblob"
-    #AZURE_STORAGE_ACCOUNT_KEY = os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
-    AZURE_STORAGE_ACCOUNT_KEY = "EMNuCh/mIyM97+CH6MYiXzeXv7Vwkp2VqAXtn+jaqGfuvZf6biFl4j+4v37b3lwv8JJ0Cplq7E21+AStyNNiKg=="
-    #AZURE_CONTAINER_NAME = os.environ["AZURE_CONTAINER_NAME"]
-    AZURE_CONTAINER_NAME = "testcloud-blob"
-
-
-    compressed_image = compress_image(image_file)
-    # Connect to Azure Blob Storage
-    
-    blob_service_client = BlobServiceClient(
-        f'https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net',
-        credential=AZURE_STORAGE_ACCOUNT_KEY
-    )
 
-    blob_client = blob_service_client.get_blob_client(container=AZURE_CONTAINER_NAME, blob=blob_name)
-    blob_client.upload_blob(compressed_image, overwrite=True)
-    blob_client.set_http_headers(content_settings=ContentSettings(content_type="image/png"))
-    # Upload Image
-
-    # Generate SAS URL with expiration time (e.g., 1 hour)
-    sas_token = generate_blob_sas(
-        account_name=AZURE_STORAGE_ACCOUNT_NAME,
-        container_name=AZURE_CONTAINER_NAME,
-        blob_name=blob_name,
-        account_key=AZURE_STORAGE_ACCOUNT_KEY,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(days=365 * 100)  # URL expires in 1 hour
-    )
-
-    sas_url = f"{blob_client.url}?{sas_token}"
-
-    return sas_url
-    
-    
-def compress_image(image_file):
-    """Compress the image to reduce file size before uploading."""
-    img = Image.open(image_file)
+class ProcessReceiptBatchView(APIView):
+    """ Upload and analyse many receipts in one multipart request. """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
 
-    # Convert to JPEG (reduces file size)
-    img = img.convert("RGB")
+    def post(self, request, *args, **kwargs):
+        uploaded_files = request.FILES.getlist('images')
+        image_urls = request.data.getlist('image_urls')
+        sources = [(uploaded_file, None) for uploaded_file in uploaded_files] + [(None, url) for url in image_urls]
+
+        if not sources:
+            return Response({"error": "No images or image_urls provided."}, status=status.HTTP_400_BAD_REQUEST)
+        max_size = getattr(settings, 'RECEIPT_BATCH_MAX_SIZE', 50)
+        if len(sources) > max_size:
+            return Response({"error": f"A batch may contain at most {max_size} receipts."}, status=status.HTTP_400_BAD_REQUEST)
+
+        outcomes = analyse_receipt_sources(sources)
+        analysed = [outcome for outcome in outcomes if not isinstance(outcome, Exception)]
+        receipts = iter(create_receipts_from_results(request.user, analysed))
+
+        results = []
+        for index, ((uploaded_file, image_url), outcome) in enumerate(zip(sources, outcomes)):
+            result = {"index": index, "source": uploaded_file.name if uploaded_file else image_url}
+            if isinstance(outcome, Exception):
+                result.update(status="failed", error=str(outcome))
+            else:
+                result.update(status="created", receipt=ReceiptSerializer(next(receipts)).data)
+            results.append(result)
+
+        created = len(analysed)
+        if created == len(sources):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({"created": created, "failed": len(sources) - created, "results": results}, status=response_status)
 
-    # Save to buffer with compression
-    img_io = BytesIO()
-    img.save(img_io, format="JPEG", quality=70)  # Adjust quality (70-80 is good)
-    img_io.seek(0)
+def _is_truthy(value):
+    return str(value).lower() in ('1', 'true', 'yes')
 
-    return img_io
+class ReceiptJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """ Poll the status of receipts queued with `?async=true`. """
+    serializer_class = ReceiptJobSerializer
+    permission_classes = [IsAuthenticated]
+    def get_queryset(self):
+        return ReceiptJob.objects.filter(user=self.request.user).select_related('receipt')
+    filter_backends = (filters.DjangoFilterBackend,)
+    filterset_fields = ['status']
         
+class ReceiptImageView(APIView):
+    """ Serves receipt images kept in LocalFileStorage. The signed token in the URL is the credential. """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request, token):
+        storage = get_image_storage()
+        if not isinstance(storage, LocalFileStorage):
+            raise Http404
+        try:
+            image_file, content_type = storage.open(token)
+        except (signing.BadSignature, FileNotFoundError):
+            raise Http404
+        return FileResponse(image_file, content_type=content_type)
+
 class ExportReceiptsXlsxView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        """ Generate an Excel (.xlsx) file with formatted receipts, either all or by budget """
+        """ Generate an Excel (.xlsx) or, with `?export_format=csv`, a streamed CSV file of receipts, either all or by budget """
         
         budget_id = kwargs.get("budget_id")  # Check if budget_id is provided in the URL
 
@@ -365,107 +340,336 @@ class ExportReceiptsXlsxView(APIView):
             receipts = Receipt.objects.filter(user=request.user)
             filename = "receipts.xlsx"
 
-        # Create an Excel workbook and sheet
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Receipts"
+        rows = _export_rows(receipts)
 
-        # Define column headers
-        headers = ["ID", "Merchant", "Total Amount", "Transaction Date", "Receipt Category", "Item Name", "Item Price"]
-        
-        ws.append(headers)
+        if request.query_params.get("export_format") == "csv":
+            # Stream CSV rows straight to the client as they are read from the database
+            writer = csv.writer(_Echo())
+            response = StreamingHttpResponse(
+                (writer.writerow(row) for row in itertools.chain([EXPORT_HEADERS], rows)),
+                content_type="text/csv",
+            )
+            response["Content-Disposition"] = f'attachment; filename="{filename.replace(".xlsx", ".csv")}"'
+            return response
+
+        # Create a write-only Excel workbook, so rows are flushed to disk instead of kept in memory
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Receipts")
+
+        # Column widths must be set before any row is written, so size them from the database
+        for col_num, width in enumerate(_export_column_widths(receipts), 1):
+            ws.column_dimensions[get_column_letter(col_num)].width = width
 
         # Format headers
-        for col_num, header in enumerate(headers, 1):
-            ws[f"{get_column_letter(col_num)}1"].alignment = Alignment(horizontal="center", vertical="center")
-
-        # Write receipt data
-        for receipt in receipts:
-            transaction_date = receipt.transaction_date.strftime('%d/%m/%Y') if receipt.transaction_date else receipt.uploaded_at.strftime('%d/%m/%Y')
-
-            # First row: Receipt details with the first item
-            receipt_row = [
-                receipt.id,
-                receipt.merchant,
-                f"{round(receipt.total_amount, 2):.2f}",
-                transaction_date,
-                receipt.receipt_category
-            ]
-
-            if isinstance(receipt.parsed_items, list) and receipt.parsed_items:
-                first_item = receipt.parsed_items[0]
-                item_name = first_item.get("description", {}).get("value", "Unknown Item")
-                item_price = float(first_item.get("total_price", {}).get("value", "0.00"))
-                receipt_row.append(item_name)
-                receipt_row.append(f"{item_price:.2f}")
-            else:
-                receipt_row.append("No Items")
-                receipt_row.append("-")
-
-            ws.append(receipt_row)
-
-            # Additional rows for remaining items (without repeating receipt details)
-            if isinstance(receipt.parsed_items, list) and len(receipt.parsed_items) > 1:
-                for item in receipt.parsed_items[1:]:
-                    item_name = item.get("description", {}).get("value", "Unknown Item")
-                    item_price = float(item.get("total_price", {}).get("value", "0.00"))
-                    ws.append(["", "", "", "", "", item_name, f"{item_price:.2f}"])
-
-        # Auto-adjust column widths
-        for col_num, col_cells in enumerate(ws.columns, 1):
-            max_length = 0
-            col_letter = get_column_letter(col_num)
-            for cell in col_cells:
-                try:
-                    if cell.value:
-                        max_length = max(max_length, len(str(cell.value)))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[col_letter].width = adjusted_width
-
-        # Enable wrap text for the Parsed Items column
+        header_cells = []
+        for header in EXPORT_HEADERS:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.alignment = Alignment(horizontal="center", vertical="center")
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+        with timed("serialize"):
+            for row in rows:
+                ws.append(row)
+
+        content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        if _is_truthy(request.query_params.get("stream")):
+            workbook_file = tempfile.TemporaryFile()
+            with timed("serialize"):
+                wb.save(workbook_file)
+            workbook_file.seek(0)
+            return FileResponse(workbook_file, as_attachment=True, filename=filename, content_type=content_type)
+
         # Create HTTP response
-        response = HttpResponse(content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        response = HttpResponse(content_type=content_type)
         response["Content-Disposition"] = f'attachment; filename="{filename}"'
-        wb.save(response)
+        with timed("serialize"):
+            wb.save(response)
 
         return response
+
+EXPORT_HEADERS = ["ID", "Merchant", "Total Amount", "Transaction Date", "Receipt Category", "Item Name", "Item Price"]
+EXPORT_ITEM_NAME_MAX_WIDTH = 60  # Longer item names wrap instead of widening the column further
+
+class _Echo:
+    """ A file-like object whose write() hands the line back, for streaming csv.writer output. """
+    def write(self, value):
+        return value
+
+def _export_rows(receipts):
+    """ Yield one row per receipt with its first item, then one row for each further item. """
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+    receipt_rows = receipts.order_by("id").values_list(
+        "id", "merchant", "total_amount", "transaction_date", "uploaded_at", "receipt_category"
+    )
+    # The items arrive as a second stream in the same order, so each receipt's items are the next group
+    items = ReceiptItem.objects.filter(receipt__in=receipts.order_by().values("pk")).order_by("receipt_id", "position")
+    item_groups = itertools.groupby(items.values_list("receipt_id", "description", "total_price").iterator(chunk_size=chunk_size), key=lambda item: item[0])
+    group = next(item_groups, None)
+
+    for receipt_id, merchant, total_amount, transaction_date, uploaded_at, category in receipt_rows.iterator(chunk_size=chunk_size):
+        transaction_date = transaction_date.strftime('%d/%m/%Y') if transaction_date else uploaded_at.strftime('%d/%m/%Y')
+        while group is not None and group[0] < receipt_id:  # Items of a receipt added after the receipts were read
+            group = next(item_groups, None)
+        receipt_items = []
+        if group is not None and group[0] == receipt_id:
+            receipt_items = [(description, price) for _, description, price in group[1]]
+            group = next(item_groups, None)
+
+        # First row: Receipt details with the first item
+        receipt_row = [
+            receipt_id,
+            merchant,
+            f"{round(total_amount, 2):.2f}",
+            transaction_date,
+            category
+        ]
+
+        if receipt_items:
+            receipt_row.extend(_export_item(*receipt_items[0]))
+        else:
+            receipt_row.append("No Items")
+            receipt_row.append("-")
+
+        yield receipt_row
+
+        # Additional rows for remaining items (without repeating receipt details)
+        for description, price in receipt_items[1:]:
+            yield ["", "", "", "", "", *_export_item(description, price)]
+
+def _export_item(description, price):
+    return [description or "Unknown Item", f"{price or 0:.2f}"]
+
+def _export_column_widths(receipts):
+    """ Column widths (longest value + 2) computed with two aggregate queries instead of a pass over every cell. """
+    longest_items = ReceiptItem.objects.filter(receipt__in=receipts.order_by().values("pk")).aggregate(
+        description=Max(Length("description")),
+        max_price=Max("total_price"),
+        min_price=Min("total_price"),
+    )
+    longest = receipts.order_by().aggregate(
+        id=Max("id"),
+        merchant=Max(Length("merchant")),
+        max_total=Max("total_amount"),
+        min_total=Min("total_amount"),
+        category=Max(Length("receipt_category")),
+    )
+    totals = [len(f"{total:.2f}") for total in (longest["max_total"], longest["min_total"]) if total is not None]
+    prices = [len(f"{price:.2f}") for price in (longest_items["max_price"], longest_items["min_price"]) if price is not None]
+    value_lengths = [
+        len(str(longest["id"] or "")),
+        longest["merchant"] or 0,
+        max(totals, default=0),
+        len("dd/mm/yyyy"),
+        longest["category"] or 0,
+        max(min(longest_items["description"] or 0, EXPORT_ITEM_NAME_MAX_WIDTH), len("Unknown Item"), len("No Items")),
+        max(prices, default=len("0.00")),
+    ]
+    return [max(length, len(header)) + 2 for length, header in zip(value_lengths, EXPORT_HEADERS)]
  
+class ReportReceiptsPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
 class BudgetReportView(APIView):  
+    """ Spending summary for a budget. Receipts are paginated with `?page=` and left out with `?include_receipts=false`. """
     permission_classes = [IsAuthenticated]
 
     def get(self, request, budget_id):
         budget = get_object_or_404(Budget, id=budget_id, user=request.user)
+
+        # Snapshots are keyed by the budget's data version, which every change to it or its receipts bumps.
+        # Receipt image URLs are signed, so a body listing receipts also rolls over with the signing window:
+        # URLs are handed out with at least URL_REFRESH_MARGIN seconds left, so they outlive the window they are issued in.
+        signing_window = None
+        if self.includes_receipts(request):
+            signing_window = int(time.time() // get_storage_settings()["URL_REFRESH_MARGIN"])
+        variant = repr((request.get_host(), sorted(request.query_params.lists()), signing_window))
+        variant = hashlib.sha256(variant.encode()).hexdigest()[:16]
+        etag = f'"budget-{budget.pk}-v{budget.data_version}-{variant}"'
+        last_modified = int(budget.data_updated_at.timestamp())
+        not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            # A 304 carries the validators too, so caches can refresh their stored copy (RFC 9110 15.4.5)
+            not_modified["ETag"] = etag
+            not_modified["Last-Modified"] = http_date(last_modified)
+            return not_modified
+
+        cache = caches[getattr(settings, 'BUDGET_REPORT_CACHE', 'default')]
+        cache_key = f"budget-report:{budget.pk}:{budget.data_version}:{variant}"
+        response_data = cache.get(cache_key)
+        if response_data is None:
+            response_data = self.build_report(request, budget)
+            cache.set(cache_key, response_data, getattr(settings, 'BUDGET_REPORT_CACHE_TIMEOUT', 300))
+
+        response = Response(response_data, status=status.HTTP_200_OK)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    @staticmethod
+    def includes_receipts(request):
+        return request.query_params.get('include_receipts', 'true').lower() not in ('0', 'false', 'no')
+
+    def build_report(self, request, budget):
         receipts = Receipt.objects.filter(budget=budget)
         
-        # Calculate spending summary
-        total_spent = sum(receipt.total_amount or 0 for receipt in receipts)
+        # Calculate spending summary in the database, one row per category
+        items = ReceiptItem.objects.filter(receipt=OuterRef("pk")).order_by().values("receipt").annotate(count=Count("pk")).values("count")
+        item_count = Coalesce(Subquery(items), Value(1))  # Receipts without items count as one
+        per_category = (
+            receipts.order_by()
+            .values("receipt_category")
+            .annotate(spent=Sum("total_amount"), items=Sum(item_count))
+        )
         category_spending = {}
-        total_items = 0
         category_items = {}
-        
-        for receipt in receipts:
-            category = receipt.receipt_category
-            category_spending[category] = category_spending.get(category, 0) + (receipt.total_amount or 0)
-            
-            item_count = len(receipt.parsed_items) if receipt.parsed_items else 1
-            total_items += item_count
-            category_items[category] = category_items.get(category, 0) + item_count
+        for row in per_category:
+            category_spending[row["receipt_category"]] = row["spent"] or 0
+            category_items[row["receipt_category"]] = row["items"]
         
         response_data = {
-            "budget": BudgetSerializer(budget).data,
-            "total_spent": total_spent,
+            "budget": BudgetSerializer(budget, context={'exclude': ['receipt_ids', 'receipt_count']}).data,
+            "total_spent": sum(category_spending.values()),
             "category_spending": category_spending,
-            "total_items": total_items,
+            "total_items": sum(category_items.values()),
             "category_items": category_items,
-            "receipts": ReceiptSerializer(receipts, many=True).data,
         }
-        return Response(response_data, status=status.HTTP_200_OK)
+        if self.includes_receipts(request):
+            paginator = ReportReceiptsPagination()
+            page = paginator.paginate_queryset(receipts.order_by('-uploaded_at', '-id'), request, view=self)
+            response_data.update({
+                "receipts_count": paginator.page.paginator.count,
+                "receipts_next": paginator.get_next_link(),
+                "receipts_previous": paginator.get_previous_link(),
+                "receipts": ReceiptSerializer(page, many=True).data,
+            })
+        return response_data
+
+
+class SpendingAnalyticsView(APIView):
+    """
+    Receipt and expense spending per day, week or month (`?granularity=`, default month), answered from SpendingRollup.
+    Narrow it with `?start=` and `?end=` (inclusive ISO dates) and `?category=`; `?by_category=false` totals all categories.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        granularity = request.query_params.get('granularity', 'month')
+        if granularity not in GRANULARITIES:
+            return Response({"error": f"granularity must be one of: {', '.join(GRANULARITIES)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        bounds = {}
+        for name in ('start', 'end'):
+            value = request.query_params.get(name)
+            try:
+                bounds[name] = parse_date(value) if value else None
+            except ValueError:
+                bounds[name] = None
+            if value and bounds[name] is None:
+                return Response({"error": f"{name} must be a date in YYYY-MM-DD format."}, status=status.HTTP_400_BAD_REQUEST)
+
+        categories = [category for value in request.query_params.getlist('category') for category in value.split(',') if category]
+        unknown = set(categories) - set(CategoryChoices.values)
+        if unknown:
+            return Response({"error": f"Unknown categories: {', '.join(sorted(unknown))}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        by_category = request.query_params.get('by_category', 'true').lower() not in ('0', 'false', 'no')
+        return Response({
+            "granularity": granularity,
+            "start": bounds['start'],
+            "end": bounds['end'],
+            "results": spending_series(request.user, granularity, categories=categories, by_category=by_category, **bounds),
+        })
+
+
+class SearchPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+class SearchView(APIView):
+    """
+    Ranked full-text search over the user's receipts (merchant and item descriptions) and expenses (vendor).
+    Every word of `?q=` must match the start of a word; `?type=receipt` or `?type=expense` narrows it. Paginated with `?page=`.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "A search query (q) is required."}, status=status.HTTP_400_BAD_REQUEST)
+        kind = request.query_params.get('type') or None
+        if kind not in (None, 'receipt', 'expense'):
+            return Response({"error": "type must be receipt or expense."}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(search_documents(request.user, query, kind), request, view=self)
+        documents = SearchDocument.objects.select_related('receipt', 'expense').in_bulk([pk for pk, _ in page])
+        results = []
+        for pk, rank in page:
+            document = documents.get(pk)
+            if document is None:  # Deleted since the ranking query
+                continue
+            if document.receipt_id:
+                results.append({"type": "receipt", "rank": rank, "receipt": ReceiptSerializer(document.receipt).data})
+            else:
+                results.append({"type": "expense", "rank": rank, "expense": ExpenseSerializer(document.expense).data})
+        return paginator.get_paginated_response(results)
+
+
+class ImportView(APIView):
+    """
+    Bulk import of expenses or receipts from a CSV (with a header row) or JSON lines body, streamed and
+    committed a chunk of rows at a time. Send the file as the raw body (Content-Type text/csv or
+    application/x-ndjson) or as the `file` field of a multipart form; `?import_format=` overrides the
+    detected format. Invalid rows are skipped and reported by line; `manage.py import_data` writes
+    them all to an error file.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, kind):
+        if kind not in IMPORTERS:
+            return Response({"error": f"kind must be one of: {', '.join(IMPORTERS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        if request.content_type.startswith('multipart/form-data'):
+            uploaded_file = request.FILES.get('file')
+            if not uploaded_file:
+                return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+            body, hint = uploaded_file, uploaded_file.name
+        else:
+            body, hint = request.stream or [], request.content_type
+        data_format = request.query_params.get('import_format') or _import_format(hint)
+        if data_format not in FORMATS:
+            return Response({"error": f"import_format must be one of: {', '.join(FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = import_rows(request.user, kind, decode_lines(body), data_format, chunk_size=getattr(settings, 'IMPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+        if not result.imported and not result.failed and not result.error:
+            return Response({"error": "No rows found."}, status=status.HTTP_400_BAD_REQUEST)
+        if result.imported and (result.failed or result.error):
+            response_status = status.HTTP_207_MULTI_STATUS
+        elif result.imported:
+            response_status = status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(result.as_dict(), status=response_status)
+
+def _import_format(hint):
+    """The import format a content type or file name suggests, if any."""
+    hint = (hint or '').lower()
+    if 'csv' in hint:
+        return 'csv'
+    if any(name in hint for name in ('ndjson', 'jsonl', 'json')):
+        return 'ndjson'
+    return None
 
 
 class EmailPasswordLoginView(APIView):
-    """ Login using email and password, and store session """
+    """
+    Login using email and password. The returned Authorization value is a
+    short-lived JWT bearer header, so clients never resend the password; use
+    the refresh token with /api/token/refresh/ for a new one.
+    """
     permission_classes = [AllowAny]
 
     def post(self, request):
@@ -478,9 +682,12 @@ class EmailPasswordLoginView(APIView):
         user = authenticate(request, email=email, password=password)
 
         if user:
+            refresh = RefreshToken.for_user(user)
             return Response({
                 "message": "Login successful!",
-                "Authorization": f"Basic {base64.b64encode(f'{email}:{password}'.encode()).decode()}"
+                "Authorization": f"Bearer {refresh.access_token}",
+                "access": str(refresh.access_token),
+                "refresh": str(refresh),
             }, status=status.HTTP_200_OK)
 
         return Response({"error": "Invalid email or password"}, status=status.HTTP_401_UNAUTHORIZED)
@@ -499,4 +706,16 @@ class CSRFTokenView(APIView):
 
     def get(self, request):
         csrf_token = get_token(request)  # Retrieve the CSRF token
-        return JsonResponse({"csrfToken": csrf_token})
\ No newline at end of file
+        return JsonResponse({"csrfToken": csrf_token})
+
+
+class MetricsView(APIView):
+    """ Request metrics in the Prometheus text format. With REQUEST_METRICS['TOKEN'] set, scrapers must send it as a Bearer token. """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request):
+        token = get_metrics_settings()["TOKEN"]
+        if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
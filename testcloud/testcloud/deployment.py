@@ -7,6 +7,7 @@ CSRF_TRUSTED_ORIGINS = ['https://'+os.environ['WEBSITE_HOSTNAME']]
 DEBUG = False
 SECRET_KEY = os.environ['MY_SECRET_KEY']
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',  # First, so the time of the other middleware counts too
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -29,6 +30,8 @@ STORAGES = {
 CONNECTION = os.environ['AZURE_POSTGRESQL_CONNECTIONSTRING']
 CONNECTION_STR = {pair.split('=')[0]:pair.split('=')[1] for pair in CONNECTION.split(' ')}
 
+# Allow-list pg_trgm in the server's azure.extensions parameter before migrating, so search also
+# matches misspelt names; without it migration 0009 skips the trigram index.
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
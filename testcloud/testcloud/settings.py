@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 from datetime import timedelta
 from pathlib import Path
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',  # First, so the time of the other middleware counts too
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -149,6 +151,7 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR/'staticfiles'
+MEDIA_ROOT = BASE_DIR/'media'
 WSGI_APPLICATION = 'testcloud.wsgi.application'
 
 
@@ -174,12 +177,31 @@ REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_AUTHENTICATION_CLASSES': (   
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',  # JWTAuthentication without a user query per request
         'rest_framework.authentication.SessionAuthentication',  # Enable session-based login
-        'rest_framework.authentication.BasicAuthentication', 
+        'api.authentication.CachedBasicAuthentication',  # Basic auth for older clients, without re-hashing every request
     ),
 }
 
+# Server-Timing headers and the histograms behind /metrics
+REQUEST_METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+    'TOKEN': os.environ.get('METRICS_TOKEN'),  # Scrapers send "Authorization: Bearer <token>" when set
+}
+
+# Verified Basic-auth credentials skip the password hasher for this long (per process)
+BASIC_AUTH_CACHE = {
+    'MAX_ENTRIES': 1024,
+    'TTL': 300,  # seconds
+}
+
+# Users resolved from JWTs are cached here; saving or deleting a user invalidates its entry
+JWT_USER_CACHE = {
+    'CACHE': 'default',
+    'TTL': 60,  # seconds
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
@@ -187,3 +209,75 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME_LATE_USER': timedelta(days=1),
     'SLIDING_TOKEN_LIFETIME_LATE_USER': timedelta(days=30),
 }
+
+# Azure services; the environment overrides the development defaults
+AZURE_STORAGE = {
+    'ACCOUNT_NAME': os.environ.get('AZURE_STORAGE_ACCOUNT_NAME', 'testcloudblob'),
+    'ACCOUNT_KEY': os.environ.get('AZURE_STORAGE_ACCOUNT_KEY', 'EMNuCh/mIyM97+CH6MYiXzeXv7Vwkp2VqAXtn+jaqGfuvZf6biFl4j+4v37b3lwv8JJ0Cplq7E21+AStyNNiKg=='),
+    'CONTAINER': os.environ.get('AZURE_CONTAINER_NAME', 'testcloud-blob'),
+    'BLOCK_SIZE': 1024 * 1024,  # images above this size are uploaded in blocks of this size
+}
+DOCUMENT_INTELLIGENCE = {
+    'ENDPOINT': os.environ.get('DOCUMENTINTELLIGENCE_ENDPOINT', 'https://testcloud-receipt.cognitiveservices.azure.com/'),
+    'KEY': os.environ.get('DOCUMENTINTELLIGENCE_API_KEY', '55ZEzXXYdoiuCQykzrZFzTMUxdD4gaw3kqUx8o1U0heIaVoXxu2vJQQJ99BAACi5YpzXJ3w3AAALACOGLe2w'),
+}
+
+# Where processed receipt images are kept; api.storage.LocalFileStorage works offline under MEDIA_ROOT
+RECEIPT_STORAGE = {
+    'BACKEND': os.environ.get('RECEIPT_STORAGE_BACKEND', 'api.storage.AzureBlobStorage'),
+    'URL_TTL': 3600,  # seconds a signed read URL is valid
+    'URL_REFRESH_MARGIN': 300,  # cached URLs are re-signed this long before they expire
+}
+
+# Receipt OCR; api.analysis.FixtureReceiptAnalyser replays the recorded results in api/analysis_fixtures offline
+RECEIPT_ANALYSER = {
+    'BACKEND': os.environ.get('RECEIPT_ANALYSER_BACKEND', 'api.analysis.AzureReceiptAnalyser'),
+    'RECORD_DIR': os.environ.get('RECEIPT_ANALYSER_RECORD_DIR'),  # save raw Azure results here for later replay
+    'LATENCY': 0.0,  # seconds the fixture analyser waits per receipt
+}
+
+# Keep-alive connection pools shared by the Azure clients and image downloads
+HTTP_POOL = {
+    'CONNECTIONS': 10,  # hosts with a cached pool
+    'MAXSIZE': 20,  # connections kept per host; at least RECEIPT_BATCH_WORKERS + RECEIPT_JOBS['WORKERS']
+}
+
+# Background processing of receipts uploaded with `?async=true`
+RECEIPT_JOBS = {
+    'BACKEND': 'api.jobs.DatabaseJobBackend',  # run `manage.py process_receipt_jobs`; or api.jobs.ThreadPoolJobBackend in the web process
+    'WORKERS': 4,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 5,  # seconds, doubled after every failed attempt
+    'LEASE': 600,  # seconds before a running job whose worker died is retried
+    'POLL_INTERVAL': 5,  # seconds between ThreadPoolJobBackend's checks for retries and abandoned jobs
+}
+
+# Batch receipt uploads to /api/process-receipts/batch/
+RECEIPT_BATCH_MAX_SIZE = 50
+RECEIPT_BATCH_WORKERS = 8  # concurrent uploads and document analyses per batch
+
+# Uploads are downscaled and re-encoded before OCR on a pool of processes (WORKERS=0 runs inline)
+RECEIPT_IMAGES = {
+    'MAX_DIMENSION': 2000,  # pixels on the longest side
+    'MAX_PIXELS': 50_000_000,  # larger uploads are rejected as decompression bombs
+    'JPEG_QUALITY': 70,
+    'WORKERS': 2,
+    'MAX_BYTES': 20 * 1024 * 1024,  # uploads and image_url downloads are streamed and capped at this size
+    'CHUNK_SIZE': 64 * 1024,
+}
+
+# Rows fetched per database round trip while exporting receipts
+EXPORT_CHUNK_SIZE = 2000
+
+# Budget report snapshots are cached per budget data version; any cache backend works here
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reports': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'budget-reports',
+    },
+}
+BUDGET_REPORT_CACHE = 'reports'
+BUDGET_REPORT_CACHE_TIMEOUT = 300  # seconds